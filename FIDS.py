@@ -16,23 +16,41 @@ from pprint import pprint
 from datetime import datetime as dt
 from memory_profiler import profile
 # IO
-from io_tools import get_valid_filelist, get_dict_of_files, get_data_counts, get_brick_data_types
+from io_tools import get_valid_filelist, get_file_pool, get_brick_data_types
 from io_tools import parse_datatype, map_types
-from io_tools import load_json
+from io_tools import load_json, save_json, get_zone_maps, get_sorted_indices, get_spatial_indices
+from io_tools import get_derived_pool, get_derived_column_path, get_derived_column_details
+from io_tools import save_selection_bitmap, load_selection_bitmap
 from os.path import isfile
 # Processing
 from data_tools import get_column_names, reduced_axis_list, args_to_criteria, update_interval
 # Data
-from data_tools import get_all_data, get_sample_data, get_subsetdata
+from data_tools import get_all_data, iter_all_data, get_sample_data, get_subsetdata
+from data_tools import get_selection_bitmap
 from data_tools import get_limits, reduce_cols, slice_data, get_relevant_bricks
 from data_tools import get_axis_data, format_two_columns, adjust_axis_type
 # Polygon
-from data_tools import get_data_in_polygon, get_data_in_selection
+from data_tools import get_selection_in_polygon
+from data_tools import RegionSelection, get_selected_vertices
+from data_tools import save_region_selection, load_region_selection
+# Expressions
+from data_tools import evaluate_expressions, check_expression, get_axis_expression
+from data_tools import get_expression_columns
+# Query Cache
+from data_tools import QueryCache, SelectionCache, get_query_key, get_selection_key
 # Sliders
-from setup_dataset import prepare_brick_info
+from setup_dataset import prepare_brick_info, load_brick_column_details, prepare_zone_maps
+from setup_dataset import prepare_sorted_indices, prepare_spatial_indices
+from setup_dataset import prepare_column_cache, get_column_cache_path, get_column_cache_suffix
+from setup_dataset import prepare_sample_cache, get_sample_cache_path
+from setup_dataset import prepare_derived_columns, check_derived_columns, get_derived_data_types
+from setup_dataset import reset_derived_indices
+from setup_dataset import update_manifest, get_manifest_data_counts, get_manifest_data_types
+from setup_dataset import get_manifest_column_names, get_column_details_key
+from setup_dataset import get_manifest_column_details, set_manifest_column_details
 from slider_magic import get_marks, get_range_slider, get_log_range_slider
 # Download
-from download import generate_df, generate_tmp, generate_small_file, unpack_vars
+from download import generate_df, generate_tmp, generate_small_file, generate_chunks, unpack_vars
 # Div
 from div_updating import hide_unhide_div, update_status
 # Dash
@@ -45,7 +63,7 @@ import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 # Web (Flask, etc.)
-from flask import request, session, Response, send_file
+from flask import request, session, Response, send_file, jsonify
 import urllib
 from urllib.parse import urlencode
 
@@ -71,14 +89,27 @@ filename_list = get_valid_filelist(settings['folderpath'], settings['filetypes']
 # TODO: Allow dictionary for renaming in display
 # TODO: Allow other data types
 # TODO: Allow heterogeneous data
-data = get_dict_of_files(filename_list, settings['folderpath'])
+# NOTE: Bricks are opened on first access and closed least-recently-used
+data = get_file_pool(
+    filename_list, settings['folderpath'],
+    max_open=settings['max_open_files'],
+    max_mapped_mb=settings['max_mapped_mb']
+)
+
+# Startup Manifest: stat() every file, only open changed or new ones
+manifest = load_json('manifest.json', savepath=settings['savepath'])
+manifest, changed_bricks, new_bricks = update_manifest(
+    manifest, data, filename_list, settings['folderpath']
+)
+if changed_bricks or new_bricks:
+    save_json(manifest, 'manifest.json', savepath=settings['savepath'])
 
 # Get File Descriptions
-data_counts = get_data_counts(data, ftype=settings['filetypes'][0])
+data_counts = get_manifest_data_counts(manifest, filename_list)
 # Defining columns
 # TODO: Read or allow import of UNITS. Maybe visual initialization as an app?
 column_names_file = sorted(settings['columns_to_use'])
-column_names_data = sorted(data[filename_list[0]].columns.names)
+column_names_data = sorted(get_manifest_column_names(manifest, filename_list))
 column_names = get_column_names(data, filename_list, column_names_file, column_names_data)
 # Reduce Columns to Useful
 selected_columns = column_names
@@ -95,37 +126,172 @@ display_count_step = settings['display_count_granularity']
 ####################################################################################
 
 # Slider Columns = Selected Columns with proper dtype
-brick_data_types = map_types(get_brick_data_types(data, filename_list))
+brick_data_types_raw = get_manifest_data_types(manifest, filename_list)
+brick_data_types = map_types(dict(brick_data_types_raw))
+# Columns stored in (cached copies of) bricks
+stored_col_list = column_names + [settings['name_column']]
+
+# Derived Columns = named expressions, computed once per brick into sidecars
+derived_columns = check_derived_columns(
+    settings['derived_columns'], column_names, brick_data_types
+)
+derived_data_types = get_derived_data_types(derived_columns)
+if derived_columns:
+    derived_bricks = prepare_derived_columns(
+        data, filename_list, derived_columns,
+        settings['folderpath'], settings['savepath'],
+        chunk_rows=settings['setup_chunk_rows'], hist_bins=settings['histogram_bins']
+    )
+    reset_derived_indices(derived_bricks, settings['savepath'])
+    # From here on, bricks are read with their derived columns
+    data = get_derived_pool(data, settings['savepath'], derived_data_types)
+    brick_data_types.update(map_types(dict(derived_data_types)))
+    # Listed like columns of the bricks, e.g. in dropdowns and sliders
+    column_names = sorted(column_names + list(derived_columns))
+    selected_columns = column_names
+
 allowed_types = settings["allowed_slider_dtypes"]
 slice_col_list = sorted([
     col_name for col_name in column_names
     if brick_data_types[col_name] in allowed_types
 ][:settings["max_slider_count"]])
+# Expression Columns = Selected Columns with numeric dtype
+expression_col_list = [
+    col_name for col_name in selected_columns
+    if np.dtype(brick_data_types[col_name]).kind in 'biuf'
+]
 
 # Get Brick Details
-brick_column_details = load_json('brick_column_details.json', savepath=settings['savepath'])
+brick_column_details = load_brick_column_details(settings['savepath'])
+# Details of changed files are outdated
+for brick_name in changed_bricks:
+    brick_column_details.pop(brick_name, None)
 
 # Fill in missing data if necessary
 brick_column_details = prepare_brick_info(
-    data, brick_column_details, filename_list, slice_col_list,
-    settings['savepath'], acceptable_types=settings['allowed_slider_dtypes']
+    data, brick_column_details, filename_list,
+    [col_name for col_name in slice_col_list if col_name not in derived_columns],
+    settings['savepath'], acceptable_types=settings['allowed_slider_dtypes'],
+    brick_data_types=brick_data_types_raw, chunk_rows=settings['setup_chunk_rows'],
+    folderpath=settings['folderpath'], processes=settings['setup_processes'],
+    hist_bins=settings['histogram_bins']
 )
+# Details of derived columns are computed with them
+derived_column_details = get_derived_column_details(
+    get_derived_column_path(settings['savepath']), filename_list, derived_columns
+)
+for brick_name, details in derived_column_details.items():
+    if brick_name in brick_column_details:
+        brick_column_details[brick_name].update(details)
 
 # Cut out bricks with computed details
 filename_list = [
     filename for filename in filename_list
     if filename in brick_column_details.keys()
 ]
-column_details = {
-    col_name: {
-        'min': parse_datatype(np.min([brick_column_details[brick_name][col_name]['min'] for brick_name in filename_list])),
-        'max': parse_datatype(np.max([brick_column_details[brick_name][col_name]['max'] for brick_name in filename_list])),
-    }
-    for col_name in slice_col_list
-}
+# Combined limits for sliders: reuse from manifest unless inputs changed
+column_details_key = get_column_details_key(
+    filename_list, slice_col_list, settings['savepath']+'brick_column_details.json',
+    derived_columns=derived_columns
+)
+column_details = get_manifest_column_details(manifest, column_details_key)
+if not column_details:
+    # Bricks without finite values of a column have NaN limits, columns without any are left out
+    column_details = {}
+    for col_name in slice_col_list:
+        col_details = [
+            brick_column_details[brick_name][col_name] for brick_name in filename_list
+            if (col_name in brick_column_details[brick_name])
+            and not np.isnan(brick_column_details[brick_name][col_name]['min'])
+        ]
+        if col_details:
+            column_details[col_name] = {
+                'min': parse_datatype(np.nanmin([details['min'] for details in col_details])),
+                'max': parse_datatype(np.nanmax([details['max'] for details in col_details])),
+            }
+    manifest = set_manifest_column_details(manifest, column_details_key, column_details)
+    save_json(manifest, 'manifest.json', savepath=settings['savepath'])
 slice_col_list = [col for col in slice_col_list if col in column_details.keys()]
 print("Reduced Slice Col List: ", slice_col_list)
 
+# Native-endian columnar cache: convert once, then read bricks from the cache
+if settings['column_cache']:
+    prepare_column_cache(
+        data, filename_list, stored_col_list,
+        settings['folderpath'], settings['savepath'],
+        chunk_rows=settings['setup_chunk_rows']
+    )
+    data.close_all()
+    data = get_derived_pool(get_file_pool(
+        filename_list, get_column_cache_path(settings['savepath']),
+        max_open=settings['max_open_files'],
+        max_mapped_mb=settings['max_mapped_mb'],
+        suffix=get_column_cache_suffix()
+    ), settings['savepath'], derived_data_types)
+    # Columns are stored native and decoded, no remapping of types needed
+    brick_data_types = get_brick_data_types(data, filename_list, ftype='cols')
+
+# Sample cache: bricks in random row order, such that samples are consecutive reads
+shuffled_data = {}
+if settings['sample_cache']:
+    prepare_sample_cache(
+        data, filename_list, stored_col_list,
+        settings['folderpath'], settings['savepath'],
+        chunk_rows=settings['setup_chunk_rows']
+    )
+    shuffled_data = get_file_pool(
+        filename_list, get_sample_cache_path(settings['savepath']),
+        max_open=settings['max_open_files'],
+        max_mapped_mb=settings['max_mapped_mb'],
+        suffix=get_column_cache_suffix()
+    )
+    # Derived columns of the shuffled rows, stored within the sample cache
+    if derived_columns:
+        prepare_derived_columns(
+            shuffled_data, filename_list, derived_columns,
+            settings['folderpath'], get_sample_cache_path(settings['savepath']),
+            chunk_rows=settings['setup_chunk_rows']
+        )
+        shuffled_data = get_derived_pool(
+            shuffled_data, get_sample_cache_path(settings['savepath']), derived_data_types
+        )
+
+# Zone maps: min/max per block of rows, to only slice blocks overlapping criteria
+zone_maps = {}
+if settings['zone_map_rows']:
+    prepare_zone_maps(
+        data, filename_list, slice_col_list,
+        settings['folderpath'], settings['savepath'],
+        block_rows=settings['zone_map_rows']
+    )
+    zone_maps = get_zone_maps(settings['savepath'])
+
+# Sorted indices: range criteria on these columns resolve by binary search
+sorted_indices = {}
+indexed_col_list = [col for col in settings['indexed_columns'] if col in slice_col_list]
+if indexed_col_list:
+    prepare_sorted_indices(
+        data, filename_list, indexed_col_list,
+        settings['folderpath'], settings['savepath']
+    )
+    sorted_indices = get_sorted_indices(settings['savepath'])
+
+# Spatial index: criteria on e.g. RA, DEC only check rows of intersecting grid cells
+spatial_indices = {}
+if all(col in slice_col_list for col in settings['spatial_index_columns']) \
+        and (len(settings['spatial_index_columns']) == 2):
+    prepare_spatial_indices(
+        data, filename_list, settings['spatial_index_columns'],
+        settings['folderpath'], settings['savepath'],
+        cell_size=settings['spatial_cell_size']
+    )
+    spatial_indices = get_spatial_indices(settings['savepath'])
+
+# Query cache: results of recent requests, reused while the rows stay the same
+query_cache = QueryCache(settings['query_cache_mb'])
+# Selection cache: rows of each brick within criteria, narrower criteria only check these
+selection_cache = SelectionCache(settings['selection_cache_mb'])
+
 # Set up range sliders
 slider_style = {
     'padding': '0px 20px 3px 20px', # above right below left
@@ -339,6 +505,22 @@ def create_formatter(axis_naming, axis_title, column_list):
                                     'display': 'table',
                                     'width': '100%'
                                 }
+                            ),
+                            # 2.4: Expression replacing the axis
+                            html.Div(
+                                add_explanation(
+                                    dcc.Input(
+                                        id='{}-expression'.format(axis_naming),
+                                        placeholder='Expression, e.g. log10(A / B), A - 5*log10(B) + 5',
+                                        type='text',
+                                        value='',
+                                        debounce=True,
+                                        style={'width': '100%'}
+                                    )
+                                ),
+                                style={
+                                    'padding': '3px 0px 0px 0px'
+                                }
                             )
                         ],
                         style={
@@ -518,6 +700,37 @@ app.layout = html.Div([
         # Element 7.1: Sliders
         *slice_list,
 
+        # Element 7.2: Filter expression
+        html.Div(
+            add_explanation(
+                dcc.Input(
+                    id='filter-expression',
+                    placeholder='Filter, e.g. 0.5 < A - B < 2 and C > 0',
+                    type='text',
+                    value='',
+                    debounce=True,
+                    style={'width': '100%'}
+                )
+            ),
+            style=dropdown_style
+        ),
+
+        # Element 7.3: Stored selection, e.g. of a download or combined ones
+        html.Div(
+            add_explanation(
+                dcc.Input(
+                    id='selection-bitmap-id',
+                    placeholder='Stored selection, e.g. bitmap_id of a download',
+                    type='text',
+                    value='',
+                    debounce=True,
+                    style={'width': '100%'}
+                ),
+                title="Only plot rows of a stored selection (see download status), within the sliders and filter"
+            ),
+            style=dropdown_style
+        ),
+
 
         # Graph 1: Scatter Plot
         html.Div(
@@ -560,6 +773,50 @@ app.layout = html.Div([
             }
         ),
 
+        # Graph 1.1: Selection Regions
+        html.Div(
+            [
+                add_explanation(
+                    html.Button(
+                        'Add Region',
+                        id='region-add-button',
+                        n_clicks=0
+                    ),
+                    title="Add the box or lasso selected on the graph to the selection"
+                ),
+                add_explanation(
+                    html.Button(
+                        'Subtract Region',
+                        id='region-subtract-button',
+                        n_clicks=0
+                    ),
+                    title="Remove the box or lasso selected on the graph from the selection"
+                ),
+                add_explanation(
+                    html.Button(
+                        'Clear Regions',
+                        id='region-clear-button',
+                        n_clicks=0
+                    ),
+                    title="Remove all regions, downloads use the box or lasso selected on the graph"
+                ),
+                html.Div(
+                    id='region-status',
+                    style={
+                        'padding': '0px 0px 0px 3px',
+                        'font-style': 'italic'
+                    }
+                ),
+                # Id of the stored selection
+                html.Div(
+                    id='region-selection-id',
+                    children='',
+                    style={'display': 'none'}
+                )
+            ],
+            style={'padding': '3px'}
+        ),
+
         # TODO: Graph Styling Section
         # Set min/max point size
         # Set colorscale
@@ -857,6 +1114,71 @@ def toggle_modal(n1, n2, n3, is_open):
     else: 
         return False
 
+@app.callback(
+    [
+        Output('region-selection-id', 'children'),
+        Output('region-status', 'children')
+    ],
+    [
+        Input('region-add-button', 'n_clicks'),
+        Input('region-subtract-button', 'n_clicks'),
+        Input('region-clear-button', 'n_clicks')
+    ],
+    [
+        State('indicator-graphic', 'selectedData'),
+        State('region-selection-id', 'children'),
+        State('xaxis_column', 'value'),
+        State('yaxis_column', 'value'),
+        State('xaxis-type', 'value'),
+        State('yaxis-type', 'value'),
+        State('xaxis-combined-column', 'value'),
+        State('yaxis-combined-column', 'value'),
+        State('xaxis-operator', 'value'),
+        State('yaxis-operator', 'value'),
+        State('xaxis-expression', 'value'),
+        State('yaxis-expression', 'value')
+    ]
+)
+def update_region_selection(add_clicks, subtract_clicks, clear_clicks, selected_data, selection_id,
+                            xaxis_name, yaxis_name, xaxis_type, yaxis_type,
+                            xaxis_two_name, yaxis_two_name, xaxis_operator, yaxis_operator,
+                            xaxis_expression, yaxis_expression):
+    """ Return id and status of the stored selection after adding or subtracting the box or lasso. """
+    triggered = [prop['prop_id'].split('.')[0] for prop in dash.callback_context.triggered]
+    mode = {'region-add-button': 'add', 'region-subtract-button': 'subtract'}.get(
+        triggered[0] if triggered else None
+    )
+    # Clear (or first load)
+    if mode is None:
+        return ['', None]
+    axes = dict(
+        xaxis_name=xaxis_name, yaxis_name=yaxis_name,
+        xaxis_type=xaxis_type, yaxis_type=yaxis_type,
+        xaxis_two_name=xaxis_two_name, xaxis_operator=xaxis_operator,
+        yaxis_two_name=yaxis_two_name, yaxis_operator=yaxis_operator,
+        xaxis_expression=check_expression(xaxis_expression, expression_col_list),
+        yaxis_expression=check_expression(yaxis_expression, expression_col_list)
+    )
+    status = []
+    region_selection = load_region_selection(selection_id, settings['savepath'])
+    # Regions are points on the axes they were drawn on
+    if (region_selection is None) or (not region_selection.is_same_axes(axes)):
+        if region_selection is not None:
+            status.append('Axes changed, new selection. ')
+        region_selection = RegionSelection(axes)
+    if (mode == 'subtract') and ('add' not in [region[0] for region in region_selection.regions]):
+        return [selection_id, 'Add a region before subtracting one.']
+    if not region_selection.add_region(mode, get_selected_vertices(selected_data)):
+        return [selection_id, 'Select a box or lasso on the graph first.']
+    selection_id = save_region_selection(region_selection, settings['savepath'],
+                                         max_mb=settings['stored_selections_mb'])
+    modes = [region[0] for region in region_selection.regions]
+    status.append('Selection: {} regions added, {} subtracted.'.format(
+        modes.count('add'), modes.count('subtract')
+    ))
+    return [selection_id, ''.join(status)]
+
+
 @app.callback(
     [
         Output('download-criteria-link', 'href'),
@@ -868,6 +1190,7 @@ def toggle_modal(n1, n2, n3, is_open):
     ],
     [
         State('indicator-graphic', 'selectedData'),
+        State('region-selection-id', 'children'),
         State('xaxis_column', 'value'),
         State('yaxis_column', 'value'),
         State('caxis_column', 'value'),
@@ -881,17 +1204,21 @@ def toggle_modal(n1, n2, n3, is_open):
         State('yaxis-operator', 'value'),
         State('xaxis-combined-column', 'value'),
         State('yaxis-combined-column', 'value'),
+        State('xaxis-expression', 'value'),
+        State('yaxis-expression', 'value'),
+        State('filter-expression', 'value'),
         State('brick_selector', 'value'),
         State('download_columns', 'value'),
         *slice_states
     ]
 )
-def params_to_link(n_clicks, selected_data,
+def params_to_link(n_clicks, selected_data, selection_id,
                    xaxis_name, yaxis_name, caxis_name, saxis_name,
                    xaxis_type, yaxis_type, #caxis_type, saxis_type,
                    xaxis_two_name, yaxis_two_name, caxis_two_name,
                    xaxis_operator, yaxis_operator,
                    xaxis_second_name, yaxis_second_name,
+                   xaxis_expression, yaxis_expression, filter_expression,
                    bricks_selected, download_columns, 
                    *args):
     """ Update status and link for downloading by encoding all criteria into the URL. """
@@ -927,49 +1254,133 @@ def params_to_link(n_clicks, selected_data,
     # Setup:  Include Slider Criteria
     criteria_dict = args_to_criteria(bricks_selected, slice_col_list, brick_column_details, args)
     status = update_status(status, criteria_dict, "Criteria Specified", formats=["-","-"])
-    # Check for combined axis
-    is_xaxis_combined = (xaxis_two_name) and (xaxis_operator)
-    is_yaxis_combined = (yaxis_two_name) and (yaxis_operator)
+    # Setup:  Include Filter, invalid ones are ignored
+    filter_expression = check_expression(filter_expression, expression_col_list, predicate=True)
+    xaxis_expression = check_expression(xaxis_expression, expression_col_list)
+    yaxis_expression = check_expression(yaxis_expression, expression_col_list)
+    # Check for combined axis: combined columns and expressions are not in units of a column
+    full_xaxis_expression = get_axis_expression(xaxis_name, xaxis_operator, xaxis_two_name, xaxis_expression)
+    full_yaxis_expression = get_axis_expression(yaxis_name, yaxis_operator, yaxis_two_name, yaxis_expression)
+    is_xaxis_combined = bool(full_xaxis_expression)
+    is_yaxis_combined = bool(full_yaxis_expression)
+    # Filters on combined axes instead of criteria
+    selection_filters = []
     # Selection Adjustments
     vertices = []
-    if selected_data:
+    # Regions stored server-side replace the box or lasso selected last
+    region_selection = load_region_selection(selection_id, settings['savepath'])
+    if (region_selection is not None) and (not region_selection.is_same_axes(dict(
+            xaxis_name=xaxis_name, yaxis_name=yaxis_name,
+            xaxis_type=xaxis_type, yaxis_type=yaxis_type,
+            xaxis_two_name=xaxis_two_name, xaxis_operator=xaxis_operator,
+            yaxis_two_name=yaxis_two_name, yaxis_operator=yaxis_operator,
+            xaxis_expression=xaxis_expression, yaxis_expression=yaxis_expression))):
+        status = update_status(status, "drawn on other axes", "Regions Ignored", formats=["-","-"])
+        region_selection = None
+    # Bounding box [x_min, x_max, y_min, y_max] of points to find within the scan
+    selection_bounds = None
+    if region_selection is not None:
+        # Option 0: Regions, only added ones can contain selected points
+        selection_bounds = region_selection.get_bounds('add')
+        status = update_status(status, len(region_selection), "Regions Selected", formats=["-","-"])
+    elif selected_data:
         # Option 1: Rectangle
         if ('range' in selected_data.keys()):
             # Step 1.1: Update Criteria
             x_interval = selected_data['range']['x']
             y_interval = selected_data['range']['y']
-            if (xaxis_name in criteria_dict.keys()) and (not is_xaxis_combined):
+            # Only linear axes are in units of the column
+            if (xaxis_name in criteria_dict.keys()) and (not is_xaxis_combined) \
+                    and (xaxis_type == 'Linear'):
                 criteria_dict[xaxis_name] = update_interval(
                     criteria_dict, xaxis_name,
                     np.min(x_interval), np.max(x_interval)
                 )
-            if (yaxis_name in criteria_dict.keys() )and (not is_yaxis_combined):
+            if (yaxis_name in criteria_dict.keys()) and (not is_yaxis_combined) \
+                    and (yaxis_type == 'Linear'):
                 criteria_dict[yaxis_name] = update_interval(
                     criteria_dict, yaxis_name,
                     np.min(y_interval), np.max(y_interval)
                 )
+            # Step 1.2: Filter combined axes within the scan
+            for axis_expression, axis_type, interval in [
+                    (full_xaxis_expression, xaxis_type, x_interval),
+                    (full_yaxis_expression, yaxis_type, y_interval)]:
+                if axis_expression and (axis_type == 'Linear'):
+                    selection_filters.append('({!r} < {} < {!r})'.format(
+                        float(np.min(interval)), axis_expression, float(np.max(interval))
+                    ))
             status = update_status(status, [x_interval, y_interval], "Rectangle Selected", formats=["-","-"])
         # Option 2: Curve
         if 'lassoPoints' in selected_data.keys():
             # Step 2.1: Create array of vertices
             vertices = np.array(list(zip(selected_data['lassoPoints']['x'], selected_data['lassoPoints']['y'])))
-            # Step 2.2: Update Criteria
-            xmin, ymin = vertices.min(0)
-            xmax, ymax = vertices.max(0)
-            if (xaxis_name in criteria_dict.keys()) and (not is_xaxis_combined):
-                criteria_dict[xaxis_name] = update_interval(
-                    criteria_dict, xaxis_name,
-                    xmin, xmax
-                )
-            if (yaxis_name in criteria_dict.keys()) and (not is_yaxis_combined):
-                criteria_dict[yaxis_name] = update_interval(
-                    criteria_dict, yaxis_name,
-                    ymin, ymax
-                )
+            (xmin, ymin), (xmax, ymax) = vertices.min(0), vertices.max(0)
+            selection_bounds = [xmin, xmax, ymin, ymax]
             status = update_status(status, vertices.shape[0], "Lasso Vertices Selected", formats=["-","-"])
+    if selection_bounds is not None:
+        xmin, xmax, ymin, ymax = selection_bounds
+        # Step 2.2: Update Criteria, only linear axes are in units of the column
+        if (xaxis_name in criteria_dict.keys()) and (not is_xaxis_combined) \
+                and (xaxis_type == 'Linear'):
+            criteria_dict[xaxis_name] = update_interval(
+                criteria_dict, xaxis_name,
+                xmin, xmax
+            )
+        if (yaxis_name in criteria_dict.keys()) and (not is_yaxis_combined) \
+                and (yaxis_type == 'Linear'):
+            criteria_dict[yaxis_name] = update_interval(
+                criteria_dict, yaxis_name,
+                ymin, ymax
+            )
+        # Step 2.3: Filter combined axes by bounding box within the scan
+        for axis_expression, axis_type, axis_min, axis_max in [
+                (full_xaxis_expression, xaxis_type, xmin, xmax),
+                (full_yaxis_expression, yaxis_type, ymin, ymax)]:
+            if axis_expression and (axis_type == 'Linear'):
+                selection_filters.append('({!r} <= {} <= {!r})'.format(
+                    float(axis_min), axis_expression, float(axis_max)
+                ))
+        # Step 2.4: Columns of expression axes to find points in the lasso or regions
+        axis_name_list = reduced_axis_list(
+            axis_name_list,
+            *[get_expression_columns(expression)
+              for expression in [xaxis_expression, yaxis_expression] if expression]
+        )
+    # Combine filters
+    filter_expression = ' and '.join(
+        ['({})'.format(filter_expression)]*bool(filter_expression) + selection_filters
+    )
+    status = update_status(status, filter_expression, "Filter", formats=["-","-"])
+    # Check:  Result of plot or earlier download can be reused
+    query_key = get_query_key(bricks_selected, criteria_dict, axis_name_list, predicate=filter_expression)
+    status = update_status(status, query_cache.get_row_count(query_key), "Cached Rows", formats=["-","-"])
     # Pack criteria
-    parameters['vertices'] = vertices
+    parameters['vertices'] = np.asarray(vertices).tolist()  # Full precision, unlike str of an array
+    parameters['selection_id'] = selection_id if region_selection is not None else ''
+    # Rows of the request are stored as bitmap by its first download, see download_selection
+    parameters['bitmap_id'] = get_selection_key(
+        get_query_key(bricks_selected, criteria_dict, [], predicate=filter_expression),
+        {
+            'selection_id': parameters['selection_id'],
+            'vertices': parameters['vertices'],
+            'axes': [
+                xaxis_name, yaxis_name, xaxis_type, yaxis_type,
+                xaxis_two_name, xaxis_operator, yaxis_two_name, yaxis_operator,
+                xaxis_expression, yaxis_expression
+            ] if len(vertices) else [],
+            'derived_columns': derived_columns
+        }
+    )
+    bitmap = load_selection_bitmap(parameters['bitmap_id'], settings['savepath'], settings['folderpath'])
+    if bitmap is not None:
+        status = update_status(status, bitmap.count(), "Selected Rows", formats=["-","-"])
+        status = update_status(status, parameters['bitmap_id'], "Stored Selection", formats=["-","-"])
     parameters['criteria_dict'] = criteria_dict
+    parameters['axis_name_list'] = axis_name_list
+    parameters['filter_expression'] = filter_expression
+    parameters['xaxis_expression'] = xaxis_expression
+    parameters['yaxis_expression'] = yaxis_expression
     # Require confirmation
     if not(n_clicks % 2) and (n_clicks!=1):
         return ["", status, status]
@@ -992,25 +1403,94 @@ def download_selection():
     # Unpack arguments - TODO: use proper decoding
     # Repack to types and nested types
     variables = unpack_vars(request.args.to_dict()) #urllib.parse.parse_qs(str(request.query_string))
-    # 1. Get relevant data based on slice criteria
-    return_data = get_all_data(
-        variables['bricks_selected'],
-        variables['axis_name_list'],
-        variables['criteria_dict'],
-        brick_column_details,
-        brick_data_types,
-        data
+    # Rows stored by an earlier download of the request, or combined (see combine_bitmaps)
+    bitmap = load_selection_bitmap(variables.get('bitmap_id'), settings['savepath'], settings['folderpath'])
+    # Reuse the result of the same request if plotted or downloaded before
+    query_key = get_query_key(
+        variables['bricks_selected'], variables['criteria_dict'], variables['axis_name_list'],
+        predicate=variables['filter_expression']
+    )
+    return_data = query_cache.get(query_key) if bitmap is None else None
+    print("  query cache: {}".format(query_cache.stats()))
+    # Points of the visual selection on the axes as displayed
+    polygon_axes = dict(
+        xaxis_type=variables['xaxis_type'], yaxis_type=variables['yaxis_type'],
+        xaxis_two_name=variables['xaxis_two_name'], xaxis_operator=variables['xaxis_operator'],
+        yaxis_two_name=variables['yaxis_two_name'], yaxis_operator=variables['yaxis_operator'],
+        xaxis_expression=variables['xaxis_expression'],
+        yaxis_expression=variables['yaxis_expression']
     )
-    # 2. Cut to visual selection
-    if len(variables['vertices']):
-        # Reduce data to selection polygon
+    row_filter = None
+    # Regions stored server-side are found in one pass, see RegionSelection
+    region_selection = load_region_selection(variables.get('selection_id'), settings['savepath'])
+    if region_selection is not None:
+        row_filter = region_selection.get_selection
+    elif len(variables['vertices']):
+        def row_filter(brick_rows):
+            return get_selection_in_polygon(
+                brick_rows, variables['vertices'],
+                variables['xaxis_name'], variables['yaxis_name'], **polygon_axes
+            )
+    # 1. Get rows based on slice criteria and visual selection, scanning bricks once and
+    #    storing them, hence downloading again only gathers columns
+    is_scanned = (return_data is None) and (bitmap is None)
+    if is_scanned:
         t1 = dt.now()
-        return_data = get_data_in_selection(
-            variables['xaxis_name'], variables['yaxis_name'], variables['vertices'],
-            return_data, variables['axis_name_list'],
-            xaxis_type=variables['xaxis_type'], yaxis_type=variables['yaxis_two_name'],
-            xaxis_two_name=variables['xaxis_two_name'], xaxis_operator=variables['xaxis_operator'],
-            yaxis_two_name=variables['yaxis_two_name'], yaxis_operator=variables['yaxis_operator']
+        bitmap = get_selection_bitmap(
+            variables['bricks_selected'],
+            variables['criteria_dict'],
+            brick_column_details,
+            data,
+            data_counts,
+            zone_maps=zone_maps,
+            sorted_indices=sorted_indices,
+            spatial_indices=spatial_indices,
+            threads=settings['query_threads'],
+            chunk_rows=settings['query_chunk_rows'],
+            selections=selection_cache,
+            predicate=variables['filter_expression'],
+            row_filter=row_filter
+        )
+        save_selection_bitmap(bitmap, variables.get('bitmap_id'), settings['savepath'], settings['folderpath'],
+                              max_mb=settings['stored_selections_mb'])
+        print("  selection bitmap: {:,} rows, {}".format(bitmap.count(), dt.now()-t1))
+    # 2. Stream chunks of each brick, gathering columns only for rows of the bitmap
+    if settings['query_chunk_rows'] and (return_data is None):
+        data_chunks = iter_all_data(
+            list(bitmap),
+            variables['axis_name_list'],
+            {},
+            brick_column_details,
+            data,
+            chunk_rows=settings['query_chunk_rows'],
+            bitmap=bitmap
+        )
+        return Response(generate_chunks(data_chunks, variables['axis_name_list']),
+                        mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=selected_criteria_data.csv'})
+    # 3. Gather rows of the bitmap
+    if return_data is None:
+        return_data = get_all_data(
+            list(bitmap),
+            variables['axis_name_list'],
+            {},
+            brick_column_details,
+            brick_data_types,
+            data,
+            threads=settings['query_threads'],
+            max_result_mb=settings['max_result_mb'],
+            tmp_path=settings['savepath'],
+            chunk_rows=settings['query_chunk_rows'],
+            bitmap=bitmap
+        )
+        # Only results of the criteria are those of the request
+        if is_scanned and (row_filter is None):
+            query_cache.put(query_key, return_data)
+    # 4. Cut cached result to visual selection
+    elif row_filter is not None:
+        t1 = dt.now()
+        return_data = reduce_cols(
+            return_data, variables['axis_name_list'], selection=row_filter(return_data)
         )
         print("  polygon slicing: {}".format(dt.now()-t1))
     # Inspect sizes:  size(CSV_string) ~ 2.725*size(return_data)
@@ -1032,6 +1512,51 @@ def download_selection():
     return
 
 
+@app.server.route('/dash/bitmap')
+def combine_bitmaps():
+    """ Return json of the rows of stored bitmaps combined by operation, storing the result.
+
+    bitmap_ids -- ids of stored bitmaps, e.g. bitmap_id of download links
+    operation  -- 'and', 'or', 'not' (rows of the first bitmap not in any other, or
+                  all other rows of its bricks if only one), or 'count' (of the first)
+    The combined bitmap is stored by id, hence downloaded by passing it as bitmap_id.
+    """
+    variables = unpack_vars(request.args.to_dict())
+    bitmap_ids = variables.get('bitmap_ids', [])
+    operation = variables.get('operation', 'count')
+    bitmaps = [
+        load_selection_bitmap(bitmap_id, settings['savepath'], settings['folderpath'])
+        for bitmap_id in bitmap_ids
+    ]
+    if (not bitmaps) or any(bitmap is None for bitmap in bitmaps):
+        return jsonify({'error': 'Unknown or outdated bitmap'}), 404
+    bitmap = bitmaps[0]
+    if operation == 'and':
+        for other in bitmaps[1:]:
+            bitmap = bitmap & other
+    elif operation == 'or':
+        for other in bitmaps[1:]:
+            bitmap = bitmap | other
+    elif operation == 'not':
+        if len(bitmaps) == 1:
+            bitmap = ~bitmap
+        for other in bitmaps[1:]:
+            bitmap = bitmap & ~other
+    elif operation != 'count':
+        return jsonify({'error': "Operation must be 'and', 'or', 'not', or 'count'"}), 400
+    bitmap_id = bitmap_ids[0] if operation == 'count' else get_selection_key(
+        operation, {'bitmap_ids': list(bitmap_ids)}
+    )
+    if operation != 'count':
+        save_selection_bitmap(bitmap, bitmap_id, settings['savepath'], settings['folderpath'],
+                              max_mb=settings['stored_selections_mb'])
+    return jsonify({
+        'bitmap_id': bitmap_id,
+        'rows': bitmap.count(),
+        'brick_rows': {brick_name: bitmap.count(brick_name) for brick_name in bitmap}
+    })
+
+
 ####################################################################################
 # Allow Downloading Entire Brick
 ####################################################################################
@@ -1138,7 +1663,7 @@ def update_slice_limits(bricks_selected):
         # Min
         mins = [
             parse_datatype(
-                np.min([
+                np.nanmin([
                     brick_column_details[brick_name][col_name]['min']
                     for brick_name in bricks_selected
                 ])
@@ -1148,7 +1673,7 @@ def update_slice_limits(bricks_selected):
         # Max
         maxs = [
             parse_datatype(
-                np.max([
+                np.nanmax([
                     brick_column_details[brick_name][col_name]['max']
                     for brick_name in bricks_selected
                 ]
@@ -1271,8 +1796,13 @@ update_graph_inputs = [
         Input('xaxis-combined-column', 'value'),
         Input('yaxis-combined-column', 'value'),
         Input('caxis-combined-column', 'value'),
+        Input('xaxis-expression', 'value'),
+        Input('yaxis-expression', 'value'),
+        Input('caxis-expression', 'value'),
+        Input('filter-expression', 'value'),
         Input('display_count_selection', 'value'),
         Input('brick_selector', 'value'),
+        Input('selection-bitmap-id', 'value'),
         *slice_inputs
 ]
 
@@ -1288,7 +1818,8 @@ def update_graph(xaxis_name, yaxis_name, caxis_name, saxis_name,
                  xaxis_type, yaxis_type, caxis_type,
                  xaxis_orientation, yaxis_orientation, caxis_orientation,
                  xaxis_second_column, yaxis_second_column, caxis_second_column,
-                 display_count, bricks_selected, *args):
+                 xaxis_expression, yaxis_expression, caxis_expression, filter_expression,
+                 display_count, bricks_selected, bitmap_id, *args):
     """ Update graph based on new selected variables. """
     #print('args: ', args)
     #print('kwargs: ', kwargs)
@@ -1297,6 +1828,12 @@ def update_graph(xaxis_name, yaxis_name, caxis_name, saxis_name,
     xaxis_operator, yaxis_operator, caxis_operator = args[-3], args[-2], args[-1]
     # Extract Criteria from args
     criteria_dict = args_to_criteria(bricks_selected, slice_col_list, brick_column_details, args[:-3])
+    # Expressions: invalid ones are ignored
+    xaxis_expression = check_expression(xaxis_expression, expression_col_list)
+    yaxis_expression = check_expression(yaxis_expression, expression_col_list)
+    caxis_expression = check_expression(caxis_expression, expression_col_list)
+    filter_expression = check_expression(filter_expression, expression_col_list, predicate=True)
+    axis_expressions = [xaxis_expression, yaxis_expression, caxis_expression]
 
     # Brick selection
     print("  Brick {} selected".format(bricks_selected))
@@ -1320,34 +1857,63 @@ def update_graph(xaxis_name, yaxis_name, caxis_name, saxis_name,
     if has_bricks and has_xaxis and has_yaxis:
         # Adjust for Brick usage: Only use above min, oversample proportionally, etc.
         bricks_selected = get_relevant_bricks(bricks_selected, criteria_dict, brick_column_details, min_usage=0)
+        # Stored selection: only its rows, e.g. of an earlier download (see download_selection)
+        bitmap = load_selection_bitmap(bitmap_id, settings['savepath'], settings['folderpath'])
+        if bitmap is not None:
+            bricks_selected = [brick_name for brick_name in bricks_selected if brick_name in bitmap]
         # Column list
         axis_name_list = reduced_axis_list(
             settings['name_column'],
             xaxis_name, yaxis_name, caxis_name, saxis_name,
-            xaxis_second_column, yaxis_second_column, caxis_second_column
+            xaxis_second_column, yaxis_second_column, caxis_second_column,
+            *[get_expression_columns(expression) for expression in axis_expressions if expression]
         )
         print(axis_name_list)
 
+        # Same rows as before, e.g. only axis type or orientation changed
+        query_key = get_query_key(bricks_selected, criteria_dict, axis_name_list, display_count,
+                                  predicate=filter_expression)
+        if bitmap is not None:
+            query_key = get_selection_key(query_key, {'bitmap_id': bitmap_id})
+        return_data = query_cache.get(query_key)
         # Subsample
-        if display_count:
+        if (return_data is None) and display_count:
             return_data = get_sample_data(
                 bricks_selected, display_count, axis_name_list,
                 criteria_dict, brick_column_details,
                 data,
-                brick_data_types, data_counts, settings)
+                brick_data_types, data_counts, settings,
+                shuffled_data=shuffled_data, predicate=filter_expression, bitmap=bitmap)
+            query_cache.put(query_key, return_data)
         # ALL DATA
-        else:
+        elif return_data is None:
             return_data = get_all_data(
                 bricks_selected,
                 axis_name_list,
                 criteria_dict, brick_column_details, brick_data_types,
-                data)
+                data, zone_maps=zone_maps, sorted_indices=sorted_indices,
+                spatial_indices=spatial_indices, threads=settings['query_threads'],
+                max_result_mb=settings['max_result_mb'], tmp_path=settings['savepath'],
+                chunk_rows=settings['query_chunk_rows'], selections=selection_cache,
+                predicate=filter_expression, bitmap=bitmap)
+            query_cache.put(query_key, return_data)
+        print("  query cache: {}".format(query_cache.stats()))
         # Unpack
         text_name,  text   = get_axis_data(return_data, settings['name_column'])
         xaxis_name, x_data = get_axis_data(return_data, xaxis_name, xaxis_operator, xaxis_second_column)
         yaxis_name, y_data = get_axis_data(return_data, yaxis_name, yaxis_operator, yaxis_second_column)
         caxis_name, c_data = get_axis_data(return_data, caxis_name, caxis_operator, caxis_second_column)
         saxis_name, s_data = get_axis_data(return_data, saxis_name)
+        # Expressions replace their axis, sub-expressions shared by axes evaluated once
+        expression_data = iter(evaluate_expressions(
+            return_data, [expression for expression in axis_expressions if expression]
+        ))
+        if xaxis_expression:
+            xaxis_name, x_data = xaxis_expression, next(expression_data)
+        if yaxis_expression:
+            yaxis_name, y_data = yaxis_expression, next(expression_data)
+        if caxis_expression:
+            caxis_name, c_data = caxis_expression, next(expression_data)
 
         # Create Title
         title = format_two_columns('vs.', xaxis_name, yaxis_name)
@@ -7,7 +7,17 @@ Data selection and processign toolset for FIDS
 from .data_processing import get_column_names, reduced_axis_list, args_to_criteria, update_interval
 # Data
 from .data_selector import get_limits, reduce_cols, slice_data, get_relevant_bricks
-from .data_selector import get_all_data, get_sample_data, get_subsetdata
+from .data_selector import get_all_data, iter_all_data, get_sample_data, get_subsetdata
+from .data_selector import get_selection_bitmap
 from .data_selector import get_axis_data, format_two_columns, adjust_axis_type
+# Expressions
+from .expressions import evaluate_expressions, check_expression, get_axis_expression
+from .expressions import get_expression_columns
+# Query Cache
+from .query_cache import QueryCache, SelectionCache, get_query_key, get_selection_key
 # Polygon 
-from .polygon_selection import get_data_in_polygon, get_data_in_selection
+from .polygon_selection import get_data_in_selection, get_selection_in_polygon
+from .polygon_selection import get_selection_axes
+# Region Selections
+from .region_selection import RegionSelection, get_selected_vertices
+from .region_selection import save_region_selection, load_region_selection
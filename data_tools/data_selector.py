@@ -6,8 +6,19 @@ Convenience functions for selecting data
 import numpy as np
 from datetime import datetime as dt
 import time
-from numba import jit
+import numba
+from numba import jit, prange
 import operator
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from .indexing import plan_brick_rows
+from .expressions import get_predicate_selection
+from io_tools import ColumnView, RowBitmap, SelectionBitmap
+
+# Parallel kernels run in threads of the server and queries: the TBB threading layer
+# hangs at exit once used outside the main thread, OpenMP does not
+numba.config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
 
 
 def get_sample_indices(sample_size, total_size):
@@ -26,64 +37,466 @@ def get_sample_indices(sample_size, total_size):
                     )
     return select_points
 
+
+def get_next_sample_size(sample_size, sample_use, brick_size, max_sample_size=0):
+    """ Return rows to query to find sample_size rows at fraction sample_use.
+
+    Queries 10% more than expected, as falling short costs another attempt.
+    """
+    next_sample_size = int(np.ceil(1.1*sample_size/sample_use))
+    if max_sample_size:
+        next_sample_size = min(next_sample_size, max_sample_size)
+    return max(1, min(next_sample_size, brick_size))
+
+
+def map_bricks(fnc, brick_list, threads=1):
+    """ Return [fnc(brick) for brick in brick_list], on up to threads threads.
+
+    Comparisons and memory mapped reads release the GIL, hence bricks are sliced
+    concurrently. Results keep the order of brick_list, whichever finishes first.
+    A pool per call caps the threads one request can occupy.
+    """
+    if (threads <= 1) or (len(brick_list) <= 1):
+        return [fnc(brick) for brick in brick_list]
+    with ThreadPoolExecutor(max_workers=min(threads, len(brick_list))) as executor:
+        return list(executor.map(fnc, brick_list))
+
+
+def get_random_rows(selected_data, axis_name_list, sample_size):
+    """ Return a random subset of sample_size rows in original order, if more. """
+    row_count = len(selected_data[axis_name_list[0]])
+    if row_count <= sample_size:
+        return selected_data
+    rows = np.sort(np.random.choice(row_count, sample_size, replace=False))
+    return {axis_name: selected_data[axis_name][rows] for axis_name in axis_name_list}
+
+
+def get_sample_window(start, sample_size, brick_size):
+    """ Return row ranges of sample_size consecutive rows from start, wrapping around.
+
+    In a brick stored in shuffled order, any window of rows is a random sample.
+    """
+    stop = start + min(sample_size, brick_size)
+    if stop <= brick_size:
+        return [(start, stop)]
+    return [(start, brick_size), (0, stop-brick_size)]
+
+def get_sample_ranks(sample_size, total_size):
+    """ Return sorted ranks of sample_size distinct rows out of total_size, all if fewer.
+
+    Drawn with replacement and topped up for duplicates, as drawing without
+    replacement permutes all of total_size.
+    """
+    if sample_size >= total_size:
+        return np.arange(total_size)
+    if 2*sample_size >= total_size:
+        return np.sort(np.random.choice(total_size, sample_size, replace=False))
+    ranks = np.unique(get_sample_indices(sample_size, total_size))
+    while ranks.shape[0] < sample_size:
+        ranks = np.unique(np.concatenate([
+            ranks, get_sample_indices(sample_size-ranks.shape[0], total_size)
+        ]))
+    return ranks
+
+
+def get_bitmap_sample(brick_data, row_bitmap, axis_name_list, sample_size, criteria_dict={},
+                      predicate=''):
+    """ Return sample_size random rows of row_bitmap within criteria, fewer if not as many.
+
+    Rows are looked up by rank in the runs of the bitmap, hence only sampled rows are read.
+    """
+    rows = row_bitmap.get_rows(get_sample_ranks(sample_size, row_bitmap.count()))
+    if criteria_dict or predicate:
+        rows = rows[get_selection(ColumnView(brick_data, rows), criteria_dict, predicate=predicate)]
+    return {axis_name: brick_data[axis_name][rows] for axis_name in axis_name_list}
+
 ####################################################################################
 #   Getting Data
 ####################################################################################
 
 def get_all_data(bricks_selected, axis_name_list, criteria_dict,
-                 brick_column_details, brick_data_types, data):
+                 brick_column_details, brick_data_types, data, zone_maps={},
+                 sorted_indices={}, spatial_indices={}, threads=1,
+                 max_result_mb=0, tmp_path=None, chunk_rows=0, selections=None,
+                 predicate='', row_filter=None, bitmap=None):
     """ Return all data in bricks which conform by criteria.
 
-    Iteratively appends data from bricks (Creating copies for each Brick)
-    - No known length, hence iteratively construct
-    - NumPy arrays are fixed-size, hence over-allocation & reduction creates copies too
-
-    TODO:
-    - Test memory & CPU for:  np.append vs. np.concat
+    Two passes over bricks, each on up to threads threads:
+    1. Count: rows within criteria of each brick (row numbers, not data)
+    2. Fill: each brick gathers its rows straight into its slice of arrays of the
+       exact final length, hence the result is copied once and never grown.
+    Results beyond max_result_mb (0 for no limit) are memory mapped temporary files
+    in tmp_path instead of held in memory.
+    With chunk_rows, bricks are checked and gathered in windows of chunk_rows, hence
+    memory is bounded by one window plus the result instead of the largest brick.
+    - With zone_maps, only blocks of rows overlapping the criteria are sliced, hence
+      range queries on sorted columns (e.g. RA, DEC) cost in proportion to the result
+    - With sorted_indices, the most selective indexed criterion resolves to rows by
+      binary search, and only those rows are checked for the other criteria
+    - With spatial_indices, criteria on e.g. RA, DEC only check rows of grid cells
+      intersecting the box
+    - With selections (SelectionCache), narrower criteria than before only check the
+      rows selected before, and rows selected now are kept for the next request
+    predicate is an expression filter (see expressions) checked within the scan, only
+    on rows within criteria.
+    row_filter is a function further reducing rows within criteria, see filter_brick_rows,
+    hence columns are only gathered for rows passing it (e.g. points in a lasso).
+    bitmap (SelectionBitmap) restricts rows to its rows, instead of zone maps and indices,
+    e.g. to gather the rows of a selection stored before without scanning bricks.
     """
     # 0. Adjust for Brick usage: Only query bricks with data in criteria
     bricks_selected = get_relevant_bricks(bricks_selected, criteria_dict, brick_column_details, min_usage=0)
-    # 1. Setup with appropriate types: No length known to fall under criteria
-    return_data = {
-        axis_name: np.array([], dtype=brick_data_types[axis_name])
+    if bitmap is not None:
+        bricks_selected = [brick_name for brick_name in bricks_selected if brick_name in bitmap]
+    # 1. Get rows within criteria for each brick individually, bricks in parallel
+    def get_rows(brick_name):
+        return get_brick_rows(
+            brick_name, criteria_dict, brick_column_details, data,
+            zone_maps=zone_maps, sorted_indices=sorted_indices, spatial_indices=spatial_indices,
+            chunk_rows=chunk_rows, selections=selections, predicate=predicate,
+            row_filter=row_filter, bitmap=bitmap
+        )
+    brick_rows = map_bricks(get_rows, bricks_selected, threads=threads)
+    # 2. Allocate exact size
+    offsets = np.cumsum([0] + [rows.shape[0] for rows in brick_rows])
+    return_data = allocate_result(axis_name_list, brick_data_types, int(offsets[-1]),
+                                  max_result_mb=max_result_mb, tmp_path=tmp_path)
+    # 3. Assign in order of bricks, bricks in parallel into separate slices
+    def fill_brick(ix):
+        brick_data = data[bricks_selected[ix]].data
+        rows = brick_rows[ix]
+        step = chunk_rows if chunk_rows else max(1, rows.shape[0])
+        for start in range(0, rows.shape[0], step):
+            chunk = rows[start:start+step]
+            for axis_name in axis_name_list:
+                return_data[axis_name][offsets[ix]+start:offsets[ix]+start+chunk.shape[0]] = \
+                    brick_data[axis_name][chunk]
+    t1 = dt.now()
+    map_bricks(fill_brick, list(range(len(bricks_selected))), threads=threads)
+    print("  assign: {}".format(dt.now()-t1))
+    print("  data points: {:,}".format(offsets[-1]))
+    return return_data
+
+
+def get_brick_rows(brick_name, criteria_dict, brick_column_details, data, zone_maps={},
+                   sorted_indices={}, spatial_indices={}, chunk_rows=0, selections=None,
+                   predicate='', row_filter=None, bitmap=None):
+    """ Return rows of brick within criteria, see get_all_data.
+
+    The brick is looked up in data once, its table is passed along, hence it stays
+    valid while other threads open and evict bricks of the pool.
+    """
+    # 1.1 Slicing data once reads it once, making it faster than using index
+    t1 = dt.now()
+    brick_table = data[brick_name]
+    brick_data = brick_table.data  # Pass immutable for reference to limit copies
+    fractions, row_count, row_ranges, row_ids, resolved_col_name = plan_brick(
+        brick_name, criteria_dict, brick_column_details, brick_table.header['NAXIS2'],
+        zone_maps=zone_maps, sorted_indices=sorted_indices,
+        spatial_indices=spatial_indices, selections=selections, predicate=predicate,
+        bitmap=bitmap
+    )
+    # 1.2 Get Rows
+    rows = select_brick_rows(
+        brick_data,
+        fractions, row_count,
+        row_ranges=row_ranges, row_ids=row_ids, resolved_col_name=resolved_col_name,
+        chunk_rows=chunk_rows, predicate=predicate
+    )
+    if (selections is not None) and (bitmap is None):
+        selections.put(brick_name, criteria_dict, rows, predicate=predicate)
+    # 1.3 Reduce Rows, after keeping those within criteria
+    if row_filter is not None:
+        rows = filter_brick_rows(brick_data, rows, row_filter, chunk_rows=chunk_rows)
+    print("  slice data {}: {}".format(brick_name, dt.now()-t1))
+    return rows
+
+
+def get_selection_bitmap(bricks_selected, criteria_dict, brick_column_details, data, data_counts,
+                         zone_maps={}, sorted_indices={}, spatial_indices={}, threads=1,
+                         chunk_rows=0, selections=None, predicate='', row_filter=None):
+    """ Return SelectionBitmap of rows in bricks which conform by criteria.
+
+    Bricks are scanned as by get_all_data, but only row numbers are kept, hence the
+    selection can be stored, combined, counted, and gathered later without scanning.
+    Bricks without rows within criteria are included as empty, hence ~ covers them.
+    """
+    relevant_bricks = get_relevant_bricks(bricks_selected, criteria_dict, brick_column_details, min_usage=0)
+    def get_bitmap(brick_name):
+        if brick_name not in relevant_bricks:
+            return RowBitmap(np.empty((0, 2)), data_counts[brick_name])
+        return RowBitmap.from_rows(get_brick_rows(
+            brick_name, criteria_dict, brick_column_details, data,
+            zone_maps=zone_maps, sorted_indices=sorted_indices, spatial_indices=spatial_indices,
+            chunk_rows=chunk_rows, selections=selections, predicate=predicate,
+            row_filter=row_filter
+        ), data_counts[brick_name])
+    return SelectionBitmap(zip(bricks_selected, map_bricks(get_bitmap, bricks_selected, threads=threads)))
+
+
+def iter_all_data(bricks_selected, axis_name_list, criteria_dict, brick_column_details,
+                  data, zone_maps={}, sorted_indices={}, spatial_indices={},
+                  chunk_rows=1048576, chunk_filter=None, selections=None, predicate='',
+                  row_filter=None, bitmap=None):
+    """ Yield data in bricks which conform by criteria, in chunks of at most chunk_rows.
+
+    Walks each brick in windows of chunk_rows, hence memory is bounded by one window
+    instead of the brick or the result, e.g. to stream downloads.
+    chunk_filter -- optional function reducing each chunk {axis_name: array}, e.g. to
+                    points in a polygon, applied before yielding
+    Empty chunks are not yielded.
+    See get_all_data for selections, predicate, bitmap, and row_filter, which unlike
+    chunk_filter is applied before the columns of a chunk are gathered.
+    """
+    bricks_selected = get_relevant_bricks(bricks_selected, criteria_dict, brick_column_details, min_usage=0)
+    if bitmap is not None:
+        bricks_selected = [brick_name for brick_name in bricks_selected if brick_name in bitmap]
+    for brick_name in bricks_selected:
+        brick_table = data[brick_name]
+        fractions, row_count, row_ranges, row_ids, resolved_col_name = plan_brick(
+            brick_name, criteria_dict, brick_column_details, brick_table.header['NAXIS2'],
+            zone_maps=zone_maps, sorted_indices=sorted_indices,
+            spatial_indices=spatial_indices, selections=selections, predicate=predicate,
+            bitmap=bitmap
+        )
+        brick_data = brick_table.data
+        brick_rows = []
+        # Windows of planned rows
+        if row_ids is not None:
+            windows = [
+                {'row_ids': row_ids[start:start+chunk_rows]}
+                for start in range(0, row_ids.shape[0], chunk_rows)
+            ]
+        else:
+            windows = [
+                {'row_ranges': [window]}
+                for window in split_ranges([(0, row_count)] if row_ranges is None else row_ranges, chunk_rows)
+            ]
+        for window in windows:
+            rows = select_brick_rows(brick_data, fractions, row_count,
+                                     resolved_col_name=resolved_col_name, predicate=predicate,
+                                     **window)
+            brick_rows.append(rows)
+            if row_filter is not None:
+                rows = filter_brick_rows(brick_data, rows, row_filter)
+            if not rows.shape[0]:
+                continue
+            chunk = {
+                axis_name: brick_data[axis_name][rows]
+                for axis_name in axis_name_list
+            }
+            if chunk_filter is not None:
+                chunk = chunk_filter(chunk)
+                if not chunk[axis_name_list[0]].shape[0]:
+                    continue
+            yield chunk
+        if (selections is not None) and (bitmap is None):
+            selections.put(brick_name, criteria_dict, np.concatenate(
+                [np.array([], dtype=np.int64)] + brick_rows
+            ), predicate=predicate)
+
+
+def plan_brick(brick_name, criteria_dict, brick_column_details, row_count, zone_maps={},
+               sorted_indices={}, spatial_indices={}, selections=None, predicate='',
+               bitmap=None):
+    """ Return (fractions, row_count, row_ranges, row_ids, resolved_col_name) of brick of row_count rows.
+
+    fractions   -- [(col_name, limits), ...] ordered by smallest fraction first to
+                   reduce Trues
+    See plan_brick_rows for row_ranges, row_ids, and resolved_col_name
+    With selections, rows selected by wider criteria before compete with the indices.
+    With bitmap (SelectionBitmap), only its rows of the brick are planned.
+    """
+    col_usage = get_brick_col_usage(brick_name, criteria_dict, brick_column_details)
+    fractions = sorted(col_usage.items(), key=operator.itemgetter(1))
+    fractions = [(col_name, criteria_dict[col_name]) for col_name, frac in fractions]
+    # Rows of a stored selection
+    if bitmap is not None:
+        row_ids = bitmap[brick_name].to_rows() if brick_name in bitmap else np.array([], dtype=np.int64)
+        return fractions, row_count, None, row_ids, None
+    # Narrow down rows by zone maps or indices
+    previous_rows = None
+    if (selections is not None) and criteria_dict:
+        previous_rows = selections.get_rows(brick_name, criteria_dict, predicate=predicate)
+    row_ranges, row_ids, resolved_col_name = plan_brick_rows(
+        brick_name, criteria_dict, col_usage, row_count,
+        zone_maps=zone_maps, sorted_indices=sorted_indices,
+        spatial_indices=spatial_indices, previous_rows=previous_rows
+    )
+    return fractions, row_count, row_ranges, row_ids, resolved_col_name
+
+
+def filter_brick_rows(brick_data, rows, row_filter, chunk_rows=0):
+    """ Return rows of brick for which row_filter is True, chunk_rows at a time (0 for all).
+
+    row_filter -- function returning a boolean array for the rows of a ColumnView,
+                  hence only the columns it reads are gathered
+    """
+    step = chunk_rows if chunk_rows else max(1, rows.shape[0])
+    return np.concatenate(
+        [np.array([], dtype=np.int64)]
+        + [
+            rows[start:start+step][row_filter(ColumnView(brick_data, rows[start:start+step]))]
+            for start in range(0, rows.shape[0], step)
+        ]
+    )
+
+
+def split_ranges(row_ranges, chunk_rows):
+    """ Return row ranges split into windows of at most chunk_rows (0 for no split). """
+    if not chunk_rows:
+        return row_ranges
+    return [
+        (window_start, min(window_start+chunk_rows, stop))
+        for start, stop in row_ranges
+        for window_start in range(start, stop, chunk_rows)
+    ]
+
+
+def allocate_result(axis_name_list, brick_data_types, row_count, max_result_mb=0, tmp_path=None):
+    """ Return {axis_name: empty array of row_count}, memory mapped beyond max_result_mb.
+
+    Memory mapped arrays are backed by unnamed temporary files in tmp_path, hence
+    their disk space is released with the last reference to the array.
+    """
+    result_mb = row_count*sum(
+        np.dtype(brick_data_types[axis_name]).itemsize for axis_name in axis_name_list
+    )/1024/1024
+    if (not max_result_mb) or (result_mb <= max_result_mb):
+        return {
+            axis_name: np.empty(row_count, dtype=brick_data_types[axis_name])
+            for axis_name in axis_name_list
+        }
+    print("  result of {:,.0f} mb memory mapped".format(result_mb))
+    return {
+        axis_name: np.memmap(
+            tempfile.TemporaryFile(dir=tmp_path), mode='w+',
+            dtype=brick_data_types[axis_name], shape=(row_count,)
+        )
         for axis_name in axis_name_list
     }
-    current_length = 0
-    # 2. Get Data for each brick individually
-    for brick_name in bricks_selected:
-        # 2.1 Slicing data once reads it once, making it faster than using index
-        t1 = dt.now()
-        # Order by smallest fraction first to reduce Trues
-        fractions = get_brick_col_usage(brick_name, criteria_dict, brick_column_details)
-        fractions = sorted(fractions.items(), key=operator.itemgetter(1))
-        fractions = ((col_name, criteria_dict[col_name]) for col_name, frac in fractions)
-        # 2.2 Get Data
-        selected_data = slice_data(
-                data[brick_name].data,  # Pass immutable for reference to limit copies
-                criteria_dict,
-                axis_name_list,
-                ordered=fractions
+
+
+def select_brick_rows(brick_data, fractions, row_count, row_ranges=None, row_ids=None,
+                      resolved_col_name=None, chunk_rows=0, predicate=''):
+    """ Return rows of one brick within the ordered criteria, only looking at planned rows.
+
+    See plan_brick_rows for row_ranges, row_ids, and resolved_col_name
+    Checks windows of at most chunk_rows at a time (0 for all planned rows at once).
+    predicate -- expression filter (see expressions) checked within each window
+    """
+    # Index: check only planned rows of only the columns needed
+    if row_ids is not None:
+        print("  index: {:,} rows{}".format(
+            row_ids.shape[0], " by {}".format(resolved_col_name) if resolved_col_name else ""))
+        remaining = [
+            (col_name, limits) for col_name, limits in fractions
+            if col_name != resolved_col_name
+        ]
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        if (not remaining) and (not predicate):
+            return row_ids
+        step = chunk_rows if chunk_rows else max(1, row_ids.shape[0])
+        return np.concatenate(
+            [np.array([], dtype=np.int64)]
+            + [
+                row_ids[start:start+step][get_selection(
+                    ColumnView(brick_data, row_ids[start:start+step]),
+                    dict(remaining),
+                    ordered=remaining,
+                    predicate=predicate
+                )]
+                for start in range(0, row_ids.shape[0], step)
+            ]
         )
-        print("  slice data: {}".format(dt.now()-t1))
-        # 2.3. Assign
-        t1 = dt.now()
-        for axis_name in axis_name_list:
-            return_data[axis_name] = np.append(
-                return_data[axis_name],
-                selected_data[axis_name]
-            )
-        # 4. Wrap up
-        sample_size = selected_data[axis_name_list[0]].shape[0]
-        current_length += sample_size
-    print("  data points: {:,}".format(current_length))
-    return return_data
+    # Full brick or zone map: consecutive ranges
+    if row_ranges is None:
+        row_ranges = [(0, row_count)]
+    else:
+        print("  ranges: {:,} rows in {} ranges".format(
+            sum(stop-start for start, stop in row_ranges), len(row_ranges)))
+    if (not fractions) and (not predicate):
+        return np.concatenate(
+            [np.array([], dtype=np.int64)]
+            + [np.arange(start, stop) for start, stop in row_ranges]
+        )
+    row_ranges = split_ranges(row_ranges, chunk_rows)
+    return np.concatenate(
+        [np.array([], dtype=np.int64)]
+        + [
+            start + np.flatnonzero(get_selection(
+                brick_data[start:stop],  # Slice is a view, not a copy
+                dict(fractions),
+                ordered=fractions,
+                predicate=predicate
+            ))
+            for start, stop in row_ranges
+        ]
+    )
+
+
+def slice_brick(brick_data, criteria_dict, axis_name_list, fractions, brick_data_types,
+                row_ranges=None, row_ids=None, resolved_col_name=None, predicate=''):
+    """ Return sliced data of one brick, only looking at the planned rows.
+
+    See plan_brick_rows for row_ranges, row_ids, and resolved_col_name
+    """
+    # Index: gather only planned rows of only the columns needed
+    if row_ids is not None:
+        print("  index: {:,} rows{}".format(
+            row_ids.shape[0], " by {}".format(resolved_col_name) if resolved_col_name else ""))
+        remaining = [
+            (col_name, limits) for col_name, limits in fractions
+            if col_name != resolved_col_name
+        ]
+        return slice_data(
+            ColumnView(brick_data, row_ids),
+            dict(remaining),
+            axis_name_list,
+            ordered=remaining,
+            predicate=predicate
+        )
+    # Full brick
+    if row_ranges is None:
+        return slice_data(brick_data, criteria_dict, axis_name_list, ordered=fractions,
+                          predicate=predicate)
+    # Zone map or sample window: consecutive ranges
+    print("  ranges: {:,} rows in {} ranges".format(
+        sum(stop-start for start, stop in row_ranges), len(row_ranges)))
+    selected_parts = [
+        slice_data(
+            brick_data[start:stop],  # Slice is a view, not a copy
+            criteria_dict,
+            axis_name_list,
+            ordered=fractions,
+            predicate=predicate
+        )
+        for start, stop in row_ranges
+    ]
+    return {
+        axis_name: np.concatenate(
+            [np.array([], dtype=brick_data_types[axis_name])]
+            + [selected_part[axis_name] for selected_part in selected_parts]
+        )
+        for axis_name in axis_name_list
+    }
 
 
 def get_sample_data(bricks_selected, display_count, axis_name_list, criteria_dict,
-                    brick_column_details, data, brick_data_types, data_counts, settings):
+                    brick_column_details, data, brick_data_types, data_counts, settings,
+                    shuffled_data={}, predicate='', bitmap=None):
     """ Return subsample of data within brick.
 
     Pre-allocate memory, slice, and insert.
+    Points are allocated proportionally to the rows expected within criteria
+    (data_counts * brick usage), and points a brick falls short of are
+    redistributed over the other bricks, hence no brick is over-represented.
+    Bricks are sampled on up to settings['query_threads'] threads.
+    Bricks in shuffled_data (stored in random row order) are sampled by reading
+    consecutive rows instead of gathering random rows.
+    predicate is an expression filter (see expressions) checked like criteria.
+    With bitmap (SelectionBitmap), only its rows are sampled, allocated by its exact
+    row counts and drawn by rank (see get_bitmap_sample) instead of by attempts.
     """
     print("  resampling with {} points".format(display_count))
     # 0. Allocate memory
@@ -94,57 +507,104 @@ def get_sample_data(bricks_selected, display_count, axis_name_list, criteria_dic
     }
     print("  memory allocation: {}".format(dt.now()-t1))
     # 1. Adjust for Brick usage: Only use above min, oversample proportionally, etc.
-    brick_usage = get_all_bricks_usage(bricks_selected, criteria_dict, brick_column_details)
-    bricks_selected = [
-        brick for brick in bricks_selected
-        if brick_usage[brick] > settings['min_brick_usage']
-    ]
-    brick_count = len(bricks_selected)  # Number of bricks
-    current_length = 0
-    # 2. Get Data for each Brick
-    t1 = dt.now()
-    for ix, brick_i in enumerate(bricks_selected):
-        # 2.1 Sample Size
-        sample_size = round(display_count/brick_count)
-        # 2.2 Fix uneven split by rounding, then fill remainder: introduces a skew in data
-        if ix == brick_count-1 and brick_count%2 == 1:
-            sample_size = int(display_count-current_length)
-            print("  adjustment done: {}".format(sample_size))
-        # 2.3 Slice Data
+    if bitmap is not None:
+        bricks_selected = [brick for brick in bricks_selected if bitmap.count(brick)]
+        brick_weights = {brick: bitmap.count(brick) for brick in bricks_selected}
+    else:
+        brick_usage = get_all_bricks_usage(bricks_selected, criteria_dict, brick_column_details)
+        bricks_selected = [
+            brick for brick in bricks_selected
+            if brick_usage[brick] > settings['min_brick_usage']
+        ]
+        brick_weights = {
+            brick: data_counts[brick]*brick_usage[brick]
+            for brick in bricks_selected
+        }
+    # 2. Get Data for each Brick, bricks in parallel:  in rounds, as points of bricks
+    #    falling short are split over bricks which filled their allocation
+    def get_brick_sample(brick_i):
+        t1 = dt.now()
+        if bitmap is not None:
+            # Rows of the bitmap are those of the bricks, not of their shuffled copies
+            selected_data = get_bitmap_sample(
+                data[brick_i].data, bitmap[brick_i], axis_name_list, allocation[brick_i],
+                criteria_dict=criteria_dict, predicate=predicate)
+            print("  slice data {}: {}".format(brick_i, dt.now()-t1))
+            return selected_data
+        is_shuffled = brick_i in shuffled_data
+        # Looked up once, see get_brick_rows
+        brick_table = shuffled_data[brick_i] if is_shuffled else data[brick_i]
         selected_data = get_subsetdata(
-                data[brick_i],  # do NOT add ".data" as it will create a copy
+                # do NOT add ".data" as it will create a copy
+                brick_table,
                 axis_name_list,
-                sample_size=sample_size,
+                sample_size=allocation[brick_i],
                 brick_size=data_counts[brick_i],
                 criteria_dict=criteria_dict,
                 brick_use=brick_usage[brick_i],
                 max_fill_attempts=settings['max_fill_attempts'],
-                brick_data_types=brick_data_types)
-        print("  slice data: {}".format(dt.now()-t1))
-        data_size = min(
-            sample_size-current_length,
-            min(sample_size, selected_data[axis_name_list[0]].shape[0])
+                brick_data_types=brick_data_types,
+                is_shuffled=is_shuffled,
+                max_sample_size=settings['max_sample_size'],
+                predicate=predicate)
+        print("  slice data {}: {}".format(brick_i, dt.now()-t1))
+        return selected_data
+    brick_parts = {brick: [] for brick in bricks_selected}
+    open_bricks = list(bricks_selected)
+    current_length = 0
+    while open_bricks and (current_length < display_count):
+        # 2.1 Sample Size: Split remainder over bricks not yet exhausted
+        allocation = get_sample_allocation(
+            {brick: brick_weights[brick] for brick in open_bricks},
+            display_count-current_length
         )
-        # 2.4 Assign Data
-        for axis_name in axis_name_list:
-            try:
-                return_data[axis_name][current_length:current_length+data_size] = selected_data[axis_name][0:data_size]
-            except Exception as e:
-                print("  could not assign, appending. {}".format(e))
-                return_data[axis_name] = np.append(return_data[axis_name], selected_data[axis_name])
-        print("  assign {}:  {}".format(brick_i, dt.now()-t1))
-        current_length += data_size
-        t1 = dt.now()
-    # 3. Cut Data
+        round_bricks = [brick for brick in open_bricks if allocation[brick]]
+        # 2.2 Slice Data
+        round_parts = map_bricks(get_brick_sample, round_bricks, threads=settings['query_threads'])
+        # Bricks without points this round (rounded down) are not exhausted either
+        open_bricks = [brick for brick in open_bricks if not allocation[brick]]
+        for brick_i, selected_data in zip(round_bricks, round_parts):
+            data_size = min(allocation[brick_i], selected_data[axis_name_list[0]].shape[0])
+            brick_parts[brick_i].append({
+                axis_name: selected_data[axis_name][0:data_size]
+                for axis_name in axis_name_list
+            })
+            current_length += data_size
+            if data_size < allocation[brick_i]:
+                print("  {} short by {:,}, redistributing".format(brick_i, allocation[brick_i]-data_size))
+            else:
+                open_bricks.append(brick_i)
+    # 3. Assign Data in order of bricks
+    t1 = dt.now()
+    current_length = 0
+    for brick_i in bricks_selected:
+        for selected_data in brick_parts[brick_i]:
+            data_size = selected_data[axis_name_list[0]].shape[0]
+            for axis_name in axis_name_list:
+                return_data[axis_name][current_length:current_length+data_size] = selected_data[axis_name]
+            current_length += data_size
+    print("  assign: {}".format(dt.now()-t1))
+    # 4. Cut Data
     for axis_name in axis_name_list:
         return_data[axis_name] = return_data[axis_name][0:current_length]
     return return_data
 
 
-def get_subsetdata(brick_data, axis_name_list, sample_size=0, brick_size=0, criteria_dict={}, brick_use=1, max_fill_attempts=1, brick_data_types={}):
+def get_subsetdata(brick_data, axis_name_list, sample_size=0, brick_size=0, criteria_dict={}, brick_use=1, max_fill_attempts=1, brick_data_types={},
+                   is_shuffled=False, max_sample_size=0, predicate=''):
     """
     Return exact axis subset.
 
+    predicate is an expression filter (see expressions) checked like criteria.
+
+    With criteria, each attempt queries enough rows to fill the remainder at the
+    fraction of rows found within criteria so far (starting from brick_use), but
+    at most max_sample_size rows (0 for no limit) to bound memory.
+
+    If is_shuffled, brick_data is stored in random row order, hence a sample is a
+    window of consecutive rows at a random offset (sequential reads), and further
+    fill attempts continue after it without repeating rows.
+
     TODO:
         Speed comparisons
         Implement Dask
@@ -184,61 +644,89 @@ def get_subsetdata(brick_data, axis_name_list, sample_size=0, brick_size=0, crit
     sufficient_data = False
     current_length = 0
     slice_count = 0
+    window_start = np.random.randint(brick_size) if brick_size else 0
     # A) Criteria Based Slicing
-    if criteria_dict:
+    if criteria_dict or predicate:
         # 1. Pre-Allocate Memory
         selected_data = {
             axis_name: np.empty(sample_size, dtype=brick_data_types[axis_name])
             for axis_name in axis_name_list
         }
         # 2. Oversample by 1/brick_use.  e.g. 5% brick_use: (1/0.05 = 20)*sample_size
-        next_sample_size = int(round(sample_size/brick_use))
+        next_sample_size = get_next_sample_size(sample_size, brick_use, brick_size, max_sample_size)
+        rows_queried = 0
+        rows_found = 0
         # 3. Ensure enough data
         while not sufficient_data:
-            # 3.1 Get random sample
-            select_points = get_sample_indices(next_sample_size, brick_size)
-            # 3.2 Get Data
-            new_data = slice_data(
-                brick_data.data[select_points],
-                criteria_dict,
-                axis_name_list)
-            data_size = min(sample_size-current_length, min(sample_size, len(new_data[axis_name_list[0]])))
+            # 3.1 Get random sample & 3.2 Get Data
+            if is_shuffled:
+                new_data = slice_brick(
+                    brick_data.data, criteria_dict, axis_name_list, [], brick_data_types,
+                    row_ranges=get_sample_window(window_start, next_sample_size, brick_size),
+                    predicate=predicate
+                )
+                window_start = (window_start + next_sample_size) % brick_size
+            elif next_sample_size >= brick_size:
+                # Random rows cover the brick anyway:  scan it once, keep a random subset
+                new_data = slice_data(brick_data.data, criteria_dict, axis_name_list,
+                                      predicate=predicate)
+                new_data = get_random_rows(new_data, axis_name_list, sample_size-current_length)
+            else:
+                select_points = get_sample_indices(next_sample_size, brick_size)
+                new_data = slice_data(
+                    brick_data.data[select_points],
+                    criteria_dict,
+                    axis_name_list,
+                    predicate=predicate)
+            found_size = len(new_data[axis_name_list[0]])
+            data_size = min(sample_size-current_length, found_size)
             print("  new slice (got/wanted/queried): {:,}/{:,}/{:,}".format(
-                len(new_data[axis_name_list[0]]),
-                sample_size,
-                int(round(sample_size/brick_use))))
+                found_size,
+                sample_size-current_length,
+                next_sample_size))
             # 3.3 Assign data
             for axis_name in axis_name_list:
                 selected_data[axis_name][current_length:current_length+data_size] = new_data[axis_name][0:data_size]
             current_length += data_size
+            rows_queried += next_sample_size
+            rows_found += found_size
             slice_count += 1
             # 3.4 Check for sufficienct
             if current_length >= sample_size:
                 sufficient_data = True
-            # TODO: Better handling for this
-            # 3.5 Limit Cycles
-            if slice_count > max_fill_attempts:
+            # 3.5 Limit Cycles, and a brick is exhausted once read entirely
+            if (slice_count >= max_fill_attempts) \
+                    or (is_shuffled and (rows_queried >= brick_size)) \
+                    or ((not is_shuffled) and (next_sample_size >= brick_size)):
                 sufficient_data = True
-                # Cut to how much data we got
-                for axis_name in axis_name_list:
-                    selected_data[axis_name] = selected_data[axis_name][0:current_length]
-            # 3.6 Adjust next Iteration
-            # Vaguely analogous to iteratively approaching distribution
-            # TODO: Set maximum number of sample to be used for memory usage
-            #if not sufficient_data:
-            #    sample_use = data_size/next_sample_size  # Fraction received
-            #    # Oversample by fraction received previously
-            #    next_sample_size = np.min([
-            #        int(round(sample_size/sample_use)),
-            #        brick_size,
-            #        settings['max_sample_size']
-            #    ])
+            # 3.6 Adjust next Iteration:  Oversample by fraction received so far
+            if not sufficient_data:
+                if rows_found:
+                    sample_use = rows_found/rows_queried
+                else:
+                    # Nothing found:  at most one hit in the rows queried
+                    sample_use = min(brick_use, 1/rows_queried)
+                next_sample_size = get_next_sample_size(
+                    sample_size-current_length, sample_use,
+                    brick_size-rows_queried if is_shuffled else brick_size,
+                    max_sample_size
+                )
+        # Cut to how much data we got
+        for axis_name in axis_name_list:
+            selected_data[axis_name] = selected_data[axis_name][0:current_length]
+        print("  sampling: {} attempts, {:,} rows read, {:,} wasted".format(
+            slice_count, rows_queried, rows_queried-current_length))
     # B) Simple
     else:
-        # 2. Sample
-        select_points = get_sample_indices(sample_size, brick_size)
-        # 3. Get & Assign data
-        selected_data = reduce_cols(brick_data.data[select_points], axis_name_list)
+        # 2. Sample & 3. Get & Assign data
+        if is_shuffled:
+            selected_data = slice_brick(
+                brick_data.data, criteria_dict, axis_name_list, [], brick_data_types,
+                row_ranges=get_sample_window(window_start, sample_size, brick_size)
+            )
+        else:
+            select_points = get_sample_indices(sample_size, brick_size)
+            selected_data = reduce_cols(brick_data.data[select_points], axis_name_list)
     # Return data
     return selected_data
 
@@ -335,10 +823,10 @@ def get_limits(bricks_selected, limit_dict, brick_column_details):
     if limit_dict:
         brick_limits = {
             col_name:[
-                np.min([brick_column_details[brick][col_name]['min']
-                        for brick in bricks_selected]),
-                np.max([brick_column_details[brick][col_name]['max']
-                        for brick in bricks_selected])
+                np.nanmin([brick_column_details[brick][col_name]['min']
+                           for brick in bricks_selected]),
+                np.nanmax([brick_column_details[brick][col_name]['max']
+                           for brick in bricks_selected])
             ]
             for col_name in limit_dict.keys()
         }
@@ -358,60 +846,86 @@ def get_limits(bricks_selected, limit_dict, brick_column_details):
     return lim_dict
 
 
+def get_col_usage(col_details, limits):
+    """ Return estimated fraction of a column within limits.
+
+    With quantiles (edges of an equi-depth histogram, each bin holding an equal
+    fraction of values) sum the bins within limits, linearly interpolating partially
+    covered bins. Without, assume a uniform distribution within [min, max], which is
+    far off for skewed columns (e.g. chi2min, fluxes), by orders of magnitude.
+    """
+    col_min = col_details['min']
+    col_max = col_details['max']
+    # Columns without finite values (NaN limits) have no rows within any limits
+    if np.isnan(col_min):
+        return 0.0
+    if col_max <= col_min:
+        return float((limits[0] <= col_min) and (col_max <= limits[1]))
+    if 'quantiles' in col_details:
+        edges = np.asarray(col_details['quantiles'], dtype=np.float64)
+        widths = edges[1:] - edges[:-1]
+        overlap = np.clip(
+            np.minimum(edges[1:], limits[1]) - np.maximum(edges[:-1], limits[0]),
+            0, None
+        )
+        # Zero-width bins are point masses (e.g. repeated integer values)
+        covered = np.where(
+            widths > 0,
+            overlap/np.where(widths > 0, widths, 1),
+            (edges[:-1] >= limits[0]) & (edges[:-1] <= limits[1])
+        )
+        return float(covered.mean())
+    # Intersection Size = max(0, min(maxes) - max(mins))
+    intersection_size = max(min(col_max, limits[1]) - max(col_min, limits[0]), 0)
+    return intersection_size/(col_max - col_min)
+
+
 def get_brick_col_usage(brick, limit_dict, brick_column_details):
     """ Return dict of usage of columns within one brick usage {col_name:fractional_usage}. """
     if limit_dict:
-        col_usage = {}
-        for col_name in limit_dict.keys():
-            # Intersection Size = max(0, min(maxes) - max(mins))
-            intersection_size = np.max([
-                np.min(
-                    [
-                        brick_column_details[brick][col_name]['max'],
-                        limit_dict[col_name][1]
-                    ]
-                ) - np.max(
-                    [
-                        brick_column_details[brick][col_name]['min'],
-                        limit_dict[col_name][0]
-                    ]
-                ),
-                0
-            ])
-            brick_interval_size = (
-                brick_column_details[brick][col_name]['max']
-                - brick_column_details[brick][col_name]['min']
-            )
-            col_usage[col_name] = intersection_size/brick_interval_size
+        col_usage = {
+            col_name: get_col_usage(brick_column_details[brick][col_name], limit_dict[col_name])
+            for col_name in limit_dict.keys()
+        }
     else:
         col_usage = {col_name: 1 for col_name in limit_dict.keys()}
     return col_usage
 
 
+def get_sample_allocation(brick_weights, sample_count):
+    """ Return {brick_name: sample_size} proportional to weights, summing to sample_count.
+
+    Largest remainder rounding: round all down, then give the remaining points to
+    the bricks with the largest fractional parts. Equal weights if all are zero.
+    """
+    total_weight = sum(brick_weights.values())
+    if total_weight <= 0:
+        brick_weights = {brick: 1 for brick in brick_weights}
+        total_weight = len(brick_weights)
+    quotas = {
+        brick: sample_count*weight/total_weight
+        for brick, weight in brick_weights.items()
+    }
+    allocation = {brick: int(np.floor(quota)) for brick, quota in quotas.items()}
+    remainder = sample_count - sum(allocation.values())
+    by_fraction = sorted(quotas, key=lambda brick: quotas[brick]-allocation[brick], reverse=True)
+    for brick in by_fraction[:remainder]:
+        allocation[brick] += 1
+    return allocation
+
+
 def get_all_bricks_usage(bricks_selected, limit_dict, brick_column_details):
-    """ Return dict of brick usage {brick_name:fractional_usage}. """
+    """ Return dict of brick usage {brick_name:fractional_usage}.
+
+    Assumes columns are independent, hence multiplies their usages.
+    """
     if limit_dict:
-        brick_usage = {}
-        for brick in bricks_selected:
-            brick_col_usage = []
-            for col_name in limit_dict.keys():
-                # Intersection Size = max(0, min(maxes) - max(mins))
-                intersection_size = np.max([
-                    np.min([
-                        brick_column_details[brick][col_name]['max'],
-                        limit_dict[col_name][1]
-                    ]) - np.max([
-                        brick_column_details[brick][col_name]['min'],
-                        limit_dict[col_name][0]
-                    ]),
-                    0
-                ])
-                brick_interval_size = (brick_column_details[brick][col_name]['max']
-                                       - brick_column_details[brick][col_name]['min'])
-                brick_col_usage.append(
-                    intersection_size/brick_interval_size
-                )
-            brick_usage[brick] = np.product(brick_col_usage)
+        brick_usage = {
+            brick: np.prod(list(
+                get_brick_col_usage(brick, limit_dict, brick_column_details).values()
+            ))
+            for brick in bricks_selected
+        }
     else:
         brick_usage = {brick: 1 for brick in bricks_selected}
     return brick_usage
@@ -441,7 +955,7 @@ def reduce_cols(data, axis_name_list, selection=[]):
                     selection[:,i] = data[axis_name]
     """
     t1 = time.time()
-    if len(selection) > 1:
+    if len(selection) > 0:
         selection = {
             axis_name: data[axis_name][selection]
             for axis_name in axis_name_list
@@ -456,6 +970,91 @@ def reduce_cols(data, axis_name_list, selection=[]):
     return selection
 
 
+def get_selection(data, criteria_dict, ordered=[], fused=True, predicate=''):
+    """ Return boolean array of rows within all criteria, in order of ordered.
+
+    Numeric criteria are checked in one pass by the fused kernel, otherwise
+    column by column. Returns an empty array without criteria, i.e. no selection.
+    predicate -- expression filter (see expressions), only checked on rows within
+                 criteria
+    """
+    selection = np.array([])  #np.ones(data.data.shape[0], dtype=bool)
+    if not ordered:
+        ordered = list(criteria_dict.items())
+    if fused and ordered and all(data[col_name].dtype.kind in 'biuf' for col_name, limits in ordered):
+        selection = get_selection_fused(data, ordered)
+        ordered = []
+    for idx, (col_name, limits) in enumerate(ordered):
+        # Initialize (NOTE: not by shape, slices of a single row are valid)
+        if idx == 0:
+            selection = get_within_limits(data, col_name, limits)
+        # Inplace Adjust
+        else:
+            np.logical_and(
+                selection,
+                get_within_limits(data, col_name, limits),
+                out=selection
+            )
+    if predicate:
+        selection = get_predicate_selection(data, predicate, selection)
+    return selection
+
+
+# prange already uses all cores, hence one kernel at a time across query threads
+kernel_lock = threading.Lock()
+
+
+@jit(nopython=True, parallel=True, nogil=True, cache=True)
+def get_within_all_limits(columns, lower, upper, selection):
+    """ Set selection of rows within (lower, upper) of all columns.
+
+    columns -- 2D array of shape (criteria, rows), native float64
+    Checks criteria in order and stops at the first a row is outside of, hence no
+    temporary arrays per criterion.
+    """
+    for i in prange(columns.shape[1]):
+        within = True
+        for c in range(columns.shape[0]):
+            value = columns[c, i]
+            if not ((value > lower[c]) and (value < upper[c])):
+                within = False
+                break
+        selection[i] = within
+
+
+def get_kernel_limit(dtype, limit):
+    """ Return limit as float64 comparing like NumPy compares a column of dtype.
+
+    e.g. a float32 column is compared with the limit rounded to float32.
+    """
+    if dtype.kind == 'f':
+        return float(dtype.type(limit))
+    return float(limit)
+
+
+def get_selection_fused(data, ordered, chunk_rows=65536):
+    """ Return boolean array of rows within all criteria using the fused kernel.
+
+    Copies chunks of the criteria columns to native float64 (FITS is big-endian,
+    which numba does not read), bounding extra memory by chunk_rows.
+    """
+    columns = [data[col_name] for col_name, limits in ordered]
+    lower = np.array([get_kernel_limit(column.dtype, limits[0])
+                      for column, (col_name, limits) in zip(columns, ordered)])
+    upper = np.array([get_kernel_limit(column.dtype, limits[1])
+                      for column, (col_name, limits) in zip(columns, ordered)])
+    row_count = columns[0].shape[0]
+    selection = np.empty(row_count, dtype=np.bool_)
+    chunk = np.empty((len(columns), min(chunk_rows, row_count)), dtype=np.float64)
+    for start in range(0, row_count, chunk_rows):
+        stop = min(start+chunk_rows, row_count)
+        for c, column in enumerate(columns):
+            chunk[c, :stop-start] = column[start:stop]
+        with kernel_lock:
+            get_within_all_limits(chunk[:, :stop-start], lower, upper, selection[start:stop])
+    return selection
+
+
 #@jit(nopython=True, parallel=True)
 def get_within_limits(data, col_name, limits):
     """ Return boolean array, where elements are within limits """
@@ -465,7 +1064,7 @@ def get_within_limits(data, col_name, limits):
     )
 
 
-def slice_data(data, criteria_dict, axis_name_list=[], list_comp=False, ordered=[]):
+def slice_data(data, criteria_dict, axis_name_list=[], list_comp=False, ordered=[], predicate=''):
     """ Return sliced data as dictionary.
 
     given named array, slice it according to (min,max) defined in criteria,
@@ -483,24 +1082,13 @@ def slice_data(data, criteria_dict, axis_name_list=[], list_comp=False, ordered=
                 for col_name, limits in criteria_dict.items()],
             0)
         t2 = time.time()
+        if predicate:
+            selection = get_predicate_selection(data, predicate, selection)
         print("    list comprehension: {:.2f}s".format(t2-t1))
     # Individual slicing for more efficient computation
     else:
         t1 = time.time()
-        selection = np.array([])  #np.ones(data.data.shape[0], dtype=bool)
-        if not ordered:
-            ordered = criteria_dict.items()
-        for col_name, limits in ordered:
-            # Initialize
-            if selection.shape[0] < 2:
-                selection = get_within_limits(data, col_name, limits)
-            # Inplace Adjust
-            else:
-                np.logical_and(
-                    selection,
-                    get_within_limits(data, col_name, limits),
-                    out=selection
-                )
+        selection = get_selection(data, criteria_dict, ordered=ordered, predicate=predicate)
         t2 = time.time()
         print("    cycle {:.2f}s".format(t2-t1))
     return reduce_cols(data, axis_name_list, selection)
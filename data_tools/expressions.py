@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Expressions on columns for FIDS, e.g. for axes and filters:
+
+    HST_ACS_WFC_F475W - HST_ACS_WFC_F814W           color
+    log10(HST_WFC3_F275W / HST_WFC3_F336W)          log ratio
+    HST_WFC3_F160W - 5*log10(radius_Best) + 5       distance modulus
+    0.5 < HST_ACS_WFC_F475W - HST_ACS_WFC_F814W < 2 predicate
+
+Only numbers, columns, arithmetic, comparisons, and whitelisted functions are
+allowed. Each expression is compiled into one numba kernel evaluating it row by
+row, hence no intermediate arrays are allocated, and sub-expressions shared by
+several expressions are evaluated once.
+"""
+import ast
+import threading
+import numpy as np
+from numba import jit, prange
+from collections import Counter, OrderedDict
+from io_tools import ColumnView
+
+
+functions = {
+    'log10': 'np.log10',
+    'log': 'np.log',
+    'ln': 'np.log',
+    'exp': 'np.exp',
+    'sqrt': 'np.sqrt',
+    'abs': 'np.abs'
+}
+binary_operators = {
+    ast.Add: '+',
+    ast.Sub: '-',
+    ast.Mult: '*',
+    ast.Div: '/',
+    ast.Pow: '**'
+}
+unary_operators = {
+    ast.UAdd: '+',
+    ast.USub: '-',
+    ast.Not: 'not '
+}
+compare_operators = {
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+    ast.Eq: '==',
+    ast.NotEq: '!='
+}
+bool_operators = {
+    ast.And: 'and',
+    ast.Or: 'or'
+}
+# Nodes evaluated once if shared by several expressions
+compound_nodes = (ast.BinOp, ast.UnaryOp, ast.Call, ast.Compare, ast.BoolOp)
+
+
+def parse_expression(expression, column_names=None):
+    """ Return syntax tree of expression, raising ValueError if not allowed.
+
+    column_names -- columns an expression may use, None for any
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as error:
+        raise ValueError("Invalid expression '{}': {}".format(expression, error.msg))
+    function_nodes = get_function_nodes(tree)
+    for node in ast.walk(tree.body):
+        if id(node) in function_nodes:
+            continue
+        elif isinstance(node, ast.Name):
+            if (column_names is not None) and (node.id not in column_names):
+                raise ValueError("Unknown column '{}' in '{}'".format(node.id, expression))
+        elif type(node).__name__ in ('Num', 'Constant', 'Str', 'Bytes', 'NameConstant'):
+            if get_number(node) is None:
+                raise ValueError("Only numbers allowed in '{}'".format(expression))
+        elif isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name)) or (node.func.id not in functions) \
+                    or (len(node.args) != 1) or node.keywords:
+                raise ValueError("Only {}(x) allowed in '{}'".format(
+                    '(x), '.join(sorted(functions)), expression))
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in binary_operators:
+                raise ValueError("Only + - * / ** allowed in '{}'".format(expression))
+        elif isinstance(node, ast.UnaryOp):
+            if type(node.op) not in unary_operators:
+                raise ValueError("Only + - not allowed in '{}'".format(expression))
+        elif isinstance(node, ast.Compare):
+            if any(type(op) not in compare_operators for op in node.ops):
+                raise ValueError("Only < <= > >= == != allowed in '{}'".format(expression))
+        elif isinstance(node, ast.BoolOp):
+            pass
+        elif not isinstance(node, tuple(binary_operators) + tuple(unary_operators)
+                            + tuple(compare_operators) + tuple(bool_operators) + (ast.Load,)):
+            raise ValueError("'{}' not allowed in '{}'".format(type(node).__name__, expression))
+    return tree
+
+
+def get_function_nodes(tree):
+    """ Return ids of the name nodes of function calls, which are no columns. """
+    return set(id(node.func) for node in ast.walk(tree.body) if isinstance(node, ast.Call))
+
+
+def get_number(node):
+    """ Return value of a number node (ast.Num before Python 3.8), otherwise None. """
+    value = getattr(node, 'n', None) if type(node).__name__ == 'Num' else getattr(node, 'value', None)
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def format_node(node, format_leaf):
+    """ Return source of node, fully bracketed.
+
+    format_leaf -- function returning source of a node to use instead, or None
+    """
+    leaf = format_leaf(node)
+    if leaf is not None:
+        return leaf
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.BinOp):
+        return '({} {} {})'.format(
+            format_node(node.left, format_leaf),
+            binary_operators[type(node.op)],
+            format_node(node.right, format_leaf))
+    if isinstance(node, ast.UnaryOp):
+        return '({}{})'.format(
+            unary_operators[type(node.op)],
+            format_node(node.operand, format_leaf))
+    if isinstance(node, ast.Call):
+        return '{}({})'.format(node.func.id, format_node(node.args[0], format_leaf))
+    if isinstance(node, ast.Compare):
+        # Chained:  a < b < c  ->  (a < b) and (b < c)
+        operands = [format_node(operand, format_leaf) for operand in [node.left] + node.comparators]
+        return '({})'.format(' and '.join(
+            '({} {} {})'.format(operands[i], compare_operators[type(op)], operands[i+1])
+            for i, op in enumerate(node.ops)))
+    if isinstance(node, ast.BoolOp):
+        return '({})'.format(' {} '.format(bool_operators[type(node.op)]).join(
+            format_node(value, format_leaf) for value in node.values))
+    if get_number(node) is not None:
+        return repr(float(get_number(node)))
+    raise ValueError("'{}' not allowed".format(type(node).__name__))
+
+
+def get_node_text(node):
+    """ Return canonical text of node, e.g. as key. """
+    return format_node(node, lambda leaf: None)
+
+
+def get_canonical_expression(expression):
+    """ Return expression formatted uniformly, e.g. as key. """
+    return get_node_text(parse_expression(expression).body)
+
+
+def get_expression_columns(expression):
+    """ Return sorted columns used by expression. """
+    tree = parse_expression(expression)
+    function_nodes = get_function_nodes(tree)
+    return sorted(set(
+        node.id for node in ast.walk(tree.body)
+        if isinstance(node, ast.Name) and (id(node) not in function_nodes)
+    ))
+
+
+def check_expression(expression, column_names=None, predicate=False):
+    """ Return expression if allowed (and a comparison if predicate), otherwise ''. """
+    if not expression:
+        return ''
+    try:
+        tree = parse_expression(expression, column_names)
+    except ValueError as error:
+        print("  {}".format(error))
+        return ''
+    if predicate and not is_predicate(tree):
+        print("  Filter '{}' is not a comparison".format(expression))
+        return ''
+    return expression
+
+
+def get_axis_expression(axis_name, axis_operator='', axis_two_name='', axis_expression=''):
+    """ Return expression of an axis, '' for a single column.
+
+    Combined axes (two columns and an operator) are expressions as well.
+    """
+    if axis_expression:
+        return axis_expression
+    if axis_name and axis_operator and axis_two_name:
+        return '({} {} {})'.format(axis_name, '*' if axis_operator == 'x' else axis_operator, axis_two_name)
+    return ''
+
+
+def is_predicate(tree):
+    """ Check if expression evaluates to True/False. """
+    body = tree.body
+    return isinstance(body, (ast.Compare, ast.BoolOp)) \
+        or (isinstance(body, ast.UnaryOp) and isinstance(body.op, ast.Not))
+
+
+def get_kernel_source(node, inputs, results, constants):
+    """ Return numba source of node at row, adding arrays it reads to inputs.
+
+    inputs    -- [(key, is_column)], position i is read as argument c<i>
+    results   -- {canonical sub-expression: array} evaluated before
+    constants -- [number], position i is read as k[i], hence the source only depends
+                 on the structure of node and e.g. new bounds of a selection reuse the
+                 compiled kernel
+    """
+    def format_leaf(leaf):
+        # Signs of numbers are part of the constant, e.g. bounds -0.5 and 0.5
+        sign = 1.0
+        if isinstance(leaf, ast.UnaryOp) and isinstance(leaf.op, (ast.UAdd, ast.USub)) \
+                and (get_number(leaf.operand) is not None):
+            sign = -1.0 if isinstance(leaf.op, ast.USub) else 1.0
+            leaf = leaf.operand
+        if get_number(leaf) is not None:
+            constants.append(sign*float(get_number(leaf)))
+            return 'k[{}]'.format(len(constants) - 1)
+        if isinstance(leaf, ast.Name):
+            key = (leaf.id, True)
+        elif isinstance(leaf, compound_nodes) and (get_node_text(leaf) in results):
+            key = (get_node_text(leaf), False)
+        else:
+            if isinstance(leaf, ast.Call):
+                # Function names are mapped to numpy, the argument formatted as usual
+                return '{}({})'.format(functions[leaf.func.id], format_node(leaf.args[0], format_leaf))
+            return None
+        if key not in inputs:
+            inputs.append(key)
+        return 'c{}[row]'.format(inputs.index(key))
+    return format_node(node, format_leaf)
+
+
+# Compiled kernels by source, as compiling takes far longer than evaluating,
+# least recently used ones are dropped beyond max_kernels
+kernels = OrderedDict()
+kernels_lock = threading.Lock()
+max_kernels = 128
+
+
+def get_kernel(row_source, input_count):
+    """ Return compiled kernel writing row_source of each row into out.
+
+    Called as kernel(out, k, c0, c1, ...) with constants k, see get_kernel_source.
+    """
+    source = (
+        "def kernel({}):\n"
+        "    for row in prange(out.shape[0]):\n"
+        "        out[row] = {}\n"
+    ).format(', '.join(['out', 'k'] + ['c{}'.format(i) for i in range(input_count)]), row_source)
+    with kernels_lock:
+        if source in kernels:
+            kernels.move_to_end(source)
+        else:
+            # Source only consists of whitelisted nodes, see parse_expression
+            namespace = {'np': np, 'prange': prange}
+            exec(source, namespace)
+            kernels[source] = jit(nopython=True, parallel=True, nogil=True)(namespace['kernel'])
+            while len(kernels) > max_kernels:
+                kernels.popitem(last=False)
+        return kernels[source]
+
+
+def get_kernel_column(column):
+    """ Return column as native numeric array (numba does not read big-endian FITS). """
+    column = np.asarray(column)
+    if column.dtype.kind not in 'biuf':
+        raise ValueError("Only numeric columns allowed, not {}".format(column.dtype))
+    return np.ascontiguousarray(column, dtype=column.dtype.newbyteorder('='))
+
+
+def evaluate_tree(data, tree, results={}):
+    """ Return array of expression tree evaluated on each row of data in one pass. """
+    inputs = []
+    constants = []
+    row_source = get_kernel_source(tree.body, inputs, results, constants)
+    arrays = [
+        get_kernel_column(data[key]) if is_column else results[key]
+        for key, is_column in inputs
+    ]
+    if arrays:
+        row_count = arrays[0].shape[0]
+    else:
+        # Constant:  as many rows as any column
+        row_count = len(data[next(iter(data.keys()))]) if hasattr(data, 'keys') else len(data)
+    out = np.empty(row_count, dtype=np.bool_ if is_predicate(tree) else np.float64)
+    get_kernel(row_source, len(arrays))(out, np.array(constants, dtype=np.float64), *arrays)
+    return out
+
+
+def get_subexpressions(tree):
+    """ Return set of compound sub-expressions of tree, including itself. """
+    return set(
+        get_node_text(node) for node in ast.walk(tree.body)
+        if isinstance(node, compound_nodes)
+    )
+
+
+def evaluate_expressions(data, expression_list, column_names=None):
+    """ Return [array of each expression] on data, e.g. for x, y, and color axes.
+
+    Compound sub-expressions used by several expressions are evaluated once,
+    e.g. the color of x = F475W - F814W and y = log10(F475W - F814W).
+    Each array is returned separately, as axes are adjusted in place.
+    """
+    trees = [parse_expression(expression, column_names) for expression in expression_list]
+    texts = [get_node_text(tree.body) for tree in trees]
+    counts = Counter(
+        text for tree in {text: tree for text, tree in zip(texts, trees)}.values()
+        for text in get_subexpressions(tree)
+    )
+    # Shorter first:  shared parts of shared parts are evaluated before
+    results = {}
+    for text in sorted([text for text, count in counts.items() if count > 1], key=len):
+        results[text] = evaluate_tree(data, ast.parse(text, mode='eval'), results)
+    returned = set()
+    return_list = []
+    for text, tree in zip(texts, trees):
+        if text not in results:
+            results[text] = evaluate_tree(data, tree, results)
+        return_list.append(results[text].copy() if text in returned else results[text])
+        returned.add(text)
+    return return_list
+
+
+def get_predicate_selection(data, predicate, selection=np.array([])):
+    """ Return boolean array of rows within selection where predicate is True.
+
+    selection -- boolean array of rows to check, empty to check all rows
+    Only rows within selection are read and evaluated.
+    """
+    tree = parse_expression(predicate)
+    if not is_predicate(tree):
+        raise ValueError("Filter '{}' is not a comparison".format(predicate))
+    if not selection.shape[0]:
+        return evaluate_tree(data, tree)
+    rows = np.flatnonzero(selection)
+    predicate_selection = np.zeros(selection.shape[0], dtype=np.bool_)
+    predicate_selection[rows[evaluate_tree(ColumnView(data, rows), tree)]] = True
+    return predicate_selection
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Narrowing down rows of a brick before slicing it, using precomputed indices.
+"""
+import numpy as np
+
+
+def blocks_to_ranges(block_mask, block_rows, row_count):
+    """ Return list of (start, stop) row ranges of consecutive selected blocks. """
+    padded = np.concatenate([[False], block_mask, [False]])
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return [
+        (int(start*block_rows), int(min(stop*block_rows, row_count)))
+        for start, stop in zip(changes[0::2], changes[1::2])
+    ]
+
+
+def get_zone_ranges(zone_map, criteria_dict):
+    """ Return row ranges of blocks which may contain rows within all criteria.
+
+    A block can only contain rows within (min, max) of a criterion if its zone
+    overlaps it, i.e.  zone_max > min  and  zone_min < max.
+    Returns None if no criterion has a zone map, i.e. all rows have to be checked.
+    """
+    columns = zone_map['columns']
+    zone_col_list = [col_name for col_name in criteria_dict.keys() if col_name in columns]
+    if not zone_col_list:
+        return None
+    block_mask = np.ones(columns[zone_col_list[0]].shape[0], dtype=np.bool_)
+    for col_name in zone_col_list:
+        limits = criteria_dict[col_name]
+        zones = columns[col_name]
+        block_mask &= (zones[:, 1] > limits[0]) & (zones[:, 0] < limits[1])
+    return blocks_to_ranges(block_mask, zone_map['block_rows'], zone_map['rows'])
+
+
+# Gathering rows by index costs more per row than scanning consecutive rows
+gather_cost = 4
+
+
+def get_index_range(sorted_index, criteria_dict, col_usage):
+    """ Return (col_name, start, stop) of the most selective indexed criterion.
+
+    Rows within (min, max) of col_name are  rows[start:stop]  of its sorted index,
+    found by binary search.  Returns (None, 0, 0) if no criterion is indexed.
+    """
+    indexed_col_list = [col_name for col_name in criteria_dict.keys() if col_name in sorted_index]
+    if not indexed_col_list:
+        return None, 0, 0
+    col_name = min(indexed_col_list, key=lambda col_name: col_usage.get(col_name, 1))
+    keys = sorted_index[col_name][0]
+    limits = criteria_dict[col_name]
+    # Strict limits, as in get_within_limits
+    start = int(np.searchsorted(keys, limits[0], side='right'))
+    stop = int(np.searchsorted(keys, limits[1], side='left'))
+    return col_name, start, max(start, stop)
+
+
+def get_spatial_cells(spatial_index, criteria_dict):
+    """ Return mask of cells which may contain rows within the criteria on its columns.
+
+    A column without criterion is unbounded.  Returns None if neither column has a
+    criterion, i.e. the spatial index does not narrow down rows.
+    """
+    col_x, col_y = spatial_index['columns']
+    if (col_x not in criteria_dict) and (col_y not in criteria_dict):
+        return None
+    cell_mask = np.ones(spatial_index['cell_x'].shape[0], dtype=np.bool_)
+    for col_name, cells in [(col_x, spatial_index['cell_x']), (col_y, spatial_index['cell_y'])]:
+        if col_name in criteria_dict:
+            limits = criteria_dict[col_name]
+            cell_mask &= (cells >= np.floor(limits[0]/spatial_index['cell_size'])) \
+                & (cells <= np.floor(limits[1]/spatial_index['cell_size']))
+    return cell_mask
+
+
+def get_cell_row_count(spatial_index, cell_mask):
+    """ Return number of rows in selected cells. """
+    offsets = spatial_index['offsets']
+    return int((offsets[1:] - offsets[:-1])[cell_mask].sum())
+
+
+def get_cell_rows(spatial_index, cell_mask):
+    """ Return sorted rows of selected cells. """
+    offsets = spatial_index['offsets']
+    starts = offsets[:-1][cell_mask]
+    lengths = offsets[1:][cell_mask] - starts
+    # Position of each row within rows:  start of its cell + position in its cell
+    shifts = starts - np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    positions = np.arange(lengths.sum()) + np.repeat(shifts, lengths)
+    return np.sort(spatial_index['rows'][positions])
+
+
+def plan_brick_rows(brick_name, criteria_dict, col_usage, row_count,
+                    zone_maps={}, sorted_indices={}, spatial_indices={}, previous_rows=None):
+    """ Return (row_ranges, row_ids, resolved_col_name) narrowing down rows to slice.
+
+    row_ranges          -- list of (start, stop) from zone maps, None for all rows
+    row_ids             -- sorted candidate rows from an index, None if not used
+    resolved_col_name   -- criterion already fulfilled by all row_ids
+    An index is used if gathering its rows is cheaper than scanning the ranges,
+    choosing the one with fewest rows (sorted index or spatial index).
+    previous_rows       -- sorted rows selected by wider criteria before, competing
+                           like an index
+    """
+    if not criteria_dict:
+        return None, None, None
+    row_ranges = None
+    cost = row_count
+    if brick_name in zone_maps:
+        row_ranges = get_zone_ranges(zone_maps[brick_name], criteria_dict)
+        if row_ranges is not None:
+            cost = sum(stop-start for start, stop in row_ranges)
+    plan = 'scan'
+    if brick_name in sorted_indices:
+        sorted_index = sorted_indices[brick_name]
+        col_name, start, stop = get_index_range(sorted_index, criteria_dict, col_usage)
+        if col_name and ((stop-start)*gather_cost < cost):
+            cost = (stop-start)*gather_cost
+            plan = 'sorted_index'
+    if brick_name in spatial_indices:
+        spatial_index = spatial_indices[brick_name]
+        cell_mask = get_spatial_cells(spatial_index, criteria_dict)
+        if (cell_mask is not None) \
+                and (get_cell_row_count(spatial_index, cell_mask)*gather_cost < cost):
+            cost = get_cell_row_count(spatial_index, cell_mask)*gather_cost
+            plan = 'spatial_index'
+    if (previous_rows is not None) and (previous_rows.shape[0]*gather_cost < cost):
+        plan = 'previous_rows'
+    if plan == 'sorted_index':
+        # Sorted rows gather in file order
+        return None, np.sort(sorted_index[col_name][1][start:stop]), col_name
+    if plan == 'spatial_index':
+        # Rows of cells on the edge of the box may still be outside
+        return None, get_cell_rows(spatial_index, cell_mask), None
+    if plan == 'previous_rows':
+        # Wider criteria before:  all rows within criteria_dict are among them
+        return None, previous_rows, None
+    return row_ranges, None, None
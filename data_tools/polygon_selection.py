@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-from numba import jit
-from .data_selector import reduce_cols, get_axis_data, adjust_axis_type
+from numba import jit, prange, types
+from .data_selector import reduce_cols, get_axis_data, adjust_axis_type, kernel_lock
+from .expressions import evaluate_expressions
 
 
 # Algorithms
@@ -38,11 +39,11 @@ def vec_point_in_polygon(x, y, poly):
     return c
 
 
-@jit(nopython=True, parallel=True, nogil=True, fastmath=True)
+@jit('b1(f8, f8, f8[:, ::1])', nopython=True, nogil=True, cache=True)
 def point_in_polygon(x, y, poly):
     """ Determine whether a point is inside a polygon.
 
-    x, y -- x and y coordinates of point, as 1D NumPy Array
+    x, y -- x and y coordinates of point
     poly -- 2D collection of shape [(x, y), (x, y), ...]
     -------------------------------------------------
     PNPOLY - Point Inclusion in Polygon Test
@@ -51,62 +52,195 @@ def point_in_polygon(x, y, poly):
     adapted by RCCG (github.com/the-rccg)
     """
     num = poly.shape[0]  # Number of vertices
-    i = 0            # First Vertex
-    j = num - 1      # Previous Vertex
-    # Explicit first lop
-    c = ((poly[i][1] > y) != (poly[j][1] > y)) \
-        and (x < poly[i][0] + (poly[j][0] - poly[i][0]) * (y - poly[i][1]) / (poly[j][1] - poly[i][1]))
-    # Loop over vertices
-    for i in range(1, num):
-        j = i-1
-        if ((poly[i][1] > y) != (poly[j][1] > y)) \
-                and (x < poly[i][0] + (poly[j][0] - poly[i][0]) * (y - poly[i][1]) / (poly[j][1] - poly[i][1])):
-            c = not c
+    c = False
+    j = num - 1          # Previous Vertex
+    for i in range(num):
+        # Only edges crossing the height of the point, hence never horizontal ones
+        if (poly[i, 1] > y) != (poly[j, 1] > y):
+            if x < poly[i, 0] + (poly[j, 0] - poly[i, 0]) * (y - poly[i, 1]) / (poly[j, 1] - poly[i, 1]):
+                c = not c
+        j = i
     return c
 
 
-@jit(nopython=True, parallel=True, nogil=True, fastmath=True)
+# Coordinates may be read-only views, e.g. of memory maps or DataFrames
+coordinate_types = [types.float64[::1], types.Array(types.float64, 1, 'C', readonly=True)]
+
+
+@jit([
+    types.void(x_type, y_type, types.float64[:, ::1], types.float64[::1], types.boolean[::1])
+    for x_type in coordinate_types for y_type in coordinate_types
+], nopython=True, parallel=True, nogil=True, cache=True)
+def get_in_polygon(x, y, poly, bounds, flags):
+    """ Set flags of points inside polygon, across all cores.
+
+    bounds -- bounding box of polygon [x_min, x_max, y_min, y_max]
+    Points outside the bounding box (or NaN) are rejected without looking at any edge.
+    """
+    for i in prange(x.shape[0]):
+        if (x[i] >= bounds[0]) and (x[i] <= bounds[1]) \
+                and (y[i] >= bounds[2]) and (y[i] <= bounds[3]):
+            flags[i] = point_in_polygon(x[i], y[i], poly)
+        else:
+            flags[i] = False
+
+
+@jit([
+    types.void(x_type, y_type, types.float64[:, ::1], types.float64[::1],
+               types.int64[::1], types.int64[::1], types.boolean[::1])
+    for x_type in coordinate_types for y_type in coordinate_types
+], nopython=True, parallel=True, nogil=True, cache=True)
+def get_in_polygon_slabs(x, y, poly, bounds, offsets, edges, flags):
+    """ Set flags of points inside polygon, only testing the edges of their slab.
+
+    offsets, edges -- edges of slab k are edges[offsets[k]:offsets[k+1]], see get_polygon_slabs
+    Edge e connects vertex e-1 (the last one for e = 0) with vertex e. Crossings are
+    tested as in point_in_polygon, which only counts edges spanning the height of
+    the point, and those are all in its slab.
+    """
+    num = poly.shape[0]
+    slab_count = offsets.shape[0] - 1
+    slab_height = (bounds[3] - bounds[2]) / slab_count
+    for i in prange(x.shape[0]):
+        flags[i] = False
+        if (x[i] >= bounds[0]) and (x[i] <= bounds[1]) \
+                and (y[i] >= bounds[2]) and (y[i] <= bounds[3]):
+            slab = min(int((y[i] - bounds[2]) / slab_height), slab_count - 1)
+            c = False
+            for k in range(offsets[slab], offsets[slab+1]):
+                e = edges[k]
+                j = e - 1 if e > 0 else num - 1
+                if (poly[e, 1] > y[i]) != (poly[j, 1] > y[i]):
+                    if x[i] < poly[e, 0] + (poly[j, 0] - poly[e, 0]) * (y[i] - poly[e, 1]) / (poly[j, 1] - poly[e, 1]):
+                        c = not c
+            flags[i] = c
+
+
+def get_polygon_slabs(poly, bounds, slab_count):
+    """ Return (offsets, edges) bucketing the edges of poly into horizontal slabs.
+
+    The height of the bounding box is split into slab_count slabs, each edge is
+    listed in every slab its height range overlaps. Horizontal edges never cross
+    the height of a point, hence are left out.
+    """
+    y_from = poly[:, 1]
+    y_to = np.roll(poly[:, 1], 1)
+    slab_height = (bounds[3] - bounds[2]) / slab_count
+    edges = np.flatnonzero(y_from != y_to)
+
+    def get_slab(edge_y):
+        """ Return slab like get_in_polygon_slabs, hence with the same rounding. """
+        return np.minimum(((edge_y - bounds[2]) / slab_height).astype(np.int64), slab_count-1)
+
+    first = get_slab(np.minimum(y_from, y_to)[edges])
+    last = get_slab(np.maximum(y_from, y_to)[edges])
+    spans = last - first + 1
+    starts = np.cumsum(spans) - spans
+    slabs = np.repeat(first - starts, spans) + np.arange(spans.sum())
+    order = np.argsort(slabs, kind='stable')
+    offsets = np.searchsorted(slabs[order], np.arange(slab_count+1)).astype(np.int64)
+    return offsets, np.repeat(edges, spans)[order].astype(np.int64)
+
+
+# Polygons with fewer vertices test all edges, bucketing does not pay off (see algorithm_evaluations/polygon_slab_kernels.ipynb)
+slab_min_vertices = 8
+
+
 def points_in_polygon(x, y, vertices):
-    """ Determine whether a point is inside a polygon. """
+    """ Return boolean array of points inside polygon of vertices.
+
+    Points outside the bounding box of the polygon are rejected first. Large
+    polygons (e.g. lassos of thousands of vertices) bucket their edges into as
+    many horizontal slabs as vertices, such that each point is only tested
+    against the few edges of its slab, independent of the number of vertices.
+    Coordinates are copied to native float64 if necessary (FITS is big-endian,
+    which numba does not read). Signatures are compiled once and cached on disk,
+    hence even the first selection after startup does not wait for compiling.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+    poly = np.ascontiguousarray(vertices, dtype=np.float64).reshape(-1, 2)
     flags = np.empty(x.shape[0], dtype=np.bool_)
-    for i in range(x.shape[0]):
-        flags[i] = point_in_polygon(x[i], y[i], vertices)
+    if not poly.shape[0]:
+        flags[:] = False
+        return flags
+    bounds = np.array([poly[:, 0].min(), poly[:, 0].max(), poly[:, 1].min(), poly[:, 1].max()])
+    if (poly.shape[0] < slab_min_vertices) or (bounds[3] == bounds[2]):
+        with kernel_lock:
+            get_in_polygon(x, y, poly, bounds, flags)
+        return flags
+    offsets, edges = get_polygon_slabs(poly, bounds, poly.shape[0])
+    with kernel_lock:
+        get_in_polygon_slabs(x, y, poly, bounds, offsets, edges, flags)
     return flags
 
 
 # Convenience Functions
 
 
-#@jit(nopython=True, parallel=True)
-def get_data_in_polygon(xaxis_name, yaxis_name, vertices, return_data):
-    """ Return all data in/or on polygon from bricks.
+def get_selection_axes(data, xaxis_name, yaxis_name,
+                       xaxis_type='linear', yaxis_type='linear',
+                       xaxis_two_name='', xaxis_operator='', yaxis_two_name='', yaxis_operator='',
+                       xaxis_expression='', yaxis_expression=''):
+    """ Return (x, y) arrays of rows of data as displayed on the axes.
+
+    Only reads the columns of the axes, e.g. of a ColumnView while scanning bricks.
+    Adjusts for Combined Axes, Expression Axes, and Scaled Axes. Axes are scaled on
+    copies, as adjust_axis_type works in place and would change the columns of data.
+    """
+    # 1. Expressions replace the axis, shared sub-expressions are evaluated once
+    expression_data = iter(evaluate_expressions(
+        data, [expression for expression in [xaxis_expression, yaxis_expression] if expression]
+    ))
+    # Combined column fix: get_axis_data -> [axis_name, axis_values]
+    if xaxis_expression:
+        disp_xaxis_name, xaxis_data = xaxis_expression, next(expression_data)
+    else:
+        disp_xaxis_name, xaxis_data = get_axis_data(data, xaxis_name, xaxis_operator, xaxis_two_name)
+    if yaxis_expression:
+        disp_yaxis_name, yaxis_data = yaxis_expression, next(expression_data)
+    else:
+        disp_yaxis_name, yaxis_data = get_axis_data(data, yaxis_name, yaxis_operator, yaxis_two_name)
+    # 2. Scaling fix: adjust_axis_type -> [axis_type, axis_name, axis_values]
+    xaxis_data = adjust_axis_type(xaxis_type, disp_xaxis_name, np.array(xaxis_data, dtype=np.float64))[-1]
+    yaxis_data = adjust_axis_type(yaxis_type, disp_yaxis_name, np.array(yaxis_data, dtype=np.float64))[-1]
+    return xaxis_data, yaxis_data
+
 
-    Iteratively appends data from bricks
+def get_selection_in_polygon(data, vertices, xaxis_name, yaxis_name,
+                             xaxis_type='linear', yaxis_type='linear',
+                             xaxis_two_name='', xaxis_operator='', yaxis_two_name='', yaxis_operator='',
+                             xaxis_expression='', yaxis_expression=''):
+    """ Return boolean array of rows of data whose point on the axes is inside vertices.
+
+    See get_selection_axes
     """
-    flags = points_in_polygon(
-        return_data[xaxis_name],
-        return_data[yaxis_name],
-        vertices
+    xaxis_data, yaxis_data = get_selection_axes(
+        data, xaxis_name, yaxis_name,
+        xaxis_type=xaxis_type, yaxis_type=yaxis_type,
+        xaxis_two_name=xaxis_two_name, xaxis_operator=xaxis_operator,
+        yaxis_two_name=yaxis_two_name, yaxis_operator=yaxis_operator,
+        xaxis_expression=xaxis_expression, yaxis_expression=yaxis_expression
     )
-    return_data = {col: return_data[col][flags] for col in return_data.keys()}
-    return return_data
+    # 3. Get those in Polygon
+    return points_in_polygon(xaxis_data, yaxis_data, vertices)
 
 
 def get_data_in_selection(xaxis_name, yaxis_name, vertices, return_data, axis_name_list,
                           xaxis_type='linear', yaxis_type='linear',
-                          xaxis_two_name='', xaxis_operator='', yaxis_two_name='', yaxis_operator=''):
+                          xaxis_two_name='', xaxis_operator='', yaxis_two_name='', yaxis_operator='',
+                          xaxis_expression='', yaxis_expression=''):
     """ Return data in the selected area.
 
-    Adjust for Combined Axes, Scaled Axes, and Polygon Selection
+    See get_selection_in_polygon
     """
-    # 1. Combined column fix: get_axis_data -> [axis_name, axis_values]
-    disp_xaxis_name, xaxis_data = get_axis_data(return_data, xaxis_name, xaxis_operator, xaxis_two_name)
-    disp_yaxis_name, yaxis_data = get_axis_data(return_data, yaxis_name, yaxis_operator, yaxis_two_name)
-    # 2. Scaling fix: adjust_axis_type -> [axis_type, axis_name, axis_values]
-    xaxis_data = adjust_axis_type(xaxis_type, disp_xaxis_name, xaxis_data)[-1]
-    yaxis_data = adjust_axis_type(yaxis_type, disp_yaxis_name, yaxis_data)[-1]
-    # 3. Get those in Polygon
-    flags = points_in_polygon(xaxis_data, yaxis_data, vertices)
+    flags = get_selection_in_polygon(
+        return_data, vertices, xaxis_name, yaxis_name,
+        xaxis_type=xaxis_type, yaxis_type=yaxis_type,
+        xaxis_two_name=xaxis_two_name, xaxis_operator=xaxis_operator,
+        yaxis_two_name=yaxis_two_name, yaxis_operator=yaxis_operator,
+        xaxis_expression=xaxis_expression, yaxis_expression=yaxis_expression
+    )
     # Reduce Data
     return_data = reduce_cols(return_data, axis_name_list, selection=flags)
     return return_data
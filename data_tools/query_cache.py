@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Query result cache for FIDS.
+
+Results of a request {axis_name: array} are kept by a canonical key of what
+determines the rows, such that e.g. changing the axis type or orientation does not
+query the bricks again.
+Rows of each brick within criteria are kept as well, such that narrower criteria
+(e.g. a range slider dragged inward) only check the rows selected before.
+"""
+import json
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from .expressions import get_canonical_expression
+
+
+def get_query_key(bricks_selected, criteria_dict, axis_name_list, display_count=0, seed=0,
+                  predicate=''):
+    """ Return canonical hash of a request, independent of list and dict order.
+
+    display_count -- number of sampled points, 0 for all data
+    seed          -- distinguishes samples of the same request
+    predicate     -- expression filter, see expressions
+    """
+    request = {
+        'bricks': sorted(bricks_selected),
+        'criteria': {
+            col_name: [float(limit) for limit in limits]
+            for col_name, limits in criteria_dict.items()
+        },
+        'axes': sorted(set(axis_name_list)),
+        'display_count': int(display_count or 0),
+        'seed': seed,
+        'predicate': get_canonical_expression(predicate) if predicate else ''
+    }
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_selection_key(query_key, selection):
+    """ Return canonical hash of the rows of a request refined by a visual selection.
+
+    query_key -- see get_query_key, of the request without axes
+    selection -- {name: json serializable value}, e.g. vertices and axes of a lasso
+    """
+    request = {'query': query_key, 'selection': selection}
+    return hashlib.sha1(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_result_size(result):
+    """ Return bytes of all arrays of a result. """
+    return int(np.sum([np.asarray(values).nbytes for values in result.values()]))
+
+
+class QueryCache:
+    """ Least-recently-used results of requests within max_mb (0 to disable).
+
+    Results are copied in and out, as callers adjust axes in place.
+    """
+
+    def __init__(self, max_mb):
+        self.max_bytes = int(max_mb*1024*1024)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Return copy of cached result, or None. """
+        with self._lock:
+            if key not in self._results:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._results.move_to_end(key)
+            result = self._results[key]
+        return {axis_name: np.array(values) for axis_name, values in result.items()}
+
+    def put(self, key, result):
+        """ Store copy of result, evicting least recently used ones beyond max_bytes. """
+        result_size = get_result_size(result)
+        if result_size > self.max_bytes:
+            return False
+        result = {axis_name: np.array(values) for axis_name, values in result.items()}
+        with self._lock:
+            if key in self._results:
+                self.size -= get_result_size(self._results.pop(key))
+            self._results[key] = result
+            self.size += result_size
+            while self.size > self.max_bytes:
+                self.size -= get_result_size(self._results.popitem(last=False)[1])
+        return True
+
+    def get_row_count(self, key):
+        """ Return number of rows of cached result without copying, or None. """
+        with self._lock:
+            if key not in self._results:
+                return None
+            result = self._results[key]
+            return len(next(iter(result.values()), []))
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def __len__(self):
+        return len(self._results)
+
+    def clear(self):
+        """ Remove all results, keeping counters. """
+        with self._lock:
+            self._results.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return {'results', 'size_mb', 'hits', 'misses'}. """
+        return {
+            'results': len(self._results),
+            'size_mb': self.size/1024/1024,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def is_criteria_within(criteria_dict, outer_criteria_dict):
+    """ Check if all rows within criteria_dict are within outer_criteria_dict. """
+    return all(
+        (col_name in criteria_dict)
+        and (criteria_dict[col_name][0] >= outer_limits[0])
+        and (criteria_dict[col_name][1] <= outer_limits[1])
+        for col_name, outer_limits in outer_criteria_dict.items()
+    )
+
+
+class SelectionCache:
+    """ Least-recently-used rows of bricks within criteria, within max_mb (0 to disable). """
+
+    def __init__(self, max_mb):
+        self.max_bytes = int(max_mb*1024*1024)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._selections = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_rows(self, brick_name, criteria_dict, predicate=''):
+        """ Return fewest rows of brick selected by criteria containing criteria_dict, or None.
+
+        Rows still have to be checked against criteria_dict and predicate, and were
+        selected without predicate or with the same one.
+        """
+        key_predicate = get_canonical_expression(predicate) if predicate else ''
+        with self._lock:
+            candidates = [
+                (key, rows)
+                for key, (outer_criteria_dict, rows) in self._selections.items()
+                if (key[0] == brick_name) and (key[2] in ('', key_predicate))
+                and is_criteria_within(criteria_dict, outer_criteria_dict)
+            ]
+            if not candidates:
+                self.misses += 1
+                return None
+            self.hits += 1
+            key, rows = min(candidates, key=lambda candidate: candidate[1].shape[0])
+            self._selections.move_to_end(key)
+            return rows
+
+    def put(self, brick_name, criteria_dict, rows, predicate=''):
+        """ Store rows of brick within criteria_dict, evicting least recently used ones. """
+        if (not criteria_dict) or (rows.nbytes > self.max_bytes):
+            return False
+        key = (
+            brick_name,
+            get_query_key([brick_name], criteria_dict, [], predicate=predicate),
+            get_canonical_expression(predicate) if predicate else ''
+        )
+        criteria_dict = {col_name: list(limits) for col_name, limits in criteria_dict.items()}
+        with self._lock:
+            if key in self._selections:
+                self.size -= self._selections.pop(key)[1].nbytes
+            self._selections[key] = (criteria_dict, rows)
+            self.size += rows.nbytes
+            while self.size > self.max_bytes:
+                self.size -= self._selections.popitem(last=False)[1][1].nbytes
+        return True
+
+    def __len__(self):
+        return len(self._selections)
+
+    def clear(self):
+        """ Remove all selections, keeping counters. """
+        with self._lock:
+            self._selections.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return {'selections', 'size_mb', 'hits', 'misses'}. """
+        return {
+            'selections': len(self._selections),
+            'size_mb': self.size/1024/1024,
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Selections of several regions on the axes for FIDS, kept server-side.
+
+A selection is an ordered list of regions (lasso or box) on the displayed axes,
+each adding its points to the selection or subtracting them (holes), e.g. two
+clusters of a CMD without the stars of a third one:
+
+    add lasso 1,  add lasso 2,  subtract box 3
+
+Vertices of all regions are concatenated into one polygon array, with the
+bounding box of each region, the combined bounding box of the added ones, and the
+edges of each region bucketed into horizontal slabs (see get_polygon_slabs), such
+that a brick is scanned once for all regions. Selections are stored by id as json:
+
+    selections/<selection_id>.json  -- axes, regions [{'mode', 'vertices'}]
+"""
+import os
+import re
+import json
+import hashlib
+import numpy as np
+from numba import jit, prange, types
+from io_tools import save_json, limit_folder_size
+from .data_selector import kernel_lock
+from .polygon_selection import coordinate_types, get_polygon_slabs, get_selection_axes, slab_min_vertices
+
+
+# Definition of the displayed axes, as passed to get_selection_axes
+axis_keys = [
+    'xaxis_name', 'yaxis_name', 'xaxis_type', 'yaxis_type',
+    'xaxis_two_name', 'xaxis_operator', 'yaxis_two_name', 'yaxis_operator',
+    'xaxis_expression', 'yaxis_expression'
+]
+region_modes = ('add', 'subtract')
+
+
+@jit([
+    types.void(x_type, y_type, types.float64[:, ::1], types.int64[::1], types.float64[:, ::1],
+               types.boolean[::1], types.int64[::1], types.int64[::1], types.int64[::1],
+               types.float64[::1], types.boolean[::1])
+    for x_type in coordinate_types for y_type in coordinate_types
+], nopython=True, parallel=True, nogil=True, cache=True)
+def get_in_regions(x, y, poly, vertex_offsets, region_bounds, adds, region_slabs,
+                   slab_offsets, edges, bounds, flags):
+    """ Set flags of points within the selection of regions, across all cores.
+
+    Region r has vertices poly[vertex_offsets[r]:vertex_offsets[r+1]], its bounding
+    box region_bounds[r], and slabs region_slabs[r] to region_slabs[r+1]; edges of
+    slab k are edges[slab_offsets[k]:slab_offsets[k+1]]. Edge e connects vertex e-1
+    (the last one of its region for its first vertex) with vertex e.
+    Regions are applied in order, each only tested if it can change the flag, i.e.
+    added ones for points not selected yet and subtracted ones for selected points.
+    bounds -- bounding box of all added regions, points outside are never selected
+    """
+    for i in prange(x.shape[0]):
+        c = False
+        if (x[i] >= bounds[0]) and (x[i] <= bounds[1]) \
+                and (y[i] >= bounds[2]) and (y[i] <= bounds[3]):
+            for r in range(adds.shape[0]):
+                if (c != adds[r]) \
+                        and (x[i] >= region_bounds[r, 0]) and (x[i] <= region_bounds[r, 1]) \
+                        and (y[i] >= region_bounds[r, 2]) and (y[i] <= region_bounds[r, 3]):
+                    start = vertex_offsets[r]
+                    end = vertex_offsets[r+1]
+                    slab_count = region_slabs[r+1] - region_slabs[r]
+                    slab = 0
+                    if slab_count > 1:
+                        slab_height = (region_bounds[r, 3] - region_bounds[r, 2]) / slab_count
+                        slab = min(int((y[i] - region_bounds[r, 2]) / slab_height), slab_count - 1)
+                    slab += region_slabs[r]
+                    inside = False
+                    for k in range(slab_offsets[slab], slab_offsets[slab+1]):
+                        e = edges[k]
+                        j = e - 1 if e > start else end - 1
+                        if (poly[e, 1] > y[i]) != (poly[j, 1] > y[i]):
+                            if x[i] < poly[e, 0] + (poly[j, 0] - poly[e, 0]) * (y[i] - poly[e, 1]) / (poly[j, 1] - poly[e, 1]):
+                                inside = not inside
+                    if inside:
+                        c = adds[r]
+        flags[i] = c
+
+
+def get_selected_vertices(selected_data):
+    """ Return vertices of a plotly selection (box or lasso) as array of shape (n, 2). """
+    if not selected_data:
+        return np.empty((0, 2))
+    if 'lassoPoints' in selected_data.keys():
+        return np.array(list(zip(selected_data['lassoPoints']['x'], selected_data['lassoPoints']['y'])),
+                        dtype=np.float64).reshape(-1, 2)
+    if 'range' in selected_data.keys():
+        (x0, x1), (y0, y1) = selected_data['range']['x'], selected_data['range']['y']
+        return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=np.float64)
+    return np.empty((0, 2))
+
+
+class RegionSelection:
+    """ Regions added to and subtracted from a selection on the same axes.
+
+    axes    -- {axis_key: value} of the displayed axes, see axis_keys
+    regions -- [(mode, vertices)] in order, mode 'add' or 'subtract'
+    """
+
+    def __init__(self, axes, regions=()):
+        self.axes = {axis_key: axes.get(axis_key) or '' for axis_key in axis_keys}
+        self.regions = []
+        self._index = None
+        for mode, vertices in regions:
+            self.add_region(mode, vertices)
+
+    def add_region(self, mode, vertices):
+        """ Append region, ignoring ones without area. """
+        if mode not in region_modes:
+            raise ValueError("Region mode must be one of {}, not '{}'".format(region_modes, mode))
+        vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape(-1, 2)
+        if vertices.shape[0] < 3:
+            return False
+        self.regions.append((mode, vertices))
+        self._index = None
+        return True
+
+    def is_same_axes(self, axes):
+        """ Check if regions were drawn on the displayed axes. """
+        return all(self.axes[axis_key] == (axes.get(axis_key) or '') for axis_key in axis_keys)
+
+    def get_bounds(self, mode='add'):
+        """ Return combined bounding box [x_min, x_max, y_min, y_max] of regions of mode, NaN if none. """
+        vertices_list = [vertices for region_mode, vertices in self.regions if region_mode == mode]
+        if not vertices_list:
+            return np.full(4, np.nan)
+        vertices = np.concatenate(vertices_list)
+        return np.array([vertices[:, 0].min(), vertices[:, 0].max(),
+                         vertices[:, 1].min(), vertices[:, 1].max()])
+
+    def get_index(self):
+        """ Return arrays of get_in_regions, computed once per set of regions. """
+        if self._index is not None:
+            return self._index
+        vertex_offsets = [0]
+        edge_count = 0
+        region_bounds = []
+        region_slabs = [0]
+        slab_offsets = []
+        edges = []
+        for mode, vertices in self.regions:
+            bounds = np.array([vertices[:, 0].min(), vertices[:, 0].max(),
+                               vertices[:, 1].min(), vertices[:, 1].max()])
+            # Small or flat regions test all their edges, see points_in_polygon
+            slab_count = vertices.shape[0] \
+                if (vertices.shape[0] >= slab_min_vertices) and (bounds[3] > bounds[2]) else 1
+            offsets, region_edges = get_polygon_slabs(vertices, bounds, slab_count)
+            slab_offsets.append(offsets[:-1] + edge_count)
+            edges.append(region_edges + vertex_offsets[-1])
+            edge_count += region_edges.shape[0]
+            vertex_offsets.append(vertex_offsets[-1] + vertices.shape[0])
+            region_bounds.append(bounds)
+            region_slabs.append(region_slabs[-1] + slab_count)
+        slab_offsets.append([edge_count])
+        self._index = (
+            np.ascontiguousarray(np.concatenate(
+                [vertices for mode, vertices in self.regions] or [np.empty((0, 2))]
+            )),
+            np.array(vertex_offsets, dtype=np.int64),
+            np.array(region_bounds, dtype=np.float64).reshape(-1, 4),
+            np.array([mode == 'add' for mode, vertices in self.regions], dtype=np.bool_),
+            np.array(region_slabs, dtype=np.int64),
+            np.concatenate(slab_offsets).astype(np.int64),
+            np.concatenate(edges or [np.empty(0)]).astype(np.int64),
+            self.get_bounds('add')
+        )
+        return self._index
+
+    def points_in_selection(self, x, y):
+        """ Return boolean array of points within the selection, one pass for all regions. """
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        y = np.ascontiguousarray(y, dtype=np.float64)
+        flags = np.empty(x.shape[0], dtype=np.bool_)
+        index = self.get_index()
+        with kernel_lock:
+            get_in_regions(x, y, *index, flags)
+        return flags
+
+    def get_selection(self, data):
+        """ Return boolean array of rows of data within the selection, see get_selection_axes. """
+        axes = dict(self.axes)
+        xaxis_data, yaxis_data = get_selection_axes(
+            data, axes.pop('xaxis_name'), axes.pop('yaxis_name'), **axes
+        )
+        return self.points_in_selection(xaxis_data, yaxis_data)
+
+    def to_dict(self):
+        """ Return json serializable selection. """
+        return {
+            'axes': dict(self.axes),
+            'regions': [
+                {'mode': mode, 'vertices': vertices.tolist()}
+                for mode, vertices in self.regions
+            ]
+        }
+
+    @classmethod
+    def from_dict(cls, selection_dict):
+        """ Return selection of to_dict. """
+        return cls(selection_dict['axes'], [
+            (region['mode'], region['vertices']) for region in selection_dict['regions']
+        ])
+
+    def get_id(self):
+        """ Return canonical hash of axes and regions. """
+        return hashlib.sha1(json.dumps(self.to_dict(), sort_keys=True).encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self.regions)
+
+
+def get_region_selection_path(savepath):
+    """ Return folder containing the stored selections. """
+    return savepath + 'selections/'
+
+
+def save_region_selection(selection, savepath, max_mb=0):
+    """ Store selection by its id, returning the id.
+
+    Least recently used selections beyond max_mb are removed (0 for no limit).
+    """
+    folderpath = get_region_selection_path(savepath)
+    os.makedirs(folderpath, exist_ok=True)
+    selection_id = selection.get_id()
+    save_json(selection.to_dict(), '{}.json'.format(selection_id), savepath=folderpath)
+    limit_folder_size(folderpath, max_mb)
+    return selection_id
+
+
+def load_region_selection(selection_id, savepath):
+    """ Return stored selection of id, None if unknown. """
+    # Ids come with requests, hence only hashes are looked up
+    if not re.fullmatch(r'[0-9a-f]{40}', selection_id or ''):
+        return None
+    filepath = '{}{}.json'.format(get_region_selection_path(savepath), selection_id)
+    try:
+        with open(filepath, 'r') as f:
+            selection_dict = json.load(f)
+        # Recently used ones are kept, see limit_folder_size
+        os.utime(filepath)
+    except OSError:
+        return None
+    return RegionSelection.from_dict(selection_dict)
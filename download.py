@@ -18,9 +18,9 @@ def unpack_vars(variables):
             if variables[key][0] == '[':
                 # Check for nested lists
                 if variables[key][1] == '[':
-                    # Insert commas between numbers, and between lists
+                    # Insert commas between numbers (e.g. "-1." of numpy), and between lists
                     variables[key] = re.sub(
-                        r"([-\d]+)\s+([\d-]+)",
+                        r"([-\d.]+)\s+([\d.-]+)",
                         r"\1,\2",
                         variables[key].replace("\n ", ",")
                     )
@@ -67,6 +67,19 @@ def generate_tmp(return_data, chunk_size_mb):
     tf.close()
 
 
+def generate_chunks(data_chunks, axis_name_list):
+    """ Send CSV of each chunk as it is computed, header first.
+
+    Memory is bounded by one chunk, as no chunk is held after it is sent.
+    """
+    yield pd.DataFrame({axis_name: [] for axis_name in axis_name_list}).to_csv(index=False)
+    row_count = 0
+    for chunk in data_chunks:
+        row_count += chunk[axis_name_list[0]].shape[0]
+        yield pd.DataFrame(chunk, columns=axis_name_list).to_csv(index=False, header=False)
+    print("  Streamed Rows: {:,}".format(row_count))
+
+
 def generate_small_file(return_data, return_size_mb):
     """ Send small file from memory. """
     # String Buffer
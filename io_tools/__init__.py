@@ -3,6 +3,18 @@
 IO toolset for FIDS.
 """
 
-from .io_tools import load_json, save_json
+from .io_tools import load_json, save_json, append_json_line, load_json_lines, limit_folder_size
 from .io_tools import get_ftype, parse_datatype, map_types
 from .io_tools import get_valid_filelist, get_dict_of_files, get_data_counts, get_brick_data_types
+from .file_pool import FilePool, get_file_pool
+from .columnar import ColumnView, save_columnar_data, is_columnar_valid
+from .zone_maps import ZoneMaps, get_zone_maps, get_zone_map_path, save_zone_map, is_zone_map_valid
+from .sorted_index import SortedIndices, get_sorted_indices, get_sorted_index_path, is_sorted_index_valid
+from .sorted_index import reset_sorted_index, save_sorted_index, save_sorted_index_meta
+from .spatial_index import SpatialIndices, get_spatial_indices, get_spatial_index_path
+from .spatial_index import save_spatial_index, is_spatial_index_valid
+from .derived_columns import DerivedPool, get_derived_pool, get_derived_column_path
+from .derived_columns import get_derived_column_details, is_derived_columns_valid
+from .derived_columns import reset_derived_columns, save_derived_columns_meta
+from .row_bitmaps import RowBitmap, SelectionBitmap, get_bitmap_path
+from .row_bitmaps import save_selection_bitmap, load_selection_bitmap
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""
+Columnar Functions for IO.
+
+A brick can be stored as a directory of native-endian .npy files, one per column,
+with a meta.json describing the source file it was converted from:
+
+    <brick_name>.cols/
+        meta.json
+        <col_name>.npy
+
+Columns are memory mapped, hence selecting a column is a zero-copy view and
+comparisons run without byte-swapping big-endian FITS data on every access.
+"""
+import os
+import json
+import shutil
+import numpy as np
+
+
+class ColumnView(object):
+    """ Lazy row selection of a column-addressable table.
+
+    FITS_rec[point_idx_list] gathers every column of the file, while ColumnView
+    only gathers a column when it is accessed, and only once.
+        view = ColumnView(table, rows)
+        view[col_name]      -- table[col_name][rows]
+        view[other_rows]    -- ColumnView(view, other_rows)
+    """
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+        self._columns = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._columns:
+                self._columns[key] = self.table[key][self.rows]
+            return self._columns[key]
+        return ColumnView(self, key)
+
+    def __len__(self):
+        if isinstance(self.rows, slice):
+            return len(range(*self.rows.indices(len(self.table))))
+        rows = np.asarray(self.rows)
+        if rows.dtype == np.bool_:
+            return int(np.count_nonzero(rows))
+        return rows.shape[0]
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def names(self):
+        return self.table.names
+
+
+class ColumnData(object):
+    """ Dictionary-like access to memory mapped columns of a columnar brick. """
+
+    def __init__(self, dirpath, dtypes, row_count, memmap=True):
+        self.dirpath = dirpath
+        self.dtypes = dtypes
+        self.row_count = row_count
+        self.mmap_mode = 'r' if memmap else None
+        self._columns = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._columns:
+                if key not in self.dtypes:
+                    raise KeyError(key)
+                self._columns[key] = np.load(
+                    '{}{}.npy'.format(self.dirpath, key),
+                    mmap_mode=self.mmap_mode
+                )
+            return self._columns[key]
+        return ColumnView(self, key)
+
+    def __len__(self):
+        return self.row_count
+
+    @property
+    def shape(self):
+        return (self.row_count,)
+
+    @property
+    def names(self):
+        return list(self.dtypes.keys())
+
+    def close(self):
+        """ Drop references to memory maps, arrays still in use stay valid. """
+        self._columns = {}
+
+
+class ColumnDefs(object):
+    """ Mimic the parts of FITS ColDefs used by FIDS. """
+
+    def __init__(self, dtypes):
+        self.names = list(dtypes.keys())
+        self.dtype = np.dtype([(name, dtypes[name]) for name in self.names])
+
+
+class ColumnTable(object):
+    """ Mimic the parts of a FITS DataTable used by FIDS.
+
+    table.header['NAXIS2']  -- row count
+    table.columns           -- names, dtype
+    table.data[col_name]    -- memory mapped native-endian column
+    """
+
+    def __init__(self, dirpath, memmap=True):
+        meta = load_columnar_meta(dirpath)
+        self.dirpath = dirpath
+        self.meta = meta
+        self.header = {'NAXIS2': meta['rows']}
+        self.columns = ColumnDefs(meta['columns'])
+        self.data = ColumnData(dirpath, meta['columns'], meta['rows'], memmap=memmap)
+
+    def close(self):
+        self.data.close()
+
+
+# Reading
+
+
+def load_columnar_meta(dirpath):
+    """ Return meta information of columnar brick. """
+    with open(dirpath+'meta.json', 'r') as f:
+        return json.load(f)
+
+
+def open_columnar_data(dirpath, memmap=True):
+    """ Return (handle, table) for a columnar brick, mirrors open_fitstable. """
+    table = ColumnTable(dirpath, memmap=memmap)
+    return table, table
+
+
+def get_columnar_data(dirpath, memmap=True):
+    """ Return columnar brick as DataTable-like object. """
+    return ColumnTable(dirpath, memmap=memmap)
+
+
+def get_brick_data_types_columnar(data, filename_list):
+    """ Return dict of column data types.
+
+    Columns are stored as read, hence dtypes are already native and decoded.
+    """
+    return dict(data[filename_list[0]].columns.dtype.descr)
+
+
+# Writing
+
+
+def get_source_stat(filepath):
+    """ Return size and modification time to recognize changed source files. """
+    stat = os.stat(filepath)
+    return {'source_size': stat.st_size, 'source_mtime': stat.st_mtime}
+
+
+def is_columnar_valid(dirpath, filepath, column_list):
+    """ Check if columnar brick exists, is complete, and matches its source file. """
+    try:
+        meta = load_columnar_meta(dirpath)
+    except (OSError, ValueError):
+        return False
+    source_stat = get_source_stat(filepath)
+    return (
+        (meta['source_size'] == source_stat['source_size'])
+        and (meta['source_mtime'] == source_stat['source_mtime'])
+        and all(col_name in meta['columns'] for col_name in column_list)
+    )
+
+
+def save_columnar_data(table, filepath, dirpath, column_list, chunk_rows=65536,
+                       row_order=None):
+    """ Write columns of table as native-endian .npy files in chunks.
+
+    Reads row chunks of the FITS_rec to bound memory, which also decodes
+    string columns only one chunk at a time.
+    With row_order (a permutation of rows), row i of the output is row row_order[i]
+    of the table. Each chunk is gathered in file order, then placed in row_order.
+    meta.json is written last, hence an interrupted conversion is never valid.
+    """
+    if os.path.isdir(dirpath):
+        shutil.rmtree(dirpath)
+    os.makedirs(dirpath)
+    row_count = table.header['NAXIS2']
+    # Native dtypes as read (e.g. >f8 -> <f8, |S20 -> <U20)
+    first_rows = table.data[0:1]
+    dtypes = {
+        col_name: np.dtype(first_rows[col_name].dtype).newbyteorder('=')
+        for col_name in column_list
+    }
+    columns = {
+        col_name: np.lib.format.open_memmap(
+            '{}{}.npy'.format(dirpath, col_name),
+            mode='w+', dtype=dtypes[col_name], shape=(row_count,)
+        )
+        for col_name in column_list
+    }
+    for start in range(0, row_count, chunk_rows):
+        if row_order is None:
+            rows = table.data[start:start+chunk_rows]
+            positions = slice(start, start+chunk_rows)
+        else:
+            chunk_order = row_order[start:start+chunk_rows]
+            file_order = np.argsort(chunk_order)
+            rows = table.data[chunk_order[file_order]]
+            positions = start + file_order
+        for col_name in column_list:
+            columns[col_name][positions] = rows[col_name]
+    for col_name in column_list:
+        columns[col_name].flush()
+    del columns
+    meta = {
+        'rows': row_count,
+        'columns': {col_name: dtypes[col_name].str for col_name in column_list},
+        **get_source_stat(filepath)
+    }
+    with open(dirpath+'meta.json', 'w') as f:
+        json.dump(meta, f, sort_keys=True, indent=4)
+    return meta
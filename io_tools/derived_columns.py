@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Derived Column Functions for IO.
+
+A derived column is a named expression of columns (e.g. a color F475W - F814W),
+computed once per brick and stored next to it, such that queries read it like any
+other column instead of evaluating the expression again:
+
+    derived/<brick_name>/
+        meta.json           -- columns {name: expression}, dtypes, rows, details,
+                               source_size, source_mtime
+        <col_name>.npy      -- values of each row (native-endian)
+
+Bricks of a pool are wrapped such that  data[brick_name].data[col_name]  returns the
+memory mapped sidecar for derived columns and the brick's own column otherwise.
+"""
+import os
+import json
+import shutil
+import numpy as np
+from collections.abc import Mapping
+from .columnar import ColumnView, get_source_stat
+
+
+def get_derived_column_path(savepath):
+    """ Return folder containing the derived columns of all bricks. """
+    return savepath + 'derived/'
+
+
+def reset_derived_columns(dirpath):
+    """ Remove outdated derived columns of brick and create empty folder. """
+    if os.path.isdir(dirpath):
+        shutil.rmtree(dirpath)
+    os.makedirs(dirpath)
+
+
+def save_derived_columns_meta(dirpath, source_filepath, derived_columns, dtypes, row_count,
+                              details):
+    """ Write meta.json last, hence an interrupted build is never valid.
+
+    details -- {col_name: {'min', 'max', ...}} as in brick_column_details
+    """
+    meta = {
+        'columns': dict(derived_columns),
+        'dtypes': dict(dtypes),
+        'rows': row_count,
+        'details': details,
+        **get_source_stat(source_filepath)
+    }
+    with open(dirpath+'meta.json', 'w') as f:
+        json.dump(meta, f, sort_keys=True, indent=4)
+    return meta
+
+
+def load_derived_columns_meta(dirpath):
+    """ Return meta information of derived columns of a brick. """
+    with open(dirpath+'meta.json', 'r') as f:
+        return json.load(f)
+
+
+def is_derived_columns_valid(dirpath, source_filepath, derived_columns):
+    """ Check if derived columns exist, use the same expressions, and match their source. """
+    try:
+        meta = load_derived_columns_meta(dirpath)
+    except (OSError, ValueError):
+        return False
+    source_stat = get_source_stat(source_filepath)
+    return (
+        (meta['source_size'] == source_stat['source_size'])
+        and (meta['source_mtime'] == source_stat['source_mtime'])
+        and all(
+            meta['columns'].get(col_name) == expression
+            for col_name, expression in derived_columns.items()
+        )
+    )
+
+
+def get_derived_column_details(folderpath, brick_name_list, derived_columns):
+    """ Return {brick_name: {col_name: details}} of derived columns, as brick_column_details. """
+    brick_column_details = {}
+    for brick_name in brick_name_list:
+        try:
+            meta = load_derived_columns_meta('{}{}/'.format(folderpath, brick_name))
+        except (OSError, ValueError):
+            continue
+        brick_column_details[brick_name] = {
+            col_name: meta['details'][col_name]
+            for col_name in derived_columns
+            if meta['details'].get(col_name)
+        }
+    return brick_column_details
+
+
+class DerivedData(object):
+    """ Dictionary-like access to columns of a brick and its derived columns. """
+
+    def __init__(self, table_data, dirpath, dtypes, columns=None):
+        self.table_data = table_data
+        self.dirpath = dirpath
+        self.dtypes = dtypes
+        self._columns = {} if columns is None else columns
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self.dtypes:
+                return self.table_data[key]
+            if key not in self._columns:
+                self._columns[key] = np.load(
+                    '{}{}.npy'.format(self.dirpath, key), mmap_mode='r'
+                )
+            return self._columns[key]
+        # Rows of a derived column are only gathered when accessed
+        return ColumnView(self, key)
+
+    def __len__(self):
+        return len(self.table_data)
+
+    @property
+    def shape(self):
+        return (len(self),)
+
+    @property
+    def names(self):
+        return list(self.table_data.names) + list(self.dtypes.keys())
+
+
+class DerivedColumnDefs(object):
+    """ Mimic the parts of FITS ColDefs used by FIDS, including derived columns. """
+
+    def __init__(self, columns, dtypes):
+        self.names = list(columns.names) + list(dtypes.keys())
+        self.dtype = np.dtype(
+            columns.dtype.descr + [(col_name, dtypes[col_name]) for col_name in dtypes]
+        )
+
+
+class DerivedTable(object):
+    """ Mimic a brick (table.header, table.columns, table.data) with derived columns. """
+
+    def __init__(self, table, dirpath, dtypes, columns=None):
+        self.table = table
+        self.header = table.header
+        self.columns = DerivedColumnDefs(table.columns, dtypes)
+        self.data = DerivedData(table.data, dirpath, dtypes, columns=columns)
+
+
+class DerivedPool(Mapping):
+    """ Dictionary-like access to bricks of a pool with their derived columns.
+
+    Behaves like the pool, i.e. data[brick_name].data[col_name], while bricks are
+    still opened, kept, and closed by the pool. Only the memory maps of derived
+    columns are kept here, hence evicted bricks are not held open.
+    """
+
+    def __init__(self, pool, folderpath, dtypes):
+        self.pool = pool
+        self.folderpath = folderpath
+        self.dtypes = dtypes
+        # brick_name: {col_name: memory mapped derived column}
+        self._columns = {}
+
+    def __getitem__(self, brick_name):
+        table = self.pool[brick_name]
+        return DerivedTable(
+            table, '{}{}/'.format(self.folderpath, brick_name), self.dtypes,
+            columns=self._columns.setdefault(brick_name, {})
+        )
+
+    def __contains__(self, brick_name):
+        return brick_name in self.pool
+
+    def __iter__(self):
+        return iter(self.pool)
+
+    def __len__(self):
+        return len(self.pool)
+
+    def close(self, brick_name):
+        """ Close brick if open. """
+        self._columns.pop(brick_name, None)
+        self.pool.close(brick_name)
+
+    def close_all(self):
+        """ Close all open bricks. """
+        self._columns = {}
+        self.pool.close_all()
+
+    def stats(self):
+        """ Return counters and current usage of pool. """
+        return self.pool.stats()
+
+
+def get_derived_pool(pool, savepath, dtypes):
+    """ Return pool with derived columns of dtypes {col_name: dtype}, the pool if none. """
+    if not dtypes:
+        return pool
+    return DerivedPool(pool, get_derived_column_path(savepath), dtypes)
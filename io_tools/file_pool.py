@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Lazily opened, size-limited pool of data files for FIDS.
+"""
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from .io_tools import open_fncs, get_ftype
+
+
+class FilePool(Mapping):
+    """ Dictionary-like access to bricks which opens files on first use.
+
+    Behaves like the dictionary returned by get_dict_of_files, i.e.
+        data[brick_name].data[col_name]
+    but a brick is only opened when it is first accessed. Open bricks are kept
+    in least-recently-used order and closed once either limit is exceeded:
+        max_open        -- maximum number of open file handles (0: unlimited)
+        max_mapped_mb   -- maximum size of all memory mapped files (0: unlimited)
+    Bricks are read from folderpath+brick_name+suffix, where the filetype of the
+    resulting path selects the reading function, e.g. suffix='.cols/' reads the
+    columnar cache of each brick instead of the original file.
+
+    NOTE: Closing a memory mapped HDUList does not invalidate arrays that are still
+          referenced, AstroPy keeps the mmap alive until the last array is deleted.
+          But it drops table.data of the closed HDU, whose next access reads from the
+          closed file. Hence bricks are returned as PooledTable, which maps the data
+          within the lock when the brick is opened and keeps it, such that evicting a
+          brick another thread just received (but has not accessed yet) is safe.
+    NOTE: The most recently opened brick is never evicted, even if it alone exceeds
+          max_mapped_mb.
+    """
+
+    def __init__(self, filename_list, folderpath, max_open=0, max_mapped_mb=0, suffix=''):
+        self.filename_list = list(filename_list)
+        self._filename_set = set(self.filename_list)
+        self.folderpath = folderpath
+        self.suffix = suffix
+        self.max_open = max_open
+        self.max_mapped_bytes = max_mapped_mb*1024*1024
+        # brick_name: (handle, table, mapped_bytes)
+        self._open = OrderedDict()
+        self._mapped_bytes = 0
+        self._lock = threading.RLock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, brick_name):
+        if brick_name not in self._filename_set:
+            raise KeyError(brick_name)
+        with self._lock:
+            if brick_name in self._open:
+                self.hits += 1
+                self._open.move_to_end(brick_name)
+                return self._open[brick_name][1]
+            self.misses += 1
+            handle, table, mapped_bytes = self._open_brick(brick_name)
+            self._open[brick_name] = (handle, table, mapped_bytes)
+            self._mapped_bytes += mapped_bytes
+            self._evict()
+            return table
+
+    def __contains__(self, brick_name):
+        """ Check without opening the file (Mapping default would open it). """
+        return brick_name in self._filename_set
+
+    def __iter__(self):
+        return iter(self.filename_list)
+
+    def __len__(self):
+        return len(self.filename_list)
+
+    def _open_brick(self, brick_name):
+        """ Return (handle, table, mapped_bytes) for brick. """
+        filepath = self.folderpath + brick_name + self.suffix
+        handle, table = open_fncs[get_ftype(filepath)](filepath, memmap=True)
+        return handle, PooledTable(table), get_mapped_bytes(filepath)
+
+    def _evict(self):
+        """ Close least recently used bricks until within limits. """
+        while len(self._open) > 1 and (
+                (self.max_open and len(self._open) > self.max_open)
+                or (self.max_mapped_bytes and self._mapped_bytes > self.max_mapped_bytes)):
+            self.close(next(iter(self._open)))
+            self.evictions += 1
+
+    def close(self, brick_name):
+        """ Close brick if open. """
+        with self._lock:
+            if brick_name in self._open:
+                handle, table, mapped_bytes = self._open.pop(brick_name)
+                self._mapped_bytes -= mapped_bytes
+                handle.close()
+
+    def close_all(self):
+        """ Close all open bricks. """
+        with self._lock:
+            for brick_name in list(self._open.keys()):
+                self.close(brick_name)
+
+    def stats(self):
+        """ Return counters and current usage of pool. """
+        with self._lock:
+            return {
+                'open': len(self._open),
+                'mapped_mb': self._mapped_bytes/1024/1024,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class PooledTable(object):
+    """ Mimic a brick (table.header, table.columns, table.data) mapped when opened.
+
+    Holds the data itself instead of the table, whose data is dropped when closed.
+    """
+
+    def __init__(self, table):
+        self.header = table.header
+        self.columns = table.columns
+        self.data = table.data
+
+
+def get_mapped_bytes(filepath):
+    """ Return size of file, or of all files in a directory. """
+    try:
+        if os.path.isdir(filepath):
+            return sum(
+                os.path.getsize(os.path.join(filepath, filename))
+                for filename in os.listdir(filepath)
+            )
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
+
+
+def get_file_pool(filename_list, folderpath, max_open=0, max_mapped_mb=0, suffix=''):
+    """ Return FilePool of files to access, opened lazily on first access. """
+    return FilePool(filename_list, folderpath,
+                    max_open=max_open, max_mapped_mb=max_mapped_mb, suffix=suffix)
@@ -7,15 +7,24 @@ FITS Functions for IO.
 from astropy.io import fits
 
 
-def get_fitstable_data(filenamepath, memmap=True):
-    """ Return FITS DataTable from file.
+def open_fitstable(filenamepath, memmap=True):
+    """ Return (HDUList, FITS DataTable) so the file handle can be closed later.
 
     FITS Tables are normally located at [1]
     """
+    hdulist = fits.open(filenamepath, memmap=memmap)
     try:
-        return fits.open(filenamepath, memmap=memmap)[1]
+        return hdulist, hdulist[1]
     except:
-        return fits.open(filenamepath, memmap=memmap)[0]
+        return hdulist, hdulist[0]
+
+
+def get_fitstable_data(filenamepath, memmap=True):
+    """ Return FITS DataTable from file.
+
+    FITS Tables are normally located at [1]
+    """
+    return open_fitstable(filenamepath, memmap=memmap)[1]
 
 
 def get_data_counts_fits(data):
@@ -3,20 +3,31 @@ from memory_profiler import profile
 import os
 import numpy as np
 import json
-from .fits import get_fitstable_data, get_data_counts_fits, get_brick_data_types_fits
+from .fits import open_fitstable, get_fitstable_data, get_data_counts_fits, get_brick_data_types_fits
+from .columnar import open_columnar_data, get_columnar_data, get_brick_data_types_columnar
 
 
 # TODO: Implement other filetypes in the future
+# NOTE: 'cols' are native-endian columnar caches of bricks, see columnar.py
 read_fncs = {
-    'fits': get_fitstable_data
+    'fits': get_fitstable_data,
+    'cols': get_columnar_data
+}
+
+# Return (closable handle, table) for files managed by the FilePool
+open_fncs = {
+    'fits': open_fitstable,
+    'cols': open_columnar_data
 }
 
 data_count_fncs = {
-    'fits': get_data_counts_fits
+    'fits': get_data_counts_fits,
+    'cols': get_data_counts_fits  # Columnar tables mimic the header
 }
 
 data_type_fncs = {
-    'fits': get_brick_data_types_fits
+    'fits': get_brick_data_types_fits,
+    'cols': get_brick_data_types_columnar
 }
 
 
@@ -33,18 +44,88 @@ def load_json(filename, savepath='/'):
 
 
 def save_json(dictionary, filename, savepath='/'):
-    """ Save dictionary as json. """
-    with open(savepath+filename, 'w') as f:
+    """ Save dictionary as json.
+
+    Written to a temporary file first and then replaced, hence an interruption
+    never leaves a truncated file behind.
+    """
+    tmp_filepath = savepath+filename+'.tmp'
+    with open(tmp_filepath, 'w') as f:
         json.dump(dictionary, f, sort_keys=True, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, savepath+filename)
     return True
 
 
+def append_json_line(dictionary, filename, savepath='/'):
+    """ Append dictionary as one line of json, flushed to disk immediately. """
+    with open(savepath+filename, 'a') as f:
+        f.write(json.dumps(dictionary, sort_keys=True)+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+
+def load_json_lines(filename, savepath='/'):
+    """ Return list of dictionaries from json lines, skipping incomplete lines.
+
+    An interrupted append leaves at most the last line incomplete.
+    """
+    if filename not in os.listdir(savepath):
+        return []
+    entries = []
+    with open(savepath+filename, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                print("{}: skipping incomplete line".format(filename))
+    return entries
+
+
+# Stored Files
+
+
+def limit_folder_size(dirpath, max_mb):
+    """ Remove least recently used files of folder beyond max_mb (0 for no limit).
+
+    Files are ordered by modification time, hence loading a file should touch it.
+    The most recent file is never removed, even if it alone exceeds max_mb.
+    Temporary files of writes in progress are skipped.
+    """
+    if (not max_mb) or (not os.path.isdir(dirpath)):
+        return 0
+    files = []
+    for entry in os.scandir(dirpath):
+        if (not entry.is_file()) or ('.tmp' in entry.name):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue  # Removed meanwhile
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+    folder_size = sum(file_size for _, file_size, _ in files)
+    removed = 0
+    for _, file_size, filepath in files[:-1]:
+        if folder_size <= max_mb*1024**2:
+            break
+        try:
+            os.remove(filepath)
+            removed += 1
+        except OSError:
+            pass  # Removed meanwhile
+        folder_size -= file_size
+    return removed
+
+
 # Type Handling
 
 
 def get_ftype(filename):
     """ Return file-ending. """
-    return filename.split(".")[-1].lower()
+    return filename.rstrip("/").split(".")[-1].lower()
 
 
 def parse_datatype(value):
@@ -101,6 +182,7 @@ def get_dict_of_files(filename_list, folderpath, memmap=True):
     """ Return dictonary of files to access.
 
     Recognize filetype and use appropriate function to read file
+    NOTE: Opens every file at once, use get_file_pool for large datasets
     """
     return {
         filename: read_fncs[get_ftype(filename)](folderpath+filename, memmap=True)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+"""
+Row Bitmap Functions for IO.
+
+A row bitmap marks the rows of a brick within a selection as sorted, disjoint runs
+[start, stop) of consecutive rows, hence selections of clustered rows (e.g. after
+zone maps, sky boxes, or sorted bricks) take a few runs instead of a flag or row
+number each. Bitmaps of bricks are combined by & (and), | (or), and ~ (not), and
+counted without expanding them to rows:
+
+    bitmaps/<bitmap_id>.npz
+        bricks          -- names of bricks
+        rows            -- rows of each brick
+        source_sizes    -- size of each brick when computed
+        source_mtimes   -- modification time of each brick when computed
+        run_offsets     -- runs of brick i are runs[run_offsets[i]:run_offsets[i+1]]
+        runs            -- array of shape (run_count, 2): [[start, stop], ...]
+"""
+import os
+import re
+import numpy as np
+from collections.abc import Mapping
+from .columnar import get_source_stat
+from .io_tools import limit_folder_size
+
+
+class RowBitmap:
+    """ Rows of one brick as runs [[start, stop], ...] of row_count rows. """
+
+    def __init__(self, runs, row_count):
+        self.runs = np.asarray(runs, dtype=np.int64).reshape(-1, 2)
+        self.row_count = int(row_count)
+
+    @classmethod
+    def from_rows(cls, rows, row_count):
+        """ Return bitmap of row numbers, in any order. """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if not rows.shape[0]:
+            return cls(np.empty((0, 2)), row_count)
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        starts = rows[np.concatenate([[0], breaks])]
+        stops = rows[np.concatenate([breaks - 1, [rows.shape[0] - 1]])] + 1
+        return cls(np.stack([starts, stops], axis=1), row_count)
+
+    @classmethod
+    def from_flags(cls, flags):
+        """ Return bitmap of a boolean array of all rows. """
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], np.asarray(flags, dtype=np.int8), [0]])))
+        return cls(edges.reshape(-1, 2), len(flags))
+
+    def count(self):
+        """ Return number of rows. """
+        return int(np.sum(self.runs[:, 1] - self.runs[:, 0]))
+
+    def to_rows(self):
+        """ Return sorted row numbers. """
+        lengths = self.runs[:, 1] - self.runs[:, 0]
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(self.runs[:, 0] - offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+
+    def get_rows(self, ranks):
+        """ Return row numbers of the rows at ranks (0 for the first row of the bitmap). """
+        ranks = np.asarray(ranks, dtype=np.int64)
+        lengths = self.runs[:, 1] - self.runs[:, 0]
+        stops = np.cumsum(lengths)
+        run = np.searchsorted(stops, ranks, side='right')
+        return self.runs[run, 0] + ranks - (stops[run] - lengths[run])
+
+    def _combine(self, other, min_cover):
+        """ Return rows covered by at least min_cover of both bitmaps (1: or, 2: and). """
+        if self.row_count != other.row_count:
+            raise ValueError("Bitmaps of {} and {} rows".format(self.row_count, other.row_count))
+        bounds = np.concatenate([self.runs.ravel(), other.runs.ravel()])
+        if not bounds.shape[0]:
+            return RowBitmap(self.runs, self.row_count)
+        changes = np.tile([1, -1], bounds.shape[0] // 2)
+        order = np.argsort(bounds, kind='stable')
+        bounds = bounds[order]
+        cover = np.cumsum(changes[order])
+        # Cover from each bound to the next, after all changes at the same bound
+        last = np.concatenate([bounds[1:] != bounds[:-1], [True]])
+        bounds, inside = bounds[last], cover[last] >= min_cover
+        was_inside = np.concatenate([[False], inside[:-1]])
+        return RowBitmap(np.stack([
+            bounds[inside & ~was_inside], bounds[~inside & was_inside]
+        ], axis=1), self.row_count)
+
+    def __and__(self, other):
+        return self._combine(other, 2)
+
+    def __or__(self, other):
+        return self._combine(other, 1)
+
+    def __invert__(self):
+        bounds = np.concatenate([[0], self.runs.ravel(), [self.row_count]]).reshape(-1, 2)
+        return RowBitmap(bounds[bounds[:, 1] > bounds[:, 0]], self.row_count)
+
+    def __eq__(self, other):
+        return (self.row_count == other.row_count) and np.array_equal(self.runs, other.runs)
+
+    def __len__(self):
+        return self.count()
+
+
+class SelectionBitmap(Mapping):
+    """ Dictionary-like access to the RowBitmap of each brick of a selection.
+
+    Combined by & (and), | (or), and ~ (not, within the bricks of the selection),
+    bricks of only one operand are taken as empty in the other.
+    """
+
+    def __init__(self, bitmaps):
+        self._bitmaps = dict(bitmaps)
+
+    def __getitem__(self, brick_name):
+        return self._bitmaps[brick_name]
+
+    def __iter__(self):
+        return iter(self._bitmaps)
+
+    def __len__(self):
+        return len(self._bitmaps)
+
+    def count(self, brick_name=None):
+        """ Return number of rows of brick, or of all bricks. """
+        if brick_name is not None:
+            return self._bitmaps[brick_name].count() if brick_name in self._bitmaps else 0
+        return sum(bitmap.count() for bitmap in self._bitmaps.values())
+
+    def _combine(self, other, combine):
+        brick_names = list(self) + [brick_name for brick_name in other if brick_name not in self]
+        empty = {
+            brick_name: RowBitmap(np.empty((0, 2)), bitmap.row_count)
+            for brick_name, bitmap in list(self.items()) + list(other.items())
+        }
+        return SelectionBitmap({
+            brick_name: combine(self.get(brick_name, empty[brick_name]),
+                                other.get(brick_name, empty[brick_name]))
+            for brick_name in brick_names
+        })
+
+    def __and__(self, other):
+        return self._combine(other, lambda bitmap, other_bitmap: bitmap & other_bitmap)
+
+    def __or__(self, other):
+        return self._combine(other, lambda bitmap, other_bitmap: bitmap | other_bitmap)
+
+    def __invert__(self):
+        return SelectionBitmap({brick_name: ~bitmap for brick_name, bitmap in self.items()})
+
+
+def get_bitmap_path(savepath):
+    """ Return folder containing the stored selection bitmaps. """
+    return savepath + 'bitmaps/'
+
+
+def get_bitmap_filepath(bitmap_id, savepath):
+    """ Return file of bitmap_id, None if not an id (ids come with requests). """
+    if not re.fullmatch(r'[0-9a-f]{40}', bitmap_id or ''):
+        return None
+    return '{}{}.npz'.format(get_bitmap_path(savepath), bitmap_id)
+
+
+def save_selection_bitmap(bitmap, bitmap_id, savepath, folderpath, max_mb=0):
+    """ Store bitmap by id with the size and modification time of its bricks in folderpath.
+
+    Least recently used bitmaps beyond max_mb are removed (0 for no limit).
+    """
+    filepath = get_bitmap_filepath(bitmap_id, savepath)
+    if filepath is None:
+        return False
+    os.makedirs(get_bitmap_path(savepath), exist_ok=True)
+    brick_names = list(bitmap)
+    source_stats = [get_source_stat(folderpath + brick_name) for brick_name in brick_names]
+    runs = [bitmap[brick_name].runs for brick_name in brick_names]
+    tmp_filepath = filepath + '.tmp.npz'
+    np.savez(
+        tmp_filepath,
+        bricks=np.array(brick_names, dtype=str),
+        rows=np.array([bitmap[brick_name].row_count for brick_name in brick_names], dtype=np.int64),
+        source_sizes=np.array([source_stat['source_size'] for source_stat in source_stats], dtype=np.int64),
+        source_mtimes=np.array([source_stat['source_mtime'] for source_stat in source_stats], dtype=np.float64),
+        run_offsets=np.cumsum([0] + [brick_runs.shape[0] for brick_runs in runs]).astype(np.int64),
+        runs=np.concatenate([np.empty((0, 2), dtype=np.int64)] + runs)
+    )
+    os.replace(tmp_filepath, filepath)
+    limit_folder_size(get_bitmap_path(savepath), max_mb)
+    return True
+
+
+def load_selection_bitmap(bitmap_id, savepath, folderpath):
+    """ Return stored bitmap of id, None if unknown or any of its bricks changed since. """
+    filepath = get_bitmap_filepath(bitmap_id, savepath)
+    if filepath is None:
+        return None
+    try:
+        npz = np.load(filepath)
+        # Recently used ones are kept, see limit_folder_size
+        os.utime(filepath)
+    except OSError:
+        return None
+    with npz:
+        bitmaps = {}
+        for i, brick_name in enumerate(npz['bricks']):
+            brick_name = str(brick_name)
+            try:
+                source_stat = get_source_stat(folderpath + brick_name)
+            except OSError:
+                return None
+            if (npz['source_sizes'][i] != source_stat['source_size']) \
+                    or (npz['source_mtimes'][i] != source_stat['source_mtime']):
+                return None
+            bitmaps[brick_name] = RowBitmap(
+                npz['runs'][npz['run_offsets'][i]:npz['run_offsets'][i+1]], npz['rows'][i]
+            )
+    return SelectionBitmap(bitmaps)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+Sorted Index Functions for IO.
+
+A sorted index of a column stores its values in ascending order together with the
+row each value came from, such that a range criterion resolves via binary search:
+
+    sorted_index/<brick_name>/
+        meta.json               -- columns, source_size, source_mtime
+        <col_name>.keys.npy     -- sorted finite values (native-endian)
+        <col_name>.rows.npy     -- row of each value in the brick
+"""
+import os
+import json
+import shutil
+import numpy as np
+from collections.abc import Mapping
+from .columnar import get_source_stat
+
+
+def get_sorted_index_path(savepath):
+    """ Return folder containing the sorted indices of all bricks. """
+    return savepath + 'sorted_index/'
+
+
+def save_sorted_index(column, dirpath, col_name):
+    """ Save sorted keys and rows of one column, NaN and +-inf are left out. """
+    column = np.asarray(column)
+    column = column.astype(column.dtype.newbyteorder('='))
+    rows = np.arange(column.shape[0], dtype=np.int64)
+    if column.dtype.kind == 'f':
+        finite = np.isfinite(column)
+        column = column[finite]
+        rows = rows[finite]
+    order = np.argsort(column, kind='stable')
+    # int32 halves the size for bricks below 2^31 rows
+    if rows.shape[0] and rows[-1] < np.iinfo(np.int32).max:
+        rows = rows.astype(np.int32)
+    np.save('{}{}.keys.npy'.format(dirpath, col_name), column[order])
+    np.save('{}{}.rows.npy'.format(dirpath, col_name), rows[order])
+    return True
+
+
+def save_sorted_index_meta(dirpath, source_filepath, column_list):
+    """ Write meta.json last, hence an interrupted build is never valid. """
+    meta = {
+        'columns': sorted(column_list),
+        **get_source_stat(source_filepath)
+    }
+    with open(dirpath+'meta.json', 'w') as f:
+        json.dump(meta, f, sort_keys=True, indent=4)
+    return meta
+
+
+def reset_sorted_index(dirpath):
+    """ Remove outdated index of brick and create empty folder. """
+    if os.path.isdir(dirpath):
+        shutil.rmtree(dirpath)
+    os.makedirs(dirpath)
+
+
+def load_sorted_index_meta(dirpath):
+    """ Return meta information of sorted index. """
+    with open(dirpath+'meta.json', 'r') as f:
+        return json.load(f)
+
+
+def is_sorted_index_valid(dirpath, source_filepath, column_list):
+    """ Check if sorted index exists, covers all columns, and matches its source. """
+    try:
+        meta = load_sorted_index_meta(dirpath)
+    except (OSError, ValueError):
+        return False
+    source_stat = get_source_stat(source_filepath)
+    return (
+        (meta['source_size'] == source_stat['source_size'])
+        and (meta['source_mtime'] == source_stat['source_mtime'])
+        and all(col_name in meta['columns'] for col_name in column_list)
+    )
+
+
+class BrickSortedIndex(Mapping):
+    """ {col_name: (keys, rows)} of one brick, memory mapped on first access. """
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.column_list = load_sorted_index_meta(dirpath)['columns']
+        self._columns = {}
+
+    def __getitem__(self, col_name):
+        if col_name not in self._columns:
+            if col_name not in self.column_list:
+                raise KeyError(col_name)
+            self._columns[col_name] = (
+                np.load('{}{}.keys.npy'.format(self.dirpath, col_name), mmap_mode='r'),
+                np.load('{}{}.rows.npy'.format(self.dirpath, col_name), mmap_mode='r')
+            )
+        return self._columns[col_name]
+
+    def __contains__(self, col_name):
+        return col_name in self.column_list
+
+    def __iter__(self):
+        return iter(self.column_list)
+
+    def __len__(self):
+        return len(self.column_list)
+
+
+class SortedIndices(Mapping):
+    """ Dictionary-like access to sorted indices of bricks, loaded on first access. """
+
+    def __init__(self, folderpath):
+        self.folderpath = folderpath
+        self._indices = {}
+
+    def _dirpath(self, brick_name):
+        return '{}{}/'.format(self.folderpath, brick_name)
+
+    def __getitem__(self, brick_name):
+        if brick_name not in self._indices:
+            try:
+                self._indices[brick_name] = BrickSortedIndex(self._dirpath(brick_name))
+            except (OSError, ValueError):
+                raise KeyError(brick_name)
+        return self._indices[brick_name]
+
+    def __contains__(self, brick_name):
+        return (brick_name in self._indices) \
+            or os.path.isfile(self._dirpath(brick_name)+'meta.json')
+
+    def __iter__(self):
+        if not os.path.isdir(self.folderpath):
+            return iter([])
+        return iter([
+            brick_name for brick_name in sorted(os.listdir(self.folderpath))
+            if brick_name in self
+        ])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+def get_sorted_indices(savepath):
+    """ Return SortedIndices of all bricks in savepath. """
+    return SortedIndices(get_sorted_index_path(savepath))
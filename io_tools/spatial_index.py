@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Spatial Index Functions for IO.
+
+A spatial index bins the rows of a brick into square cells of a fixed grid over two
+columns (e.g. RA, DEC), such that a box on the sky only looks at rows of the cells
+intersecting it. The grid is absolute (cell = floor(value/cell_size)), hence cells
+line up across bricks and adding a brick does not invalidate the others:
+
+    spatial_index/<brick_name>.npz
+        cell_x, cell_y      -- grid coordinates of each non-empty cell, sorted
+        offsets             -- rows of cell i are  rows[offsets[i]:offsets[i+1]]
+        rows                -- rows of the brick grouped by cell, ascending within
+        __columns__         -- [x column, y column]
+        __cell_size__       -- cell width in units of the columns
+        __source_size__     -- size of brick when computed
+        __source_mtime__    -- modification time of brick when computed
+"""
+import os
+import numpy as np
+from collections.abc import Mapping
+from .columnar import get_source_stat
+
+
+def get_spatial_index_path(savepath):
+    """ Return folder containing the spatial indices of all bricks. """
+    return savepath + 'spatial_index/'
+
+
+def get_cells(values, cell_size):
+    """ Return grid coordinate of each value. """
+    return np.floor(np.asarray(values, dtype=np.float64)/cell_size).astype(np.int64)
+
+
+def save_spatial_index(x_column, y_column, filepath, source_filepath, column_list, cell_size):
+    """ Bin rows into cells of cell_size and save, rows with NaN or +-inf are left out. """
+    x_column = np.asarray(x_column, dtype=np.float64)
+    y_column = np.asarray(y_column, dtype=np.float64)
+    rows = np.flatnonzero(np.isfinite(x_column) & np.isfinite(y_column))
+    cell_x = get_cells(x_column[rows], cell_size)
+    cell_y = get_cells(y_column[rows], cell_size)
+    # Stable sort: rows stay ascending within each cell
+    order = np.lexsort((cell_y, cell_x))
+    rows, cell_x, cell_y = rows[order], cell_x[order], cell_y[order]
+    is_first = np.ones(rows.shape[0], dtype=np.bool_)
+    is_first[1:] = (cell_x[1:] != cell_x[:-1]) | (cell_y[1:] != cell_y[:-1])
+    starts = np.flatnonzero(is_first)
+    # int32 halves the size for bricks below 2^31 rows
+    if rows.shape[0] and rows.max() < np.iinfo(np.int32).max:
+        rows = rows.astype(np.int32)
+    source_stat = get_source_stat(source_filepath)
+    tmp_filepath = filepath + '.tmp.npz'
+    np.savez(
+        tmp_filepath,
+        cell_x=cell_x[starts],
+        cell_y=cell_y[starts],
+        offsets=np.append(starts, rows.shape[0]),
+        rows=rows,
+        __columns__=np.array(column_list),
+        __cell_size__=cell_size,
+        __source_size__=source_stat['source_size'],
+        __source_mtime__=source_stat['source_mtime']
+    )
+    os.replace(tmp_filepath, filepath)
+    return True
+
+
+def load_spatial_index(filepath):
+    """ Return {'columns', 'cell_size', 'cell_x', 'cell_y', 'offsets', 'rows', ...}. """
+    with np.load(filepath) as npz:
+        return {
+            'columns': [str(col_name) for col_name in npz['__columns__']],
+            'cell_size': float(npz['__cell_size__']),
+            'source_size': int(npz['__source_size__']),
+            'source_mtime': float(npz['__source_mtime__']),
+            'cell_x': npz['cell_x'],
+            'cell_y': npz['cell_y'],
+            'offsets': npz['offsets'],
+            'rows': npz['rows']
+        }
+
+
+def is_spatial_index_valid(filepath, source_filepath, column_list, cell_size):
+    """ Check if spatial index exists, uses the same grid, and matches its source. """
+    try:
+        spatial_index = load_spatial_index(filepath)
+    except (OSError, KeyError, ValueError):
+        return False
+    source_stat = get_source_stat(source_filepath)
+    return (
+        (spatial_index['columns'] == list(column_list))
+        and (spatial_index['cell_size'] == cell_size)
+        and (spatial_index['source_size'] == source_stat['source_size'])
+        and (spatial_index['source_mtime'] == source_stat['source_mtime'])
+    )
+
+
+class SpatialIndices(Mapping):
+    """ Dictionary-like access to spatial indices of bricks, loaded on first access. """
+
+    def __init__(self, folderpath):
+        self.folderpath = folderpath
+        self._spatial_indices = {}
+
+    def _filepath(self, brick_name):
+        return '{}{}.npz'.format(self.folderpath, brick_name)
+
+    def __getitem__(self, brick_name):
+        if brick_name not in self._spatial_indices:
+            try:
+                self._spatial_indices[brick_name] = load_spatial_index(self._filepath(brick_name))
+            except OSError:
+                raise KeyError(brick_name)
+        return self._spatial_indices[brick_name]
+
+    def __contains__(self, brick_name):
+        return (brick_name in self._spatial_indices) or os.path.isfile(self._filepath(brick_name))
+
+    def __iter__(self):
+        if not os.path.isdir(self.folderpath):
+            return iter([])
+        return iter([
+            filename[:-len('.npz')]
+            for filename in sorted(os.listdir(self.folderpath))
+            if filename.endswith('.npz')
+        ])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+def get_spatial_indices(savepath):
+    """ Return SpatialIndices of all bricks in savepath. """
+    return SpatialIndices(get_spatial_index_path(savepath))
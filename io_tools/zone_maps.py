@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+"""
+Zone Map Functions for IO.
+
+A zone map stores minimum and maximum of each column for consecutive blocks of rows
+of a brick, such that range criteria only need to look at blocks overlapping them:
+
+    zone_maps/<brick_name>.npz
+        <col_name>          -- array of shape (block_count, 2): [[min, max], ...]
+        __block_rows__      -- rows per block
+        __rows__            -- rows of brick
+        __source_size__     -- size of brick when computed
+        __source_mtime__    -- modification time of brick when computed
+"""
+import os
+import numpy as np
+from collections.abc import Mapping
+from .columnar import get_source_stat
+
+
+meta_keys = ['__block_rows__', '__rows__', '__source_size__', '__source_mtime__']
+
+
+def get_zone_map_path(savepath):
+    """ Return folder containing the zone maps of all bricks. """
+    return savepath + 'zone_maps/'
+
+
+def save_zone_map(zone_map, filepath, source_filepath, block_rows, row_count):
+    """ Save {col_name: (block_count, 2) array} with meta information. """
+    source_stat = get_source_stat(source_filepath)
+    tmp_filepath = filepath + '.tmp.npz'
+    np.savez(
+        tmp_filepath,
+        __block_rows__=block_rows,
+        __rows__=row_count,
+        __source_size__=source_stat['source_size'],
+        __source_mtime__=source_stat['source_mtime'],
+        **zone_map
+    )
+    os.replace(tmp_filepath, filepath)
+    return True
+
+
+def load_zone_map(filepath):
+    """ Return {'block_rows': int, 'rows': int, 'columns': {col_name: array}}. """
+    with np.load(filepath) as npz:
+        return {
+            'block_rows': int(npz['__block_rows__']),
+            'rows': int(npz['__rows__']),
+            'source_size': int(npz['__source_size__']),
+            'source_mtime': float(npz['__source_mtime__']),
+            'columns': {
+                key: npz[key]
+                for key in npz.files
+                if key not in meta_keys
+            }
+        }
+
+
+def is_zone_map_valid(filepath, source_filepath, column_list, block_rows):
+    """ Check if zone map exists, covers all columns, and matches its source file. """
+    try:
+        zone_map = load_zone_map(filepath)
+    except (OSError, KeyError, ValueError):
+        return False
+    source_stat = get_source_stat(source_filepath)
+    return (
+        (zone_map['block_rows'] == block_rows)
+        and (zone_map['source_size'] == source_stat['source_size'])
+        and (zone_map['source_mtime'] == source_stat['source_mtime'])
+        and all(col_name in zone_map['columns'] for col_name in column_list)
+    )
+
+
+class ZoneMaps(Mapping):
+    """ Dictionary-like access to zone maps of bricks, loaded on first access.
+
+    Bricks without a zone map are not contained, e.g. zone_maps.get(brick_name)
+    """
+
+    def __init__(self, folderpath):
+        self.folderpath = folderpath
+        self._zone_maps = {}
+
+    def _filepath(self, brick_name):
+        return '{}{}.npz'.format(self.folderpath, brick_name)
+
+    def __getitem__(self, brick_name):
+        if brick_name not in self._zone_maps:
+            try:
+                self._zone_maps[brick_name] = load_zone_map(self._filepath(brick_name))
+            except OSError:
+                raise KeyError(brick_name)
+        return self._zone_maps[brick_name]
+
+    def __contains__(self, brick_name):
+        return (brick_name in self._zone_maps) or os.path.isfile(self._filepath(brick_name))
+
+    def __iter__(self):
+        if not os.path.isdir(self.folderpath):
+            return iter([])
+        return iter([
+            filename[:-len('.npz')]
+            for filename in sorted(os.listdir(self.folderpath))
+            if filename.endswith('.npz')
+        ])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+def get_zone_maps(savepath):
+    """ Return ZoneMaps of all bricks in savepath. """
+    return ZoneMaps(get_zone_map_path(savepath))
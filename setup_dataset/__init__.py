@@ -3,4 +3,15 @@
 setup_functions for FIDS
 """
 
-from .get_file_info import prepare_brick_info, get_missing_brick_info
+from .get_file_info import prepare_brick_info, get_missing_brick_info, load_brick_column_details
+from .column_stats import get_column_stats, get_brick_column_stats
+from .column_cache import prepare_column_cache, get_column_cache_path, get_column_cache_suffix
+from .column_cache import prepare_sample_cache, get_sample_cache_path
+from .manifest import update_manifest, get_manifest_data_counts, get_manifest_data_types
+from .manifest import get_manifest_column_names, get_column_details_key
+from .manifest import get_manifest_column_details, set_manifest_column_details
+from .zone_maps import prepare_zone_maps
+from .sorted_index import prepare_sorted_indices
+from .spatial_index import prepare_spatial_indices
+from .derived_columns import prepare_derived_columns, check_derived_columns, get_derived_data_types
+from .derived_columns import reset_derived_indices
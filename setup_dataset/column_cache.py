@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Convert bricks to native-endian columnar caches for faster slicing in FIDS.
+"""
+import numpy as np
+from io_tools import save_columnar_data, is_columnar_valid
+from tqdm import tqdm
+
+
+def get_column_cache_path(savepath):
+    """ Return folder containing the columnar caches of all bricks. """
+    return savepath + 'columns/'
+
+
+def get_column_cache_suffix():
+    """ Return suffix appended to brick names for their columnar cache. """
+    return '.cols/'
+
+
+def prepare_column_cache(data, brick_name_list, column_list, folderpath, savepath,
+                         chunk_rows=65536):
+    """ Write columnar cache for each brick where missing or outdated.
+
+    One-time conversion of FITS (big-endian, encoded strings) to native-endian,
+    decoded .npy columns, hence comparisons and gathers on a column never have
+    to byte-swap or decode again.
+    Returns list of bricks which were (re-)converted.
+    """
+    cache_path = get_column_cache_path(savepath)
+    converted = []
+    for brick_name in tqdm(brick_name_list):
+        dirpath = cache_path + brick_name + get_column_cache_suffix()
+        filepath = folderpath + brick_name
+        if is_columnar_valid(dirpath, filepath, column_list):
+            continue
+        print("  converting {}".format(brick_name))
+        save_columnar_data(data[brick_name], filepath, dirpath, column_list,
+                           chunk_rows=chunk_rows)
+        converted.append(brick_name)
+    return converted
+
+
+def get_sample_cache_path(savepath):
+    """ Return folder containing the shuffled columnar copies of all bricks. """
+    return savepath + 'shuffled/'
+
+
+def prepare_sample_cache(data, brick_name_list, column_list, folderpath, savepath,
+                         chunk_rows=65536, seed=0):
+    """ Write columnar copy in random row order for each brick where missing or outdated.
+
+    Any window of consecutive rows of a shuffled brick is a random sample, hence
+    sampling reads sequentially instead of gathering random rows across the file.
+    Returns list of bricks which were (re-)shuffled.
+    """
+    cache_path = get_sample_cache_path(savepath)
+    shuffled = []
+    for brick_name in tqdm(brick_name_list):
+        dirpath = cache_path + brick_name + get_column_cache_suffix()
+        filepath = folderpath + brick_name
+        if is_columnar_valid(dirpath, filepath, column_list):
+            continue
+        print("  shuffling {}".format(brick_name))
+        row_count = data[brick_name].header['NAXIS2']
+        row_order = np.random.RandomState(seed).permutation(row_count)
+        save_columnar_data(data[brick_name], filepath, dirpath, column_list,
+                           chunk_rows=chunk_rows, row_order=row_order)
+        shuffled.append(brick_name)
+    return shuffled
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked computation of column statistics for setting up FIDS.
+"""
+import numpy as np
+from io_tools import parse_datatype, get_ftype
+from io_tools.io_tools import open_fncs
+
+
+def get_column_stats(table_data, column_list, row_count, chunk_rows=65536, bins=0,
+                     sample_rows=65536):
+    """ Return {col_name: {'min': min, 'max': max}} from one pass over the rows.
+
+    Reads the table in chunks of rows for all columns together, instead of reading
+    each column twice (.min() and .max()), hence
+    - FITS stores rows contiguously, so each chunk is one sequential read
+    - memory is bounded by chunk_rows, no column is materialized entirely
+    NaN and +-inf are skipped. Columns without any finite value get NaN limits.
+    With bins, adds 'quantiles': bins+1 edges of an equi-depth histogram, i.e. each
+    bin holds the same fraction of values. Estimated from every n-th row (about
+    sample_rows per column) within the same pass, which unlike evenly spaced bins
+    resolves skewed columns (e.g. chi2min, where most values fall in the first bin).
+    """
+    minimums = {}
+    maximums = {}
+    samples = {col_name: [] for col_name in column_list}
+    sample_step = max(1, row_count//sample_rows)
+    for start in range(0, row_count, chunk_rows):
+        rows = table_data[start:start+chunk_rows]
+        # Offset keeps the sample step continuous across chunks
+        sample_offset = (-start) % sample_step
+        for col_name in column_list:
+            chunk = rows[col_name]
+            if bins:
+                sample = np.array(chunk[sample_offset::sample_step])
+                if sample.dtype.kind == 'f':
+                    sample = sample[np.isfinite(sample)]
+                samples[col_name].append(sample)
+            if chunk.dtype.kind == 'f':
+                chunk = chunk[np.isfinite(chunk)]
+            if not chunk.shape[0]:
+                continue
+            chunk_min = chunk.min()
+            chunk_max = chunk.max()
+            if (col_name not in minimums) or (chunk_min < minimums[col_name]):
+                minimums[col_name] = chunk_min
+            if (col_name not in maximums) or (chunk_max > maximums[col_name]):
+                maximums[col_name] = chunk_max
+    column_stats = {
+        col_name: {
+            'min': parse_datatype(minimums.get(col_name, np.nan)),
+            'max': parse_datatype(maximums.get(col_name, np.nan))
+        }
+        for col_name in column_list
+    }
+    if bins:
+        for col_name in column_stats.keys():
+            column_stats[col_name]['quantiles'] = get_quantiles(
+                np.concatenate(samples[col_name]),
+                column_stats[col_name]['min'],
+                column_stats[col_name]['max'],
+                bins
+            )
+    return column_stats
+
+
+def get_quantiles(sample, minimum, maximum, bins):
+    """ Return bins+1 edges of an equi-depth histogram with exact outer edges. """
+    if sample.shape[0]:
+        quantiles = np.quantile(sample.astype(np.float64), np.linspace(0, 1, bins+1))
+    else:
+        quantiles = np.linspace(minimum, maximum, bins+1)
+    quantiles[0] = minimum
+    quantiles[-1] = maximum
+    return [float(edge) for edge in np.maximum.accumulate(quantiles)]
+
+
+def get_brick_column_stats(filepath, column_list, chunk_rows=65536, bins=0):
+    """ Return get_column_stats of a file, opening and closing it within the call.
+
+    Used by worker processes, as open memory maps cannot be sent between processes.
+    """
+    handle, table = open_fncs[get_ftype(filepath)](filepath, memmap=True)
+    try:
+        return get_column_stats(table.data, column_list, table.header['NAXIS2'],
+                                chunk_rows=chunk_rows, bins=bins)
+    finally:
+        handle.close()
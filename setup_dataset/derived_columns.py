@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Compute derived columns (named expressions of columns) of bricks for FIDS.
+"""
+import os
+import shutil
+import numpy as np
+from io_tools import get_derived_column_path, is_derived_columns_valid
+from io_tools import reset_derived_columns, save_derived_columns_meta
+from io_tools.derived_columns import DerivedData
+from io_tools import get_zone_map_path, get_sorted_index_path, get_spatial_index_path
+from data_tools import evaluate_expressions
+from data_tools.expressions import parse_expression, is_predicate
+from .column_stats import get_column_stats
+from tqdm import tqdm
+
+
+def get_derived_data_types(derived_columns):
+    """ Return {col_name: dtype} of derived columns, boolean for comparisons. """
+    return {
+        col_name: '|b1' if is_predicate(parse_expression(expression)) else '<f8'
+        for col_name, expression in derived_columns.items()
+    }
+
+
+def check_derived_columns(derived_columns, column_names, brick_data_types):
+    """ Return {col_name: expression} of allowed derived columns, printing the others.
+
+    Derived columns only use numeric columns of the bricks, not each other, and do
+    not replace them.
+    """
+    numeric_col_list = [
+        col_name for col_name in column_names
+        if np.dtype(brick_data_types[col_name]).kind in 'biuf'
+    ]
+    checked = {}
+    for col_name, expression in derived_columns.items():
+        if col_name in brick_data_types:
+            print("  Derived column '{}' already exists".format(col_name))
+            continue
+        try:
+            parse_expression(expression, numeric_col_list)
+        except ValueError as error:
+            print("  Derived column '{}': {}".format(col_name, error))
+            continue
+        checked[col_name] = expression
+    return checked
+
+
+def prepare_derived_columns(data, brick_name_list, derived_columns, folderpath, savepath,
+                            chunk_rows=65536, hist_bins=0):
+    """ Compute derived columns of each brick where missing, outdated, or changed.
+
+    Expressions are evaluated on chunks of rows (see evaluate_expressions) and
+    written into memory mapped .npy files, hence memory is bounded by chunk_rows.
+    Minimum, maximum (and quantiles) are computed from the written columns and
+    stored with them, see get_derived_column_details.
+    Returns list of bricks which were (re-)computed.
+    """
+    derived_path = get_derived_column_path(savepath)
+    expression_list = list(derived_columns.values())
+    dtypes = get_derived_data_types(derived_columns)
+    computed = []
+    for brick_name in tqdm(brick_name_list):
+        dirpath = derived_path + brick_name + '/'
+        source_filepath = folderpath + brick_name
+        if is_derived_columns_valid(dirpath, source_filepath, derived_columns):
+            continue
+        reset_derived_columns(dirpath)
+        table_data = data[brick_name].data
+        row_count = data[brick_name].header['NAXIS2']
+        columns = {
+            col_name: np.lib.format.open_memmap(
+                '{}{}.npy'.format(dirpath, col_name),
+                mode='w+', dtype=np.dtype(dtypes[col_name]), shape=(row_count,)
+            )
+            for col_name in derived_columns
+        }
+        for start in range(0, row_count, chunk_rows):
+            values_list = evaluate_expressions(
+                table_data[start:start+chunk_rows], expression_list
+            )
+            for col_name, values in zip(derived_columns, values_list):
+                columns[col_name][start:start+chunk_rows] = values
+        for column in columns.values():
+            column.flush()
+        del columns
+        column_stats = get_column_stats(
+            DerivedData(table_data, dirpath, dtypes),
+            [col_name for col_name in derived_columns if dtypes[col_name] == '<f8'],
+            row_count, chunk_rows=chunk_rows, bins=hist_bins
+        )
+        save_derived_columns_meta(dirpath, source_filepath, derived_columns, dtypes,
+                                  row_count, column_stats)
+        computed.append(brick_name)
+    return computed
+
+
+def reset_derived_indices(brick_name_list, savepath):
+    """ Remove zone maps and indices of bricks, e.g. after their derived columns changed.
+
+    These are only checked against the brick file, which does not change when the
+    expression of a derived column does. Removed ones are rebuilt by prepare_zone_maps,
+    prepare_sorted_indices, and prepare_spatial_indices.
+    """
+    for brick_name in brick_name_list:
+        for filepath in [
+                '{}{}.npz'.format(get_zone_map_path(savepath), brick_name),
+                '{}{}.npz'.format(get_spatial_index_path(savepath), brick_name)]:
+            if os.path.isfile(filepath):
+                os.remove(filepath)
+        dirpath = '{}{}/'.format(get_sorted_index_path(savepath), brick_name)
+        if os.path.isdir(dirpath):
+            shutil.rmtree(dirpath)
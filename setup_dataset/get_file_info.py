@@ -2,13 +2,35 @@
 """
 Tools for processing files to get relevant meta information for setting up FIDS.
 """
+import os
+import multiprocessing
+import numpy as np
 from pprint import pprint
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io_tools import save_json, load_json, parse_datatype, get_brick_data_types
+from io_tools import append_json_line, load_json_lines
 from tqdm import tqdm
+from .column_stats import get_column_stats, get_brick_column_stats
 
 
-def get_missing_column_dict(brick_name_list, brick_column_details, column_list):
-    """ Return dict of lists showing missing columns for each key. """
+details_filename = 'brick_column_details.json'
+# Bricks finished since the last full save, one json line each
+details_journal_filename = 'brick_column_details.jsonl'
+
+
+def load_brick_column_details(savepath):
+    """ Return brick column details including bricks finished by an interrupted setup. """
+    brick_column_details = load_json(details_filename, savepath=savepath)
+    for entry in load_json_lines(details_journal_filename, savepath=savepath):
+        brick_column_details.setdefault(entry['brick'], {}).update(entry['details'])
+    return brick_column_details
+
+
+def get_missing_column_dict(brick_name_list, brick_column_details, column_list, hist_bins=0):
+    """ Return dict of lists showing missing columns for each key.
+
+    With hist_bins, columns without quantiles for that many bins are missing too.
+    """
     # Get missing_columns for each file
     missing_column_dict = {}
     for brick_name in brick_name_list:
@@ -26,7 +48,8 @@ def get_missing_column_dict(brick_name_list, brick_column_details, column_list):
                 column
                 for column in brick_column_details[brick_name]
                 if ('max' not in brick_column_details[brick_name][column] \
-                    or 'min' not in brick_column_details[brick_name][column]) \
+                    or 'min' not in brick_column_details[brick_name][column] \
+                    or (hist_bins and len(brick_column_details[brick_name][column].get('quantiles', [])) != hist_bins+1)) \
                     and (column in column_list)
             ]
         if not len(missing_column_dict[brick_name]):
@@ -35,48 +58,98 @@ def get_missing_column_dict(brick_name_list, brick_column_details, column_list):
     return missing_column_dict
 
 
-def get_missing_brick_info(data, brick_column_details, missing_column_dict, savepath):
-    """ Get missing minimum, maximum for brick_column_details. """
-    # Compute all columns missing for each brick
+def get_missing_brick_info(data, brick_column_details, missing_column_dict, savepath,
+                           chunk_rows=65536, folderpath='', processes=1, hist_bins=0):
+    """ Get missing minimum, maximum (and quantiles) for brick_column_details.
+
+    All missing columns of a brick are computed in one chunked pass, see get_column_stats.
+    With processes other than 1 (0: all cores), bricks are distributed over a process
+    pool, which requires folderpath as workers open files themselves.
+    Each finished brick is appended to a journal instead of rewriting the whole json,
+    the journal is merged into the json once at the end (see load_brick_column_details)
+    """
     added_info = False
-    # Loop over Files
-    for brick_name in missing_column_dict.keys():
-        print(brick_name)
-        # Add it not present already
+    brick_name_list = list(missing_column_dict.keys())
+    # Add it not present already
+    for brick_name in brick_name_list:
         if brick_name not in brick_column_details.keys():
             brick_column_details[brick_name] = {}
-        # Loop over Columns
-        for col_name in tqdm(missing_column_dict[brick_name]):
-            brick_column_details[brick_name][col_name] = {}
-            try:
-                minimum = data[brick_name].data[col_name].min()
-                brick_column_details[brick_name][col_name]['min'] = parse_datatype(minimum)
-                added_info = True
-            except Exception as e:
-                print(brick_name, e)
+
+    def store(brick_name, column_stats):
+        """ Assign and journal stats of one brick. """
+        details = {
+            col_name: column_stats[col_name]
+            for col_name in missing_column_dict[brick_name]
+        }
+        for col_name in details.keys():
+            if np.isnan(details[col_name]['min']):
+                print(brick_name, "{} has no finite values".format(col_name))
+        brick_column_details[brick_name].update(details)
+        append_json_line(
+            {'brick': brick_name, 'details': details},
+            details_journal_filename, savepath=savepath
+        )
+        return bool(column_stats)
+
+    # NOTE: Only forked workers, spawned ones would re-import (and re-run) FIDS.py
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        processes = 1
+    # Serial
+    if (processes == 1) or (not folderpath):
+        for brick_name in tqdm(brick_name_list):
             try:
-                maximum = data[brick_name].data[col_name].max()
-                brick_column_details[brick_name][col_name]['max'] = parse_datatype(maximum)
-                added_info = True
+                column_stats = get_column_stats(
+                    data[brick_name].data,
+                    missing_column_dict[brick_name],
+                    data[brick_name].header['NAXIS2'],
+                    chunk_rows=chunk_rows,
+                    bins=hist_bins
+                )
             except Exception as e:
                 print(brick_name, e)
-        # Save updates from file
-        if added_info:
-            save_json(brick_column_details, 'brick_column_details.json', savepath=savepath)
-            added_info = False
-    # Save at end just in case
+                continue
+            added_info = store(brick_name, column_stats) or added_info
+    # Parallel
+    else:
+        with ProcessPoolExecutor(max_workers=(processes or os.cpu_count()),
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            futures = {
+                executor.submit(
+                    get_brick_column_stats,
+                    folderpath+brick_name,
+                    missing_column_dict[brick_name],
+                    chunk_rows,
+                    hist_bins
+                ): brick_name
+                for brick_name in brick_name_list
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                brick_name = futures[future]
+                try:
+                    column_stats = future.result()
+                except Exception as e:
+                    print(brick_name, e)
+                    continue
+                added_info = store(brick_name, column_stats) or added_info
+    # Merge journal into details, then drop it
     if added_info:
-        save_json(brick_column_details, 'brick_column_details.json', savepath=savepath)
+        save_json(brick_column_details, details_filename, savepath=savepath)
+        os.remove(savepath+details_journal_filename)
     return brick_column_details
 
 
 def prepare_brick_info(data, brick_column_details, brick_name_list, column_list, savepath,
-                       acceptable_types=['>f8', '>f4', '>i8', '>i4']):
-    """ Return full brick column details, updates where necessary. """
+                       acceptable_types=['>f8', '>f4', '>i8', '>i4'], brick_data_types=None,
+                       chunk_rows=65536, folderpath='', processes=1, hist_bins=0):
+    """ Return full brick column details, updates where necessary.
+
+    brick_data_types can be passed (e.g. from the manifest) to avoid opening a file.
+    """
     if not brick_column_details.keys():
         print("Setting up dataset...")
     # Setup types
-    brick_data_types = get_brick_data_types(data, list(data.keys()), ftype='')
+    if not brick_data_types:
+        brick_data_types = get_brick_data_types(data, list(data.keys()), ftype='')
     acceptable_col_list = [
         col_name
         for col_name in column_list
@@ -84,12 +157,14 @@ def prepare_brick_info(data, brick_column_details, brick_name_list, column_list,
     ]
     # Determine exactly what is missing
     missing_column_dict = get_missing_column_dict(
-        brick_name_list, brick_column_details, acceptable_col_list
+        brick_name_list, brick_column_details, acceptable_col_list, hist_bins=hist_bins
     )
     # Update when necessary
     if missing_column_dict:
         print(missing_column_dict)
         brick_column_details = get_missing_brick_info(
-            data, brick_column_details, missing_column_dict, savepath
+            data, brick_column_details, missing_column_dict, savepath,
+            chunk_rows=chunk_rows, folderpath=folderpath, processes=processes,
+            hist_bins=hist_bins
         )
     return brick_column_details
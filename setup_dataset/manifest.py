@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Startup manifest for FIDS.
+
+Keeps size, modification time, row count, and data types of every brick, such that
+a restart only needs one stat() per file instead of opening every file again:
+
+    {
+        "bricks": {
+            "file_name.fits": {
+                "source_size": 0, "source_mtime": 0.0,
+                "rows": 0, "dtypes": {"column_name": ">f8"}
+            }
+        },
+        "column_details_key": "...",
+        "column_details": {"column_name": {"min": 0, "max": 1}}
+    }
+"""
+import os
+import json
+import hashlib
+from io_tools import get_brick_data_types, get_data_counts, get_ftype
+from io_tools.columnar import get_source_stat
+
+
+def update_manifest(manifest, data, brick_name_list, folderpath):
+    """ Return (manifest, changed_bricks, new_bricks) after checking files against it.
+
+    Only bricks whose size or modification time changed, or which are new, are
+    opened to read their row count and data types.
+    changed_bricks  -- bricks known before whose file changed: details are outdated
+    new_bricks      -- bricks not in the manifest before
+    """
+    manifest_bricks = manifest.get('bricks', {})
+    updated_bricks = {}
+    changed_bricks = []
+    new_bricks = []
+    for brick_name in brick_name_list:
+        source_stat = get_source_stat(folderpath+brick_name)
+        entry = manifest_bricks.get(brick_name, {})
+        if (entry.get('source_size') == source_stat['source_size']) \
+                and (entry.get('source_mtime') == source_stat['source_mtime']):
+            updated_bricks[brick_name] = entry
+            continue
+        # Re-read brick
+        if entry:
+            changed_bricks.append(brick_name)
+        else:
+            new_bricks.append(brick_name)
+        updated_bricks[brick_name] = {
+            **source_stat,
+            'rows': int(get_data_counts({brick_name: data[brick_name]}, get_ftype(brick_name))[brick_name]),
+            'dtypes': get_brick_data_types(data, [brick_name])
+        }
+    manifest = {
+        **manifest,
+        'bricks': updated_bricks
+    }
+    # Removed files invalidate as well
+    if changed_bricks or new_bricks or (set(manifest_bricks.keys()) != set(brick_name_list)):
+        manifest.pop('column_details_key', None)
+        manifest.pop('column_details', None)
+    return manifest, changed_bricks, new_bricks
+
+
+def get_manifest_data_counts(manifest, brick_name_list):
+    """ Return {brick_name: row_count}, analogous to get_data_counts. """
+    return {
+        brick_name: manifest['bricks'][brick_name]['rows']
+        for brick_name in brick_name_list
+    }
+
+
+def get_manifest_data_types(manifest, brick_name_list):
+    """ Return dict of column data types, analogous to get_brick_data_types.
+    Assumes homogeneous data structure
+    """
+    return dict(manifest['bricks'][brick_name_list[0]]['dtypes'])
+
+
+def get_manifest_column_names(manifest, brick_name_list):
+    """ Return column names of the first brick. """
+    return list(manifest['bricks'][brick_name_list[0]]['dtypes'].keys())
+
+
+def get_column_details_key(brick_name_list, column_list, details_filepath, derived_columns={}):
+    """ Return key identifying the inputs the combined column details depend on.
+
+    derived_columns -- {col_name: expression}, whose details are stored with them
+    """
+    try:
+        details_mtime = os.stat(details_filepath).st_mtime
+    except OSError:
+        details_mtime = 0
+    key_inputs = [sorted(brick_name_list), sorted(column_list), details_mtime]
+    if derived_columns:
+        key_inputs.append(derived_columns)
+    return hashlib.md5(json.dumps(key_inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_manifest_column_details(manifest, column_details_key):
+    """ Return stored combined column details if still valid, otherwise {}. """
+    if manifest.get('column_details_key') == column_details_key:
+        return manifest.get('column_details', {})
+    return {}
+
+
+def set_manifest_column_details(manifest, column_details_key, column_details):
+    """ Store combined column details with the key they are valid for. """
+    manifest['column_details_key'] = column_details_key
+    manifest['column_details'] = column_details
+    return manifest
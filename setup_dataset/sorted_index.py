@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Build sorted secondary indices of chosen columns for FIDS.
+"""
+from io_tools import get_sorted_index_path, is_sorted_index_valid
+from io_tools import reset_sorted_index, save_sorted_index, save_sorted_index_meta
+from tqdm import tqdm
+
+
+def prepare_sorted_indices(data, brick_name_list, column_list, folderpath, savepath):
+    """ Build sorted index of each column for each brick where missing or outdated.
+
+    NOTE: Sorting requires one column of a brick in memory at a time
+    Returns list of bricks which were (re-)indexed.
+    """
+    sorted_index_path = get_sorted_index_path(savepath)
+    indexed = []
+    for brick_name in tqdm(brick_name_list):
+        dirpath = sorted_index_path + brick_name + '/'
+        source_filepath = folderpath + brick_name
+        if is_sorted_index_valid(dirpath, source_filepath, column_list):
+            continue
+        reset_sorted_index(dirpath)
+        for col_name in column_list:
+            save_sorted_index(data[brick_name].data[col_name], dirpath, col_name)
+        save_sorted_index_meta(dirpath, source_filepath, column_list)
+        indexed.append(brick_name)
+    return indexed
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Bin rows of bricks into a spatial grid (e.g. RA, DEC) for FIDS.
+"""
+import os
+from io_tools import get_spatial_index_path, is_spatial_index_valid, save_spatial_index
+from tqdm import tqdm
+
+
+def prepare_spatial_indices(data, brick_name_list, column_list, folderpath, savepath,
+                            cell_size):
+    """ Build spatial index of [x column, y column] for each brick where missing or outdated.
+
+    NOTE: Binning requires both columns of a brick in memory at a time
+    Returns list of bricks which were (re-)indexed.
+    """
+    spatial_index_path = get_spatial_index_path(savepath)
+    if not os.path.isdir(spatial_index_path):
+        os.makedirs(spatial_index_path)
+    indexed = []
+    for brick_name in tqdm(brick_name_list):
+        filepath = '{}{}.npz'.format(spatial_index_path, brick_name)
+        source_filepath = folderpath + brick_name
+        if is_spatial_index_valid(filepath, source_filepath, column_list, cell_size):
+            continue
+        save_spatial_index(
+            data[brick_name].data[column_list[0]],
+            data[brick_name].data[column_list[1]],
+            filepath, source_filepath, column_list, cell_size
+        )
+        indexed.append(brick_name)
+    return indexed
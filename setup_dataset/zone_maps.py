@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Compute zone maps (minimum, maximum per block of rows) of bricks for FIDS.
+"""
+import os
+import numpy as np
+from io_tools import save_zone_map, is_zone_map_valid, get_zone_map_path
+from tqdm import tqdm
+
+
+def get_zone_map(table_data, column_list, row_count, block_rows=65536):
+    """ Return {col_name: array of [min, max] per block of rows}.
+
+    Reads one block of rows for all columns at a time.
+    NaN and +-inf are skipped, blocks without finite values are [NaN, NaN] and hence
+    never overlap any criteria.
+    """
+    block_count = -(-row_count//block_rows)
+    zone_map = {
+        col_name: np.full((block_count, 2), np.nan)
+        for col_name in column_list
+    }
+    for block in range(block_count):
+        rows = table_data[block*block_rows:(block+1)*block_rows]
+        for col_name in column_list:
+            chunk = rows[col_name]
+            if chunk.dtype.kind == 'f':
+                chunk = chunk[np.isfinite(chunk)]
+            if chunk.shape[0]:
+                zone_map[col_name][block] = chunk.min(), chunk.max()
+    return zone_map
+
+
+def prepare_zone_maps(data, brick_name_list, column_list, folderpath, savepath,
+                      block_rows=65536):
+    """ Compute zone maps for each brick where missing or outdated.
+
+    Returns list of bricks which were (re-)computed.
+    """
+    zone_map_path = get_zone_map_path(savepath)
+    if not os.path.isdir(zone_map_path):
+        os.makedirs(zone_map_path)
+    computed = []
+    for brick_name in tqdm(brick_name_list):
+        filepath = '{}{}.npz'.format(zone_map_path, brick_name)
+        source_filepath = folderpath + brick_name
+        if is_zone_map_valid(filepath, source_filepath, column_list, block_rows):
+            continue
+        row_count = data[brick_name].header['NAXIS2']
+        zone_map = get_zone_map(data[brick_name].data, column_list, row_count,
+                                block_rows=block_rows)
+        save_zone_map(zone_map, filepath, source_filepath, block_rows, row_count)
+        computed.append(brick_name)
+    return computed
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures for testing FIDS on small bricks written on the fly.
+"""
+import os
+import sys
+import numpy as np
+import pytest
+from astropy.io import fits
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from io_tools import get_file_pool, get_brick_data_types, get_data_counts, map_types
+
+
+def write_bricks(folderpath, brick_sizes, seed=0, ra_ranges=None):
+    """ Write a FITS brick of each size with columns Name, RA, DEC, return their names.
+
+    ra_ranges -- [(low, high)] of RA of each brick, (10, 11) for all if None
+    """
+    rng = np.random.default_rng(seed)
+    ra_ranges = ra_ranges or [(10, 11)]*len(brick_sizes)
+    brick_names = []
+    for i, brick_size in enumerate(brick_sizes):
+        brick_name = 'brick{:03d}.fits'.format(i)
+        fits.BinTableHDU.from_columns([
+            fits.Column(name='Name', format='16A',
+                        array=np.array(['S{:03d}_{:06d}'.format(i, row) for row in range(brick_size)])),
+            fits.Column(name='RA', format='D', array=np.sort(rng.uniform(*ra_ranges[i], brick_size))),
+            fits.Column(name='DEC', format='D', array=rng.uniform(40, 41, brick_size)),
+        ]).writeto(folderpath + brick_name)
+        brick_names.append(brick_name)
+    return brick_names
+
+
+def get_dataset(folderpath, brick_names, max_open=0):
+    """ Return (data, brick_column_details, brick_data_types, data_counts) as set up by FIDS. """
+    data = get_file_pool(brick_names, folderpath, max_open=max_open)
+    brick_column_details = {}
+    for brick_name in brick_names:
+        with fits.open(folderpath + brick_name) as hdulist:
+            brick_column_details[brick_name] = {
+                col_name: {
+                    'min': float(hdulist[1].data[col_name].min()),
+                    'max': float(hdulist[1].data[col_name].max())
+                }
+                for col_name in ['RA', 'DEC']
+            }
+    brick_data_types = map_types(get_brick_data_types(data, brick_names, ftype='fits'))
+    return data, brick_column_details, brick_data_types, get_data_counts(data, 'fits')
+
+
+@pytest.fixture
+def bricks(tmp_path):
+    """ Return (folderpath, brick_names) of six bricks of 2000 to 4500 rows. """
+    folderpath = str(tmp_path) + '/'
+    return folderpath, write_bricks(folderpath, [2000 + 500*i for i in range(6)])
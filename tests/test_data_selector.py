@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of querying bricks, see data_tools/data_selector.py.
+"""
+import numpy as np
+from astropy.io import fits
+from conftest import get_dataset, write_bricks
+from data_tools import get_all_data, get_sample_data, iter_all_data
+
+
+sample_settings = {
+    'min_brick_usage': 0,
+    'max_fill_attempts': 3,
+    'max_sample_size': 0,
+    'query_threads': 4
+}
+
+
+def get_names(folderpath, brick_names, criteria_dict):
+    """ Return names of rows within criteria, read directly from the files. """
+    names = []
+    for brick_name in brick_names:
+        with fits.open(folderpath + brick_name) as hdulist:
+            table_data = hdulist[1].data
+            selection = np.ones(len(table_data), dtype=bool)
+            for col_name, (low, high) in criteria_dict.items():
+                selection &= (table_data[col_name] > low) & (table_data[col_name] < high)
+            names.extend(table_data['Name'][selection])
+    return sorted(names)
+
+
+def test_queries_with_fewer_open_files_than_threads(bricks):
+    """ Bricks evicted while other threads query them stay readable. """
+    folderpath, brick_names = bricks
+    data, brick_column_details, brick_data_types, data_counts = get_dataset(
+        folderpath, brick_names, max_open=1
+    )
+    criteria_dict = {'RA': [10.2, 10.7]}
+    expected_names = get_names(folderpath, brick_names, criteria_dict)
+    for _ in range(5):
+        return_data = get_all_data(
+            brick_names, ['Name', 'RA'], criteria_dict, brick_column_details,
+            brick_data_types, data, threads=4
+        )
+        assert sorted(return_data['Name']) == expected_names
+        chunks = list(iter_all_data(
+            brick_names, ['Name'], criteria_dict, brick_column_details, data, chunk_rows=1000
+        ))
+        assert sorted(np.concatenate([chunk['Name'] for chunk in chunks])) == expected_names
+        sample = get_sample_data(
+            brick_names, 500, ['Name', 'RA'], criteria_dict, brick_column_details,
+            data, brick_data_types, data_counts, sample_settings
+        )
+        assert sample['Name'].shape[0] == 500
+        assert set(sample['Name']) <= set(expected_names)
+    assert data.stats()['evictions'] > 0
+
+
+def test_sample_fills_from_bricks_without_points_before(tmp_path):
+    """ Points bricks fall short of go to bricks which got none so far (rounded down). """
+    folderpath = str(tmp_path) + '/'
+    # Samples of fewer points than bricks leave half of the bricks without points, and
+    # those with points first (ties go to the first bricks) have none within the filter
+    brick_names = write_bricks(folderpath, [50]*20, ra_ranges=[(10, 10.4)]*10 + [(10.6, 11)]*10)
+    data, brick_column_details, brick_data_types, data_counts = get_dataset(folderpath, brick_names)
+    sample = get_sample_data(
+        brick_names, 10, ['Name', 'RA'], {}, brick_column_details, data,
+        brick_data_types, data_counts, sample_settings, predicate='RA > 10.5'
+    )
+    assert sample['Name'].shape[0] == 10
+    assert (sample['RA'] > 10.5).all()
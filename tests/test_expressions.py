@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of expressions on columns, see data_tools/expressions.py.
+"""
+import numpy as np
+from conftest import get_dataset  # noqa: F401  (adds the repository to the path)
+from data_tools import expressions
+
+
+def test_constants_reuse_compiled_kernel():
+    """ Expressions differing only in numbers share one kernel, e.g. bounds of selections. """
+    rng = np.random.default_rng(0)
+    data = {'A': rng.normal(size=1000), 'B': rng.normal(size=1000)}
+    values = data['A'] - data['B']
+    expressions.get_predicate_selection(data, '(-0.5 <= A - B <= 0.5)')
+    kernel_count = len(expressions.kernels)
+    for low, high in [(-1.0, 0.25), (0.1, 2.0), (-3.0, -1.5)]:
+        selection = expressions.get_predicate_selection(data, '({!r} <= A - B <= {!r})'.format(low, high))
+        assert np.array_equal(selection, (values >= low) & (values <= high))
+    assert len(expressions.kernels) == kernel_count
+
+
+def test_kernels_are_limited():
+    """ Least recently used kernels are dropped beyond max_kernels. """
+    data = {'A': np.arange(10, dtype=np.float64)}
+    max_kernels = expressions.max_kernels
+    expressions.max_kernels = 2
+    try:
+        for expression in ['A + 1', 'A * A', 'A / (A + 1)']:
+            expressions.evaluate_expressions(data, [expression])
+        assert len(expressions.kernels) == 2
+        assert np.allclose(expressions.evaluate_expressions(data, ['A + 2'])[0], data['A'] + 2)
+    finally:
+        expressions.max_kernels = max_kernels